@@ -1,35 +1,94 @@
-import tkinter as tk
-from tkinter import messagebox, scrolledtext
 import threading
 import time
-import pyautogui # For taking screenshots (alternative method)
-from PIL import Image, ImageGrab # For taking screenshots and image processing
+from PIL import Image # For taking screenshots and image processing
 import pytesseract # For OCR
 import requests # For sending HTTP requests to the callback URL
+from requests.adapters import HTTPAdapter # For pooled keep-alive connections
 import json # For handling JSON data
 import logging # For logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler # For non-blocking rotating logs
+import atexit # For flushing queued logs on exit
 from datetime import datetime # For timestamps
 import os # For file paths
 import sys # For system-specific parameters and functions
 import hashlib # For simple deduplication hashing
 import re # For regular expressions
-from pynput import mouse # For mouse listener during region selection
 import mss # Alternative screenshot library, potentially faster
 import io # For BytesIO
-from flask import Flask, request, jsonify # For the internal API server
+import zlib # For fast per-tile frame checksums
+import numpy as np # For vectorised image preprocessing
+import difflib # For OCR accuracy reports
+import uuid # For unique debug order IDs
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP # For normalising amounts and integer cents
+from collections import OrderedDict # For the preprocessing cache
+import argparse # For command line options
+import signal # For stopping headless mode on SIGTERM
+import statistics # For benchmark summaries
+import bisect # For histogram buckets
+import heapq # For pending-order expiry
+import queue # For sharing OCR engines between worker threads
+import sqlite3 # For the durable callback outbox and payment store
+import asyncio # For the event-driven push server
+import urllib.parse # For parsing push server requests
+from collections import deque # For the bounded recent-payments cache
+from dataclasses import dataclass, asdict, field # For typed parser results
+from typing import Optional # For typed parser results
+from concurrent.futures import ThreadPoolExecutor # For the OCR worker pool
+from flask import Flask, request, jsonify, Response, stream_with_context # For the internal API server
+try:
+    import tesserocr # Optional: long-lived in-process Tesseract API
+except ImportError:
+    tesserocr = None
+try:
+    import waitress # Optional: production WSGI server for the API
+except ImportError:
+    waitress = None
 
 
 # --- 配置 ---
 
 # 设置日志配置
-logging.basicConfig(
-    level=logging.DEBUG,  # 设置日志级别为 DEBUG，以便捕获更多信息
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("app.log", encoding='utf-8'), # 写入文件
-        logging.StreamHandler(sys.stdout) # 同时输出到控制台
-    ]
-)
+# 日志级别可用环境变量 DTY_LOG_LEVEL 或命令行 --log-level 修改，排查识别问题时再打开 DEBUG
+LOG_LEVEL = os.environ.get("DTY_LOG_LEVEL", "INFO")
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+LOG_FILE = "app.log"
+LOG_MAX_BYTES = 10 * 1024 * 1024 # 单个日志文件最大 10MB，超过后轮转
+LOG_BACKUP_COUNT = 5 # 保留的历史日志文件数 (app.log.1 ~ app.log.5)
+
+_log_listener = None
+
+def configure_logging(level=LOG_LEVEL):
+    """
+    日志写入通过 QueueHandler 交给后台 QueueListener 线程，
+    监控线程和 OCR 线程只负责把记录放进队列，不直接做磁盘 I/O。
+    重复调用时只修改日志级别。无效的级别 (例如 DTY_LOG_LEVEL=verbose) 记录警告后使用 INFO。
+    """
+    root = logging.getLogger()
+    invalid_level = None
+    if isinstance(level, str):
+        level = level.strip().upper()
+        if level not in LOG_LEVELS:
+            invalid_level, level = level, "INFO"
+    root.setLevel(level)
+    if _log_listener is None:
+        _start_log_listener(root)
+    if invalid_level is not None:
+        root.warning(f"无效的日志级别 {invalid_level!r}，使用 INFO (可选 {', '.join(LOG_LEVELS)})")
+
+def _start_log_listener(root):
+    global _log_listener
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8') # 写入文件
+    console_handler = logging.StreamHandler(sys.stdout) # 同时输出到控制台
+    for handler in (file_handler, console_handler):
+        handler.setFormatter(formatter)
+    log_queue = queue.SimpleQueue()
+    root.addHandler(QueueHandler(log_queue))
+    _log_listener = QueueListener(log_queue, file_handler, console_handler)
+    _log_listener.start()
+    atexit.register(_log_listener.stop) # 退出前写完队列中剩余的日志
+
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Tesseract OCR 可执行文件路径 (根据你的实际安装路径修改)
@@ -46,23 +105,2101 @@ pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tessera
 # 默认回调URL (可以在GUI中修改)
 DEFAULT_CALLBACK_URL = "http://localhost:5001/receive_payment"
 
+# API 服务: 'auto' 已安装 waitress 时使用 waitress (多线程生产级服务器)，否则回退到 Flask 开发服务器
+API_SERVER = 'auto'
+API_HOST = '0.0.0.0' # 对外网可见，生产环境需谨慎
+API_PORT = 5001
+API_THREADS = 8 # waitress 工作线程数 (API 端口上的每个 SSE/长轮询连接会占用一个线程，见 API_PUSH_MAX_SUBSCRIBERS)
+
 # OCR语言 (中文简体+英文)
 OCR_LANG = 'chi_sim+eng'
 
-# --- GUI 类定义 ---
-class NotificationWindow(tk.Tk):
+# OCR 引擎: 'auto' 优先使用常驻进程内的 tesserocr，不可用时回退到 pytesseract
+#           'tesserocr' / 'pytesseract' 强制使用指定引擎 (tesserocr 初始化失败时仍会回退)
+OCR_ENGINE = 'auto'
+# tesserocr 使用的 tessdata 目录 (None 表示使用 tesseract 的默认路径)
+TESSDATA_PATH = None
+# Tesseract 页面分割模式与引擎模式 (与原先的 --oem 3 --psm 6 保持一致)
+OCR_PSM = 6
+OCR_OEM = 3
+
+# 收款卡片区域识别 (ROI): 先按颜色找出与聊天背景颜色不同的卡片色带 (NumPy，不调用 OCR)，
+# 再只对卡片子区域做完整识别，金额行单独用仅数字白名单识别一遍
+ROI_ENABLED = True
+ROI_BAND_TOLERANCE = 6 # 灰度与背景色相差超过该值的像素算作卡片 (浅色模式背景 #EDEDED 与白色卡片相差 18)
+ROI_BAND_MIN_FILL = 0.3 # 一行中至少有这么多比例的像素属于卡片，才算卡片色带中的行 (居中的时间戳等短文字不算)
+ROI_BAND_MAX_GAP = 3 # 色带中间不超过这么多行的背景色 (卡片内的分隔线) 不切断色带
+ROI_CARD_MIN_HEIGHT = 40 # 高度低于该值的色带 (普通消息气泡、被截断的卡片边缘) 不识别
+ROI_FALLBACK_FULL = True # 整帧找不到任何卡片色带时 (例如框选区域在卡片内部，没有背景色)，对变化的部分完整识别
+ROI_MARGIN = 8 # 裁剪时在卡片四周保留的像素
+ROI_AMOUNT_DIGITS = True # 金额行是否单独做数字识别
+OCR_DIGITS_WHITELIST = "0123456789."
+
+# 收款识别规则文件 (JSON，格式同 DEFAULT_RECEIPT_RULES)，不存在时使用默认规则:
+# card_start 为收款卡片的标题 (卡片第一行)，用来把一帧中的多张卡片切开；include 为收款卡片中的关键词
+# (卡片末尾 "备注 收款成功，已存入零钱")，以标题开始或含 include 的卡片才是收款；exclude 关键词标志一张需要剔除的卡片 (自动续费、付款、退款等)，
+# anchors 为金额/时间/备注/汇总 ("今日第N笔") 字段的关键词。所有关键词编译成一个自动机，每段文本只扫描一遍
+RULES_FILE = "rules.json"
+DEFAULT_RECEIPT_RULES = {
+    "card_start": ["收款到账通知"],
+    "include": ["收款成功"],
+    "exclude": ["自动续费", "扣费成功", "付款成功", "支付成功", "退款"],
+    "anchors": {
+        "amount": ["收款金额"],
+        "time": ["收款时间", "到账时间"],
+        "memo": ["付款方备注", "转账备注"],
+        "summary": ["汇总"],
+    },
+}
+
+# 滚动感知的增量识别 (需要启用 ROI): 新通知把旧消息向上推时，按行哈希对齐相邻两帧估计滚动距离，
+# 只识别延伸到底部新露出部分的卡片，完全在旧内容里的卡片之前已经识别过
+SCROLL_OCR_ENABLED = True
+SCROLL_MAX_FRACTION = 0.75 # 滚动超过区域高度的这个比例时直接整帧识别
+SCROLL_MIN_MATCH = 0.95 # 重叠部分中有文字的行至少有这么多比例完全一致才认为是滚动
+SCROLL_MIN_TEXT_ROWS = 8 # 重叠部分至少要有这么多有文字的行，避免纯背景误判
+SCROLL_ROW_CONTRAST = 24 # 行内最亮与最暗像素相差超过该值才算有文字的行
+SCROLL_STRIP_OVERLAP = 2 # 新露出部分向上多算这么多行，底边刚好落在旧画面底边附近 (可能被截断) 的卡片重新识别
+
+# OCR 前的图像预处理 (灰度 -> 裁掉空白边 -> 整数倍放大 -> 自适应二值化)，
+# 预处理后微信可以使用正常字号，不必再把字体放大
+PREPROCESS_ENABLED = True
+PREPROCESS_SCALE = 2 # 整数放大倍数，1 表示不放大
+PREPROCESS_THRESHOLD = True # 是否做自适应二值化
+PREPROCESS_BLOCK_SIZE = 15 # 自适应阈值的邻域边长 (放大前的像素)
+PREPROCESS_OFFSET = 10 # 比邻域均值暗多少才算文字
+PREPROCESS_TRIM = True # 是否裁掉四周的纯色空白
+PREPROCESS_CACHE_SIZE = 32 # 缓存最近多少张图像的预处理结果
+
+# 预置的监控区域列表 (每个区域对应一个微信窗口/收款账户)，启动时填入GUI区域列表
+# 示例: [{"name": "商户A", "left": 0, "top": 0, "width": 400, "height": 600}]
+MONITOR_REGIONS = []
+
+# OCR 线程池大小 (最多同时识别的区域数)，每个工作线程独占一个 OCR 引擎
+OCR_WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+# 自适应轮询间隔 (秒): 画面变化或收款后立即回到最短间隔，画面静止时按倍数退避到最长间隔
+POLL_MIN_INTERVAL = 0.3
+POLL_MAX_INTERVAL = 5.0
+POLL_BACKOFF_FACTOR = 2.0
+
+# 回调投递发件箱 (SQLite)。识别到的收款先写入发件箱，再由后台线程投递，程序重启后继续投递
+OUTBOX_DB_PATH = "outbox.db"
+# 投递失败后的重试间隔 (秒): 第 n 次失败后等待 DELIVERY_RETRY_BASE * 2^(n-1)，最长 DELIVERY_RETRY_MAX
+DELIVERY_RETRY_BASE = 2.0
+DELIVERY_RETRY_MAX = 300.0
+# 连续失败这么多次后不再重试，转为死信 (保留在发件箱中供排查)；回调返回 4xx (408、429 除外) 说明通知本身有问题，直接转为死信
+DELIVERY_MAX_ATTEMPTS = 20
+# 单次回调请求超时 (秒)
+DELIVERY_TIMEOUT = 10
+# HTTP 连接池大小 (所有回调共用一个 keep-alive 会话)
+HTTP_POOL_SIZE = 8
+# 批量投递: 开启后同一回调地址的多条通知合并为一次请求发往批量接口 (…/receive_payment -> …/receive_payments)
+DELIVERY_BATCH_MODE = False
+DELIVERY_BATCH_SIZE = 20
+
+# 收款记录存储 (SQLite, WAL)，/receive_payment 写入，/query_payment 查询
+PAYMENTS_DB_PATH = "payments.db"
+# 待支付订单 (POST /orders 登记，收款入库时按 备注 + 金额 匹配)，默认/最长有效期 (秒)
+ORDER_TTL = 15 * 60
+ORDER_MAX_TTL = 24 * 3600
+# 订单支付成功后 POST 到 notify_url 的 webhook 发件箱 (与识别端的回调发件箱分开)
+WEBHOOK_OUTBOX_DB_PATH = "webhooks.db"
+# /query_payment 单页最多返回的记录数
+QUERY_MAX_LIMIT = 1000
+# /wait_payment 长轮询最长等待时间 (秒)
+WAIT_MAX_TIMEOUT = 60
+# /stream_payments 无新记录时发送心跳的间隔 (秒)，防止代理断开空闲连接
+SSE_KEEPALIVE_INTERVAL = 15
+# 推送服务: 独立端口上的 asyncio 事件循环 (一个线程) 保持所有 /wait_payment、/stream_payments 连接，
+# 每个连接只是一个协程，不占用 API 的工作线程；0 表示不启动 (仍可使用 API 端口上的推送接口)
+PUSH_PORT = 5003
+# 推送服务同时保持的连接数上限，超过时返回 503 和 Retry-After (受进程可打开的文件数限制)
+PUSH_MAX_SUBSCRIBERS = 10000
+# 推送服务在内存中缓存的最近收款条数，订阅者的游标在缓存范围内时不查询数据库
+PUSH_RECENT_RECORDS = 1000
+# API 端口 (waitress/gunicorn 工作线程) 上同时挂起的推送连接上限，每个连接占用一个工作线程，
+# 应小于 API_THREADS 给 /receive_payment 等普通请求留出线程；超过时返回 503，大量订阅者请连接 PUSH_PORT
+API_PUSH_MAX_SUBSCRIBERS = 4
+
+# 收款去重索引: 同一笔收款在保留时间内只上报/入库一次，超过条数上限时淘汰最旧的记录
+# (识别到的时间不含日期和秒时，订单ID不稳定，屏幕上同一张卡片只靠这里的保留时间去重)
+DEDUP_TTL = 6 * 3600
+DEDUP_MAX_ENTRIES = 10000
+# 去重键不足以区分两笔收款时 (没有带日期和秒的时间，也没有 "今日第N笔")，只在这么短的时间内去重 (秒)，
+# 挡住画面变化时同一张卡片的重复识别，又不会把几分钟后金额、备注相同的另一笔收款当成重复
+DEDUP_WEAK_TTL = 5
+
+# 帧变化检测: 分块网格 (行 x 列) 与采样行步长，步长越大越省CPU但越可能漏检细微变化
+FRAME_DIFF_TILE_ROWS = 8
+FRAME_DIFF_TILE_COLS = 4
+FRAME_DIFF_ROW_STEP = 2
+
+# 交给 pytesseract 的临时图像格式。BMP 为无压缩格式，写入只是内存拷贝，
+# 避免每帧都做一次 PNG 压缩
+OCR_IMAGE_FORMAT = 'BMP'
+
+# 界面刷新: 其他线程的日志/收款/状态先放进队列，主线程每隔 UI_REFRESH_MS 毫秒批量更新一次
+UI_REFRESH_MS = 200
+# 日志区域与收款记录区域最多保留的行数，超出后删除最早的行
+UI_LOG_MAX_LINES = 1000
+UI_PAYMENT_MAX_LINES = 500
+
+# /metrics 耗时直方图的分桶上界 (秒)
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# --- 运行指标 (Prometheus 文本格式，由 /metrics 输出) ---
+def _format_labels(label, value):
+    if label is None or value is None:
+        return ""
+    escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'{{{label}="{escaped}"}}'
+
+class Counter:
+    """只增不减的计数器，可以带一个标签 (如 result="ok")"""
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self._values = {} if label else {None: 0}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, label_value=None):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def value(self, label_value=None):
+        return self._values.get(label_value, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items(), key=lambda item: str(item[0]))
+        for label_value, value in items:
+            lines.append(f"{self.name}{_format_labels(self.label, label_value)} {value}")
+        return lines
+
+class Histogram:
+    """耗时直方图: observe 只做一次二分查找和三次加法，可以放在每帧的热路径上；可以带一个标签"""
+    def __init__(self, name, help_text, buckets=METRICS_LATENCY_BUCKETS, label=None):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.buckets = tuple(sorted(buckets))
+        # 标签值 -> [各桶计数 (最后一个是 +Inf), 总和, 次数]
+        self._series = {} if label else {None: [[0] * (len(self.buckets) + 1), 0.0, 0]}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, label_value=None):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self):
+        with self._lock:
+            items = sorted(((label_value, list(counts), total, count)
+                            for label_value, (counts, total, count) in self._series.items()), key=lambda item: str(item[0]))
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_value, counts, total, count in items:
+            labels = f'{self.label}="{label_value}",' if self.label else ""
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{self.name}_bucket{{{labels}le="{le}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{_format_labels(self.label, label_value)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label, label_value)} {count}")
+        return lines
+
+class Gauge:
+    """瞬时值，在输出 /metrics 时调用 set_function 设置的函数读取"""
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._func = None
+
+    def set_function(self, func):
+        self._func = func
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        if self._func is not None:
+            try:
+                lines.append(f"{self.name} {self._func()}")
+            except Exception as e:
+                logger.warning(f"读取指标 {self.name} 失败: {e}")
+        return lines
+
+class MetricsRegistry:
     def __init__(self):
-        super().__init__()
-        self.title("Dty 微信收款OCR监听器")
-        self.geometry("550x800") # 增加高度以容纳调试功能区域
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+capture_latency = metrics.register(Histogram("dty_capture_seconds", "截图、帧变化检测与图像转换耗时"))
+ocr_latency = metrics.register(Histogram("dty_ocr_seconds", "单帧 OCR 识别耗时"))
+ocr_pass_latency = metrics.register(Histogram(
+    "dty_ocr_pass_seconds", "ROI 识别各步骤的耗时 (pass=locate / card / digits / fallback)", label="pass"))
+parse_latency = metrics.register(Histogram("dty_parse_seconds", "OCR 文本解析耗时"))
+callback_latency = metrics.register(Histogram("dty_callback_seconds", "回调请求耗时 (批量投递时为整批)"))
+frames_counter = metrics.register(Counter("dty_frames_total", "采集的帧数 (result=ocr 执行识别 / skipped 画面未变化)", label="result"))
+duplicates_counter = metrics.register(Counter("dty_duplicates_suppressed_total", "被去重挡住的收款 (stage=detected 识别端 / ingested 接收端)", label="stage"))
+ocr_rows_counter = metrics.register(Counter("dty_ocr_rows_total", "送入 OCR 的像素行数 (mode=card 卡片色带 / fallback 认不出版面时变化的部分)", label="mode"))
+orders_counter = metrics.register(Counter("dty_orders_total", "待支付订单事件 (event=registered / paid / expired)", label="event"))
+rule_hits_counter = metrics.register(Counter("dty_rule_hits_total", "识别规则关键词命中次数 (rule=类别:关键词)", label="rule"))
+deliveries_counter = metrics.register(Counter("dty_deliveries_total", "回调投递结果 (result=success / failure / dead 不再重试)", label="result"))
+webhook_latency = metrics.register(Histogram("dty_webhook_seconds", "订单 webhook 请求耗时"))
+webhook_deliveries_counter = metrics.register(Counter(
+    "dty_webhook_deliveries_total", "订单 webhook 投递结果 (result=success / failure / dead 不再重试)", label="result"))
+delivery_backlog_gauge = metrics.register(Gauge("dty_delivery_backlog", "发件箱中待投递的通知数"))
+push_subscribers_gauge = metrics.register(Gauge("dty_push_subscribers", "挂起中的 /wait_payment 与 /stream_payments 连接数"))
+payment_records_gauge = metrics.register(Gauge("dty_payment_records", "payments.db 中的收款记录数 (最大记录ID，记录只增不删)"))
+
+# --- 截图转换 ---
+def screenshot_to_image(screenshot):
+    """直接从 mss 的 BGRA 原始缓冲区构造 PIL Image，不经过 PNG 编码/解码"""
+    img = Image.frombuffer("RGB", screenshot.size, screenshot.raw, "raw", "BGRX", 0, 1)
+    # pytesseract 会按 image.format 写临时文件，未设置时默认使用 PNG
+    img.format = OCR_IMAGE_FORMAT
+    return img
+
+def _legacy_screenshot_to_image(screenshot):
+    """旧的转换方式 (PNG 编码后再解码)，仅用于基准测试对比"""
+    import mss.tools
+    img = Image.open(io.BytesIO(mss.tools.to_png(screenshot.rgb, screenshot.size)))
+    img.load()
+    return img
+
+def benchmark_capture(region, frames=50):
+    """
+    对比旧/新两种截图转换路径的每帧耗时 (截图 + 转换 + 交给OCR的临时文件编码)。
+    :param region: mss 区域字典 {"left", "top", "width", "height"}
+    :param frames: 每种路径测量的帧数
+    :return: {路径名: {"mean_ms", "p50_ms", "p95_ms"}}
+    """
+    def measure(convert):
+        samples = []
+        with mss.mss() as sct:
+            for _ in range(frames):
+                start = time.perf_counter()
+                img = convert(sct.grab(region))
+                # 模拟 pytesseract 写临时文件的编码开销
+                img.save(io.BytesIO(), format=img.format or 'PNG')
+                samples.append((time.perf_counter() - start) * 1000)
+        samples.sort()
+        return {
+            "mean_ms": statistics.mean(samples),
+            "p50_ms": samples[len(samples) // 2],
+            "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        }
+
+    return {
+        "png_roundtrip": measure(_legacy_screenshot_to_image),
+        "frombuffer": measure(screenshot_to_image),
+    }
+
+# --- OCR 引擎 ---
+@dataclass
+class OCRWord:
+    """一个识别出的单词及其在图像中的位置 (line_key 相同的单词属于同一行)"""
+    text: str
+    left: int
+    top: int
+    right: int
+    bottom: int
+    line_key: tuple = ()
+
+@dataclass
+class OCRLine:
+    """一行文本及其外接矩形"""
+    text: str
+    left: int
+    top: int
+    right: int
+    bottom: int
+    words: list
+
+def group_lines(words):
+    """按 line_key 把单词合并为文本行，保持识别顺序"""
+    grouped = {}
+    for word in words:
+        grouped.setdefault(word.line_key, []).append(word)
+    return [OCRLine(text=" ".join(w.text for w in line_words),
+                    left=min(w.left for w in line_words), top=min(w.top for w in line_words),
+                    right=max(w.right for w in line_words), bottom=max(w.bottom for w in line_words),
+                    words=line_words)
+            for line_words in grouped.values()]
+
+class OCREngine:
+    """
+    OCR 引擎接口。
+    image_to_string 返回整段文本；image_to_words 返回带位置的单词 (用于定位金额行)；
+    image_to_digits 把图像当作单行、只允许数字和小数点识别 (用于金额行)。
+    """
+    name = "base"
+
+    def image_to_string(self, img):
+        raise NotImplementedError
+
+    def image_to_words(self, img):
+        raise NotImplementedError
+
+    def image_to_digits(self, img):
+        raise NotImplementedError
+
+    def warm_up(self):
+        """用一张空白小图跑一次识别，提前加载语言数据"""
+        start = time.perf_counter()
+        self.image_to_string(Image.new("RGB", (64, 32), "white"))
+        logger.info(f"OCR 引擎 {self.name} 预热完成，耗时 {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    def close(self):
+        pass
+
+class PytesseractEngine(OCREngine):
+    """原有路径：每次识别都启动一个 tesseract 进程"""
+    name = "pytesseract"
+
+    def __init__(self, lang=OCR_LANG, psm=OCR_PSM, oem=OCR_OEM):
+        self.config = f'--oem {oem} --psm {psm} -l {lang}'
+        self.digits_config = f'--oem {oem} --psm 7 -l eng -c tessedit_char_whitelist={OCR_DIGITS_WHITELIST}'
+
+    def image_to_string(self, img):
+        return pytesseract.image_to_string(img, config=self.config)
+
+    def image_to_words(self, img):
+        data = pytesseract.image_to_data(img, config=self.config, output_type=pytesseract.Output.DICT)
+        words = []
+        for i, text in enumerate(data["text"]):
+            text = text.strip()
+            if not text:
+                continue
+            left, top = data["left"][i], data["top"][i]
+            words.append(OCRWord(text, left, top, left + data["width"][i], top + data["height"][i],
+                                 (data["block_num"][i], data["par_num"][i], data["line_num"][i])))
+        return words
+
+    def image_to_digits(self, img):
+        return pytesseract.image_to_string(img, config=self.digits_config).strip()
+
+class TesserocrEngine(OCREngine):
+    """常驻的 Tesseract API 句柄，语言数据只在初始化时加载一次"""
+    name = "tesserocr"
+
+    def __init__(self, lang=OCR_LANG, psm=OCR_PSM, oem=OCR_OEM, tessdata_path=TESSDATA_PATH):
+        if tesserocr is None:
+            raise RuntimeError("未安装 tesserocr")
+        kwargs = {"lang": lang, "psm": psm, "oem": oem}
+        if tessdata_path:
+            kwargs["path"] = tessdata_path
+        self.api = tesserocr.PyTessBaseAPI(**kwargs)
+        # 金额行的数字识别使用单独的句柄 (仅英文数据，单行模式，数字白名单)
+        digits_kwargs = dict(kwargs, lang="eng", psm=7)
+        self.digits_api = tesserocr.PyTessBaseAPI(**digits_kwargs)
+        self.digits_api.SetVariable("tessedit_char_whitelist", OCR_DIGITS_WHITELIST)
+        # 同一个 API 句柄不能被多个线程同时使用
+        self._lock = threading.Lock()
+
+    def image_to_string(self, img):
+        with self._lock:
+            self.api.SetImage(img)
+            return self.api.GetUTF8Text()
+
+    def image_to_words(self, img):
+        level = tesserocr.RIL.WORD
+        words = []
+        with self._lock:
+            self.api.SetImage(img)
+            self.api.Recognize()
+            iterator = self.api.GetIterator()
+            line_index = -1
+            for result in tesserocr.iterate_level(iterator, level):
+                if result.IsAtBeginningOf(tesserocr.RIL.TEXTLINE):
+                    line_index += 1
+                text = (result.GetUTF8Text(level) or "").strip()
+                box = result.BoundingBox(level)
+                if text and box:
+                    words.append(OCRWord(text, box[0], box[1], box[2], box[3], (line_index,)))
+        return words
+
+    def image_to_digits(self, img):
+        with self._lock:
+            self.digits_api.SetImage(img)
+            return self.digits_api.GetUTF8Text().strip()
+
+    def close(self):
+        with self._lock:
+            self.api.End()
+            self.digits_api.End()
+
+def create_ocr_engine(preferred=OCR_ENGINE):
+    """按配置创建 OCR 引擎，tesserocr 不可用时回退到 pytesseract"""
+    if preferred in ('auto', 'tesserocr'):
+        try:
+            return TesserocrEngine()
+        except Exception as e:
+            logger.warning(f"tesserocr 引擎不可用，回退到 pytesseract: {e}")
+    return PytesseractEngine()
+
+# --- 图像预处理 ---
+class ImagePreprocessor:
+    """
+    OCR 前的图像预处理，全部用 NumPy 向量化实现：
+    灰度化 (深色模式自动反色) -> 裁掉四周空白 -> 整数倍放大 -> 基于积分图的自适应阈值二值化。
+    结果按输入像素的摘要缓存，同一张图 (例如未变化的收款卡片) 不会重复处理。
+    """
+    TRIM_TOLERANCE = 12 # 行/列内最亮与最暗像素相差不超过该值视为空白
+    TRIM_PADDING = 4
+
+    def __init__(self, scale=PREPROCESS_SCALE, threshold=PREPROCESS_THRESHOLD, block_size=PREPROCESS_BLOCK_SIZE,
+                 offset=PREPROCESS_OFFSET, trim=PREPROCESS_TRIM, cache_size=PREPROCESS_CACHE_SIZE):
+        self.scale = max(1, int(scale))
+        self.threshold = threshold
+        self.block_size = max(3, int(block_size) | 1) # 保证为奇数
+        self.offset = offset
+        self.trim = trim
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def process(self, img):
+        """预处理一张 PIL 图像，返回 'L' 模式的 PIL 图像"""
+        gray = np.asarray(img.convert("L"))
+        key = (gray.shape, hashlib.md5(gray.tobytes()).digest()) if self.cache_size else None
+        if key is not None:
+            with self._lock:
+                cached = self._cache.get(key)
+                if cached is not None:
+                    self._cache.move_to_end(key)
+                    self.cache_hits += 1
+                    return cached
+        result = Image.fromarray(self.process_array(gray))
+        result.format = OCR_IMAGE_FORMAT
+        if key is not None:
+            with self._lock:
+                self.cache_misses += 1
+                self._cache[key] = result
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return result
+
+    def process_array(self, gray):
+        """对 uint8 灰度数组做预处理"""
+        if gray.size == 0:
+            return gray
+        # 深色模式 (浅色字深色底) 先反色，统一为深色字
+        if gray.mean() < 128:
+            gray = 255 - gray
+        if self.trim:
+            gray = self.trim_blank(gray)
+        if self.scale > 1:
+            gray = np.repeat(np.repeat(gray, self.scale, axis=0), self.scale, axis=1)
+        if self.threshold:
+            gray = self.adaptive_threshold(gray, self.block_size * self.scale | 1, self.offset)
+        return np.ascontiguousarray(gray)
+
+    def trim_blank(self, gray):
+        """裁掉四周像素值几乎不变的行和列"""
+        rows = np.flatnonzero(np.ptp(gray, axis=1) > self.TRIM_TOLERANCE)
+        cols = np.flatnonzero(np.ptp(gray, axis=0) > self.TRIM_TOLERANCE)
+        if rows.size == 0 or cols.size == 0:
+            return gray
+        pad = self.TRIM_PADDING
+        return gray[max(0, rows[0] - pad):rows[-1] + pad + 1, max(0, cols[0] - pad):cols[-1] + pad + 1]
+
+    @staticmethod
+    def adaptive_threshold(gray, block_size, offset):
+        """自适应均值阈值：比 block_size 邻域均值暗 offset 以上的像素置为黑色 (0)，其余为白色 (255)"""
+        h, w = gray.shape
+        radius = block_size // 2
+        integral = np.zeros((h + 1, w + 1), dtype=np.int64)
+        integral[1:, 1:] = gray.cumsum(axis=0, dtype=np.int64).cumsum(axis=1)
+        y0 = np.clip(np.arange(h) - radius, 0, h)
+        y1 = np.clip(np.arange(h) + radius + 1, 0, h)
+        x0 = np.clip(np.arange(w) - radius, 0, w)
+        x1 = np.clip(np.arange(w) + radius + 1, 0, w)
+        sums = (integral[y1[:, None], x1[None, :]] - integral[y0[:, None], x1[None, :]]
+                - integral[y1[:, None], x0[None, :]] + integral[y0[:, None], x0[None, :]])
+        counts = (y1 - y0)[:, None] * (x1 - x0)[None, :]
+        return np.where(gray.astype(np.int64) * counts < sums - offset * counts, 0, 255).astype(np.uint8)
+
+image_preprocessor = ImagePreprocessor()
+
+def preprocess_for_ocr(img):
+    """按配置预处理，未启用时原样返回"""
+    return image_preprocessor.process(img) if PREPROCESS_ENABLED else img
+
+def _char_accuracy(expected, actual):
+    """忽略空白后的字符级相似度 (0~1)"""
+    expected = re.sub(r"\s+", "", expected)
+    actual = re.sub(r"\s+", "", actual)
+    if not expected:
+        return 1.0 if not actual else 0.0
+    return difflib.SequenceMatcher(None, expected, actual, autojunk=False).ratio()
+
+def benchmark_preprocessing(samples, engine, configs=None):
+    """
+    比较不同预处理配置的识别准确率与耗时。
+    :param samples: [(PIL 图像, 期望文本), ...]
+    :param engine: OCR 引擎
+    :param configs: {配置名: ImagePreprocessor 或 None (不预处理)}
+    :return: {配置名: {"accuracy", "preprocess_ms", "ocr_ms"}}
+    """
+    if configs is None:
+        configs = {
+            "原图": None,
+            "灰度": ImagePreprocessor(scale=1, threshold=False, trim=False, cache_size=0),
+            "灰度+裁边+2倍": ImagePreprocessor(scale=2, threshold=False, cache_size=0),
+            "灰度+裁边+2倍+二值化": ImagePreprocessor(scale=2, threshold=True, cache_size=0),
+            "灰度+裁边+3倍+二值化": ImagePreprocessor(scale=3, threshold=True, cache_size=0),
+        }
+    report = {}
+    for name, preprocessor in configs.items():
+        accuracies, pre_ms, ocr_ms = [], [], []
+        for img, expected in samples:
+            start = time.perf_counter()
+            prepared = preprocessor.process(img) if preprocessor else img
+            middle = time.perf_counter()
+            text = engine.image_to_string(prepared)
+            end = time.perf_counter()
+            pre_ms.append((middle - start) * 1000)
+            ocr_ms.append((end - middle) * 1000)
+            accuracies.append(_char_accuracy(expected, text))
+        report[name] = {
+            "accuracy": statistics.mean(accuracies) if accuracies else 0.0,
+            "preprocess_ms": statistics.mean(pre_ms) if pre_ms else 0.0,
+            "ocr_ms": statistics.mean(ocr_ms) if ocr_ms else 0.0,
+        }
+    return report
+
+# --- 帧变化检测 ---
+class FrameChangeDetector:
+    """
+    比较相邻两帧的原始像素，只有区域内容发生变化时才需要OCR。
+    把画面切成 tile_rows x tile_cols 的网格，每块按 row_step 隔行采样后计算 crc32，
+    与上一帧的分块哈希逐块比较。
+    """
+    def __init__(self, tile_rows=FRAME_DIFF_TILE_ROWS, tile_cols=FRAME_DIFF_TILE_COLS, row_step=FRAME_DIFF_ROW_STEP):
+        self.tile_rows = max(1, tile_rows)
+        self.tile_cols = max(1, tile_cols)
+        self.row_step = max(1, row_step)
+        self.last_signature = None
+        self.changed_tiles = []
+
+    def reset(self):
+        """清除上一帧记录，下一帧必定被视为已变化"""
+        self.last_signature = None
+        self.changed_tiles = []
+
+    def signature(self, raw, width, height, bytes_per_pixel=4):
+        """计算一帧的分块哈希 (raw 为 mss 的 BGRA 原始缓冲区)"""
+        view = memoryview(raw)
+        stride = width * bytes_per_pixel
+        # 列边界按像素对齐，避免把一个像素拆到两个块里
+        col_bounds = [(width * c // self.tile_cols) * bytes_per_pixel for c in range(self.tile_cols + 1)]
+        tiles = []
+        for r in range(self.tile_rows):
+            row_start = height * r // self.tile_rows
+            row_end = height * (r + 1) // self.tile_rows
+            crcs = [0] * self.tile_cols
+            for y in range(row_start, row_end, self.row_step):
+                offset = y * stride
+                for c in range(self.tile_cols):
+                    crcs[c] = zlib.crc32(view[offset + col_bounds[c]:offset + col_bounds[c + 1]], crcs[c])
+            tiles.extend(crcs)
+        return (width, height, tuple(tiles))
+
+    def has_changed(self, raw, width, height):
+        """返回当前帧相对上一帧是否有变化，并记录本帧签名"""
+        current = self.signature(raw, width, height)
+        previous = self.last_signature
+        self.last_signature = current
+        if previous is None or previous[:2] != current[:2]:
+            self.changed_tiles = list(range(len(current[2])))
+            return True
+        self.changed_tiles = [i for i, (a, b) in enumerate(zip(previous[2], current[2])) if a != b]
+        return bool(self.changed_tiles)
+
+# --- 滚动检测 ---
+_row_hash_weights = {}
+
+def row_signature(gray):
+    """
+    计算灰度图 (H x W 的 uint8 数组) 每一行的哈希，以及哪些行有文字 (非纯背景)。
+    哈希为像素与固定随机权重的点积 (按 2^64 取模)，整图一次向量化计算。
+    """
+    height, width = gray.shape
+    weights = _row_hash_weights.get(width)
+    if weights is None:
+        weights = np.random.default_rng(width).integers(1, 2 ** 63, size=width, dtype=np.uint64)
+        _row_hash_weights[width] = weights
+    hashes = (gray.astype(np.uint64) * weights).sum(axis=1)
+    informative = (gray.max(axis=1) - gray.min(axis=1)) > SCROLL_ROW_CONTRAST
+    return hashes, informative
+
+def estimate_scroll(previous, current, max_fraction=SCROLL_MAX_FRACTION, min_match=SCROLL_MIN_MATCH,
+                    min_text_rows=SCROLL_MIN_TEXT_ROWS):
+    """
+    估计当前帧相对上一帧向上滚动了多少行 (上一帧的第 y+dy 行 == 当前帧的第 y 行)。
+    :param previous: 上一帧的 row_signature
+    :param current: 当前帧的 row_signature
+    :return: dy (0 表示内容没有移动)，无法对齐时返回 None (内容原地变化、滚动过多或尺寸变化)
+    """
+    prev_hashes, prev_text = previous
+    cur_hashes, cur_text = current
+    height = len(cur_hashes)
+    if len(prev_hashes) != height:
+        return None
+    if np.array_equal(prev_hashes, cur_hashes):
+        return 0
+    max_shift = int(height * max_fraction)
+
+    # 候选位移: 当前帧开头几行有文字的行在上一帧中出现的位置
+    candidates = set()
+    for y in np.flatnonzero(cur_text)[:3]:
+        candidates.update(int(dy) for dy in np.flatnonzero(prev_hashes == cur_hashes[y]) - y if 0 < dy <= max_shift)
+
+    best, best_ratio = None, min_match
+    for dy in sorted(candidates):
+        overlap = height - dy
+        text_rows = prev_text[dy:] | cur_text[:overlap]
+        count = int(text_rows.sum())
+        if count < min_text_rows:
+            continue
+        ratio = int(((prev_hashes[dy:] == cur_hashes[:overlap]) & text_rows).sum()) / count
+        if ratio > best_ratio or (best is None and ratio >= best_ratio):
+            best, best_ratio = dy, ratio
+    return best
+
+class ScrollState:
+    """
+    一个监控区域在相邻帧之间保留的增量识别状态：上一帧的行签名。
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """清除状态，下一帧整帧识别"""
+        self.rows = None
+
+    def plan(self, rows, height):
+        """
+        根据本帧的行签名估计滚动距离，返回新内容的起始纵坐标 (其上方的内容上一帧已经识别过)。
+        无法对齐时返回 0，即整帧识别；内容没有移动时返回 height。
+        """
+        dy = estimate_scroll(self.rows, rows) if self.rows is not None else None
+        if dy is None:
+            return 0
+        return max(0, height - dy - SCROLL_STRIP_OVERLAP) if dy else height
+
+    def commit(self, rows):
+        self.rows = rows
+
+# --- 自适应轮询 ---
+class AdaptivePollScheduler:
+    """
+    根据画面活跃程度调整轮询间隔。
+    有变化或收款时回到 min_interval 快速轮询，连续静止时每轮乘以 backoff，直到 max_interval。
+    """
+    def __init__(self, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL, backoff=POLL_BACKOFF_FACTOR):
+        if min_interval <= 0 or max_interval < min_interval:
+            raise ValueError("轮询间隔必须满足 0 < 最短间隔 <= 最长间隔")
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = max(1.0, backoff)
+        self.interval = min_interval
+
+    def on_activity(self):
+        """画面变化或检测到收款，立即切换到最短间隔 (可从任意线程调用)"""
+        self.interval = self.min_interval
+
+    def on_idle(self):
+        """本轮所有区域都没有变化，按倍数退避"""
+        self.interval = min(self.max_interval, self.interval * self.backoff)
+
+# --- 监控区域 ---
+class MonitorRegion:
+    """一个监控区域 (对应一个微信窗口/收款账户)，各自维护帧变化检测状态"""
+    def __init__(self, name, left, top, width, height):
+        self.name = name
+        self.monitor = {"left": left, "top": top, "width": width, "height": height}
+        self.detector = FrameChangeDetector()
+        self.scroll = ScrollState() # 滚动感知的增量识别状态
+        self.future = None # 正在识别的帧 (同一区域同时只识别一帧)
+
+    def reset(self):
+        """清除帧变化检测和增量识别状态，下一帧必定整帧重新识别"""
+        self.detector.reset()
+        self.scroll.reset()
+
+    @classmethod
+    def from_config(cls, config):
+        """从 {"name", "left", "top", "width", "height"} 字典创建"""
+        return cls(config.get("name") or "默认", int(config["left"]), int(config["top"]),
+                   int(config["width"]), int(config["height"]))
+
+    def coords_str(self):
+        m = self.monitor
+        return f"{m['left']},{m['top']},{m['width']},{m['height']}"
+
+    def __str__(self):
+        return f"{self.name}: {self.coords_str()}"
+
+# --- 回调投递发件箱 ---
+def open_sqlite(path):
+    """打开 SQLite 数据库并启用 WAL，允许多个线程通过同一连接 (由调用方加锁) 访问"""
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """返回全局共享的 requests.Session (连接池 + keep-alive)"""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({'Content-Type': 'application/json'})
+            _http_session = session
+        return _http_session
+
+def bulk_callback_url(url):
+    """单条回调地址对应的批量接口地址，无法推断时返回 None"""
+    path = url.split('?', 1)[0].rstrip('/')
+    if path.endswith('/receive_payment'):
+        return path + 's'
+    return None
+
+class PaymentOutbox:
+    """持久化的回调发件箱，每行是一条待投递的通知 (目标URL + JSON 数据)"""
+    def __init__(self, path=OUTBOX_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = open_sqlite(path)
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    url TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_error TEXT,
+                    dead_at REAL
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_next_attempt ON outbox(next_attempt_at)")
+            # 旧的发件箱没有死信标记
+            if "dead_at" not in {row[1] for row in self._conn.execute("PRAGMA table_info(outbox)")}:
+                self._conn.execute("ALTER TABLE outbox ADD COLUMN dead_at REAL")
+
+    def enqueue(self, url, payload):
+        """写入一条待投递通知，返回其ID"""
+        now = time.time()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO outbox (url, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+                (url, json.dumps(payload, ensure_ascii=False), now, now))
+            return cursor.lastrowid
+
+    def due(self, limit=20):
+        """取出已到重试时间的通知 (不含死信): [(id, url, payload, attempts), ...]"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, url, payload, attempts FROM outbox WHERE dead_at IS NULL AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (time.time(), limit)).fetchall()
+        return [(row_id, url, json.loads(payload), attempts) for row_id, url, payload, attempts in rows]
+
+    def mark_delivered(self, row_id):
+        """投递成功，从发件箱删除"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+
+    def mark_failed(self, row_id, attempts, error):
+        """投递失败，按指数退避安排下一次重试，返回等待秒数；失败次数达到 DELIVERY_MAX_ATTEMPTS 时转为死信并返回 None"""
+        attempts += 1
+        if attempts >= DELIVERY_MAX_ATTEMPTS:
+            self.mark_dead(row_id, attempts, error)
+            return None
+        delay = min(DELIVERY_RETRY_MAX, DELIVERY_RETRY_BASE * (2 ** (attempts - 1)))
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (attempts, time.time() + delay, str(error)[:500], row_id))
+        return delay
+
+    def mark_dead(self, row_id, attempts, error):
+        """不再重试 (死信)，记录保留在发件箱中"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE outbox SET attempts = ?, dead_at = ?, last_error = ? WHERE id = ?",
+                (attempts, time.time(), str(error)[:500], row_id))
+
+    def pending_count(self):
+        """待投递的通知数 (不含死信)"""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM outbox WHERE dead_at IS NULL").fetchone()[0]
+
+    def dead_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM outbox WHERE dead_at IS NOT NULL").fetchone()[0]
+
+    def seconds_until_next_due(self):
+        """距离最早一条通知可重试还有多少秒，没有待投递的通知时返回 None"""
+        with self._lock:
+            row = self._conn.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE dead_at IS NULL").fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class DeliveryWorker(threading.Thread):
+    """后台投递线程：从发件箱取出到期的通知并发送，失败的通知按退避时间重试，4xx 或失败次数过多时转为死信"""
+    def __init__(self, outbox, on_delivered=None, idle_wait=5.0, batch_mode=DELIVERY_BATCH_MODE,
+                 name="delivery", latency=callback_latency, counter=deliveries_counter):
+        super().__init__(name=name, daemon=True)
+        self.outbox = outbox
+        self.on_delivered = on_delivered # 投递成功后的回调 on_delivered(payload)
+        self.latency = latency # 请求耗时直方图与投递结果计数 (收款回调与订单 webhook 分开统计)
+        self.counter = counter
+        self.idle_wait = idle_wait
+        self.batch_mode = batch_mode
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+
+    def wake(self):
+        """有新通知写入发件箱时调用，立即开始投递"""
+        self._wake_event.set()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        self._wake_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        logger.info(f"投递线程已启动，发件箱中待投递通知: {self.outbox.pending_count()} 条")
+        while not self._stop_event.is_set():
+            try:
+                batch = self.outbox.due(limit=DELIVERY_BATCH_SIZE if self.batch_mode else 20)
+                if self.batch_mode:
+                    self._deliver_batches(batch)
+                else:
+                    for row_id, url, payload, attempts in batch:
+                        if self._stop_event.is_set():
+                            break
+                        self._deliver(row_id, url, payload, attempts)
+                if batch:
+                    continue # 可能还有到期的通知，继续取
+                wait = self.outbox.seconds_until_next_due()
+                wait = self.idle_wait if wait is None else min(wait, self.idle_wait)
+            except Exception as e:
+                logger.error(f"投递线程发生错误: {e}", exc_info=True)
+                wait = self.idle_wait
+            self._wake_event.wait(wait)
+            self._wake_event.clear()
+        logger.info("投递线程已停止。")
+
+    def _deliver(self, row_id, url, payload, attempts):
+        start = time.perf_counter()
+        try:
+            response = get_http_session().post(url, data=json.dumps(payload), timeout=DELIVERY_TIMEOUT)
+            self.latency.observe(time.perf_counter() - start)
+            if response.status_code == 200:
+                logger.info(f"成功发送通知到 {url}。响应: {response.status_code}")
+                self._delivered(row_id, payload)
+                return
+            error = f"状态码: {response.status_code}, 响应: {response.text}"
+            if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+                # 请求本身被拒绝 (数据格式等问题)，重试也不会成功
+                self._dead(row_id, attempts + 1, error)
+                return
+        except requests.exceptions.RequestException as e:
+            self.latency.observe(time.perf_counter() - start)
+            error = f"网络错误: {e}"
+        self._failed(row_id, attempts, error)
+
+    def _deliver_batches(self, batch):
+        """按回调地址分组，每组一次请求发往批量接口；无法推断批量接口的地址仍逐条发送"""
+        groups = {}
+        for item in batch:
+            groups.setdefault(item[1], []).append(item)
+        for url, items in groups.items():
+            if self._stop_event.is_set():
+                return
+            bulk_url = bulk_callback_url(url)
+            if bulk_url is None or len(items) == 1:
+                for row_id, _, payload, attempts in items:
+                    self._deliver(row_id, url, payload, attempts)
+                continue
+            start = time.perf_counter()
+            try:
+                body = {"payments": [payload for _, _, payload, _ in items]}
+                response = get_http_session().post(bulk_url, data=json.dumps(body), timeout=DELIVERY_TIMEOUT)
+                self.latency.observe(time.perf_counter() - start)
+                if response.status_code != 200:
+                    raise requests.exceptions.RequestException(f"状态码: {response.status_code}, 响应: {response.text}")
+                body = response.json()
+                results = body.get("results") if isinstance(body, dict) else None
+                if not isinstance(results, list):
+                    raise ValueError(f"返回格式无效: {response.text[:200]}")
+            except (requests.exceptions.RequestException, ValueError) as e:
+                for row_id, _, _, attempts in items:
+                    self._failed(row_id, attempts, f"批量投递失败: {e}")
+                continue
+            logger.info(f"批量发送 {len(items)} 条通知到 {bulk_url}")
+            for index, (row_id, _, payload, attempts) in enumerate(items):
+                result = results[index] if index < len(results) else None
+                if isinstance(result, dict) and result.get("status") == "success":
+                    self._delivered(row_id, payload)
+                else:
+                    self._failed(row_id, attempts, f"批量接口返回: {result}")
+
+    def _delivered(self, row_id, payload):
+        self.outbox.mark_delivered(row_id)
+        self.counter.inc(label_value="success")
+        if self.on_delivered:
+            self.on_delivered(payload)
+
+    def _failed(self, row_id, attempts, error):
+        delay = self.outbox.mark_failed(row_id, attempts, error)
+        if delay is None:
+            self.counter.inc(label_value="dead")
+            logger.error(f"发送通知失败 (第 {attempts + 1} 次)，已达到最大重试次数，不再重试。{error}")
+            return
+        self.counter.inc(label_value="failure")
+        logger.error(f"发送通知失败 (第 {attempts + 1} 次)，{delay:.0f} 秒后重试。{error}")
+
+    def _dead(self, row_id, attempts, error):
+        self.outbox.mark_dead(row_id, attempts, error)
+        self.counter.inc(label_value="dead")
+        logger.error(f"通知被回调地址拒绝，不再重试 (保留在发件箱 {self.outbox.path} 中)。{error}")
+
+# --- 收款识别规则 ---
+@dataclass
+class RuleHit:
+    """一次关键词命中: 类别 (include / exclude / amount / time / memo)、关键词、在原文中的 [start, end)"""
+    kind: str
+    keyword: str
+    start: int
+    end: int
+
+class ReceiptRules:
+    """
+    把收款 / 剔除 / 字段关键词编译成一个 Aho-Corasick 自动机。
+    scan 对文本只做一遍扫描就找出所有关键词 (可重叠)，耗时与文本长度成正比，不随关键词数量增加。
+    扫描时跳过空白字符，关键词的字与字之间允许 OCR 插入的空格和换行。
+    """
+    FIELD_KINDS = ("amount", "time", "memo", "summary")
+
+    def __init__(self, include, exclude=(), anchors=None, card_start=()):
+        self.rules = [("include", keyword) for keyword in include] + [("exclude", keyword) for keyword in exclude]
+        self.rules += [("card_start", keyword) for keyword in card_start]
+        for kind, keywords in (anchors or {}).items():
+            if kind not in self.FIELD_KINDS:
+                raise ValueError(f"未知的字段类别: {kind} (可选 {', '.join(self.FIELD_KINDS)})")
+            self.rules += [(kind, keyword) for keyword in keywords]
+        if not include:
+            raise ValueError("至少需要一个 include 关键词")
+        self._build()
+
+    def _build(self):
+        # goto[state] 为 {字符: 下一状态}，output[state] 为在该状态结束的 [(类别, 关键词, 去空白后的长度)]
+        goto, output = [{}], [[]]
+        seen = {}
+        for kind, keyword in self.rules:
+            compact = re.sub(r"\s+", "", str(keyword))
+            if not compact:
+                raise ValueError(f"{kind} 中有空关键词")
+            if seen.setdefault(compact, kind) != kind:
+                raise ValueError(f"关键词 {keyword} 同时属于 {seen[compact]} 和 {kind}")
+            state = 0
+            for char in compact:
+                if char not in goto[state]:
+                    goto.append({})
+                    output.append([])
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            if not output[state]:
+                output[state].append((kind, keyword, len(compact)))
+
+        # 按层 (BFS) 计算失败指针，并把失败链上的输出合并进来，扫描时不必再沿失败链收集
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in goto[state].items():
+                queue.append(child)
+                target = fail[state]
+                while target and char not in goto[target]:
+                    target = fail[target]
+                fail[child] = goto[target].get(char, 0)
+                output[child] = output[child] + output[fail[child]]
+        self._goto, self._fail, self._output = goto, fail, output
+
+    def scan(self, text):
+        """返回文本中所有关键词命中 [RuleHit, ...]，按结束位置排列"""
+        goto, fail, output = self._goto, self._fail, self._output
+        hits = []
+        positions = [] # 已送入自动机的非空白字符在原文中的下标
+        state = 0
+        for index, char in enumerate(text):
+            if char.isspace():
+                continue
+            positions.append(index)
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for kind, keyword, length in output[state]:
+                hits.append(RuleHit(kind, keyword, positions[-length], index + 1))
+        return hits
+
+    @staticmethod
+    def count(hits):
+        """累加规则命中计数 (/metrics 中的 dty_rule_hits_total)"""
+        for hit in hits:
+            rule_hits_counter.inc(label_value=f"{hit.kind}:{hit.keyword}")
+
+def load_receipt_rules(path=RULES_FILE):
+    """从 JSON 文件加载识别规则，文件不存在时使用 DEFAULT_RECEIPT_RULES。规则无效时抛出 ValueError"""
+    config = DEFAULT_RECEIPT_RULES
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            try:
+                config = json.load(f)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"规则文件 {path} 不是有效的 JSON: {e}") from e
+        if not isinstance(config, dict):
+            raise ValueError(f"规则文件 {path} 必须是一个 JSON 对象")
+        logger.info(f"已加载识别规则: {path}")
+    return ReceiptRules(config.get("include", []), config.get("exclude", []), config.get("anchors", {}),
+                        config.get("card_start", []))
+
+def _load_startup_rules():
+    try:
+        return load_receipt_rules()
+    except (OSError, ValueError) as e:
+        logger.error(f"加载识别规则失败，使用默认规则: {e}")
+        return load_receipt_rules(None)
+
+# --- 收款通知解析 ---
+# 提取失败时使用的默认值 (与回调数据中的取值保持一致)
+UNKNOWN_AMOUNT = "未知"
+UNKNOWN_TIME = "未知时间"
+NO_MEMO = "无备注"
+
+@dataclass
+class ReceiptFields:
+    """从一段OCR文本中提取出的收款字段，未找到的字段为 None"""
+    is_payment: bool = False
+    amount: Optional[str] = None
+    payment_time: Optional[str] = None
+    user_memo: Optional[str] = None
+    daily_index: Optional[int] = None # 汇总中的 "今日第N笔"
+
+class ReceiptParser:
+    """
+    微信收款通知解析器。关键词来自识别规则 (ReceiptRules)，
+    先用规则自动机扫描一遍文本，记录收款/剔除/字段关键词的位置，
+    再只在字段关键词之后的小窗口内匹配金额/时间/备注。
+    """
+    AMOUNT_PATTERN = re.compile(r"\d+(?:\.\d{2})?")
+    DATETIME_PATTERN = re.compile(r"\d{4}[-/]\d{1,2}[-/]\d{1,2}\s*\d{1,2}:\d{2}(?::\d{2})?")
+    CLOCK_PATTERN = re.compile(r"\d{1,2}:\d{2}(?::\d{2})?")
+    CLOCK_HMS_PATTERN = re.compile(r"\d{1,2}:\d{2}:\d{2}")
+    # 备注在换行或下一个信息块 ("汇总"、"备注") 的首字处截断
+    MEMO_STOP_PATTERN = re.compile(r"[\r\n汇总备注]")
+    LINE_END_PATTERN = re.compile(r"[\r\n]")
+    DAILY_INDEX_PATTERN = re.compile(r"第\s*(\d+)\s*笔")
+
+    # 关键词之后用于匹配的窗口长度 (字符)
+    AMOUNT_WINDOW = 20
+    TIME_WINDOW = 25
+    MEMO_WINDOW = 30
+    SUMMARY_WINDOW = 20
+
+    def __init__(self, rules=None):
+        self.rules = rules if rules is not None else load_receipt_rules(None)
+
+    def parse(self, text):
+        """解析一段OCR文本，返回 ReceiptFields (含剔除关键词时判定为非收款)"""
+        hits = self.scan(text)
+        self.rules.count(hits)
+        return self._parse_hits(text, hits)
+
+    def scan(self, text):
+        """
+        扫描文本中的关键词命中。同一行中字段关键词之后的 include / exclude 命中属于字段的值
+        (例如备注 "退款单1" 中的 "退款")，不是卡片的开始，予以去掉。
+        """
+        hits = self.rules.scan(text)
+        value_spans = []
+        for hit in hits:
+            if hit.kind in ReceiptRules.FIELD_KINDS:
+                line_end = self.LINE_END_PATTERN.search(text, hit.end)
+                value_spans.append((hit.end, line_end.start() if line_end else len(text)))
+        if not value_spans:
+            return hits
+        return [hit for hit in hits
+                if hit.kind in ReceiptRules.FIELD_KINDS or not any(start <= hit.start < end for start, end in value_spans)]
+
+    def _parse_hits(self, text, hits):
+        anchors = {kind: [] for kind in ("card_start", "include", "exclude") + ReceiptRules.FIELD_KINDS}
+        for hit in hits:
+            anchors[hit.kind].append(hit.end)
+
+        fields = ReceiptFields(is_payment=bool(anchors["card_start"] or anchors["include"]) and not anchors["exclude"])
+        fields.amount = self._extract_amount(text, anchors["amount"])
+        fields.payment_time = self._extract_time(text, anchors["time"])
+        fields.user_memo = self._extract_memo(text, anchors["memo"])
+        fields.daily_index = self._extract_daily_index(text, anchors["summary"])
+        return fields
+
+    def _card_spans(self, text, hits):
+        """
+        按卡片标题 (card_start) 和剔除关键词把文本切成卡片，返回 [(start, end), ...]。
+        第一个标题之前的内容 (滚出区域顶部、被截断的卡片) 不属于任何卡片；
+        文本中没有卡片标题时 (只有一张卡片且标题没有识别出来) 整段文本作为一张卡片。
+        """
+        boundaries = sorted((hit.start, hit.kind) for hit in hits if hit.kind in ("card_start", "exclude"))
+        first = next((start for start, kind in boundaries if kind == "card_start"), None)
+        if first is None:
+            return [(0, len(text))]
+        spans = []
+        for (start, kind), (end, _) in zip(boundaries, boundaries[1:] + [(len(text), None)]):
+            if start >= first and end > start:
+                spans.append((start, end))
+        return spans
+
+    def _payment_cards(self, text, hits):
+        """[(start, end, ReceiptFields), ...]，只包含收款卡片 (剔除的卡片不在其中)"""
+        cards = []
+        for start, end in self._card_spans(text, hits):
+            card_hits = [RuleHit(hit.kind, hit.keyword, hit.start - start, hit.end - start)
+                         for hit in hits if start <= hit.start and hit.end <= end]
+            fields = self._parse_hits(text[start:end], card_hits)
+            if fields.is_payment:
+                cards.append((start, end, fields))
+        return cards
+
+    def parse_all(self, text):
+        """解析一帧中的所有收款卡片，返回 [(卡片文本, ReceiptFields), ...]，没有收款时返回空列表"""
+        hits = self.scan(text) # 整帧只扫描一遍，各卡片复用命中结果
+        self.rules.count(hits)
+        return [(text[start:end], fields) for start, end, fields in self._payment_cards(text, hits)]
+
+    def payment_spans(self, text):
+        """parse_all 切出的收款卡片在文本中的位置 [(start, end), ...] (不计入规则命中次数)"""
+        return [(start, end) for start, end, _ in self._payment_cards(text, self.scan(text))]
+
+    def _extract_amount(self, text, positions):
+        if not positions:
+            return None
+        start = positions[0]
+        match = self.AMOUNT_PATTERN.search(text, start, start + self.AMOUNT_WINDOW)
+        return match.group(0) if match else None
+
+    def _extract_time(self, text, positions):
+        for start in positions:
+            end = start + self.TIME_WINDOW
+            match = self.DATETIME_PATTERN.search(text, start, end) or self.CLOCK_PATTERN.search(text, start, end)
+            if match:
+                return match.group(0).strip()
+        # 关键词附近没有时间时，在全文中查找
+        match = self.DATETIME_PATTERN.search(text) or self.CLOCK_HMS_PATTERN.search(text)
+        return match.group(0).strip() if match else None
+
+    def _extract_memo(self, text, positions):
+        for start in positions:
+            window = text[start:start + self.MEMO_WINDOW].lstrip().lstrip(':：').lstrip()
+            stop = self.MEMO_STOP_PATTERN.search(window)
+            memo = (window[:stop.start()] if stop else window).strip()
+            if memo:
+                return memo
+        return None
+
+    def _extract_daily_index(self, text, positions):
+        for start in positions:
+            match = self.DAILY_INDEX_PATTERN.search(text, start, start + self.SUMMARY_WINDOW)
+            if match:
+                return int(match.group(1))
+        return None
+
+receipt_parser = ReceiptParser(_load_startup_rules())
+
+# --- 收款卡片区域识别 (ROI) ---
+@dataclass
+class RecognitionResult:
+    """一帧的识别结果：用于解析的文本，以及每张收款卡片数字专用识别得到的金额 (按卡片顺序，可能为 None)"""
+    text: str
+    amount_hints: list = field(default_factory=list)
+    timings: dict = field(default_factory=dict) # 各识别步骤的耗时 (秒)，见 dty_ocr_pass_seconds
+
+class ReceiptRegionRecognizer:
+    """
+    只识别收款卡片而不是整个监控区域：
+    1. 用 NumPy 按颜色找出卡片色带 (与聊天背景颜色不同、足够宽也足够高的连续行)，不调用 OCR；
+       整帧找不到任何色带时 (无法判断版面) 对变化的部分做一次完整识别兜底 (ROI_FALLBACK_FULL)；
+    2. 只对卡片子图做完整的 OCR_LANG 识别，由解析器判断是收款还是需要剔除的卡片；
+    3. 金额行只取 "收款金额" 右侧的数字部分，用仅数字白名单再识别一次，减少金额误读。
+    """
+    AMOUNT_VALUE_PATTERN = re.compile(r"^\d+(?:\.\d{2})?$")
+    DIGIT_PATTERN = re.compile(r"\d")
+
+    def __init__(self, tolerance=ROI_BAND_TOLERANCE, min_fill=ROI_BAND_MIN_FILL, max_gap=ROI_BAND_MAX_GAP,
+                 min_height=ROI_CARD_MIN_HEIGHT, margin=ROI_MARGIN, amount_digits=ROI_AMOUNT_DIGITS,
+                 fallback_full=ROI_FALLBACK_FULL):
+        self.tolerance = tolerance
+        self.min_fill = min_fill
+        self.max_gap = max_gap
+        self.min_height = min_height
+        self.margin = margin
+        self.amount_digits = amount_digits
+        self.fallback_full = fallback_full
+
+    def recognise(self, engine, img, scroll=None):
+        """
+        识别一帧，返回 RecognitionResult。
+        传入 scroll (该区域的 ScrollState) 时，画面只是整体上移的话只识别延伸到新露出部分的卡片
+        (完全在旧内容里的卡片之前已经识别过)。
+        """
+        gray = np.asarray(img.convert("L"))
+        rows = None
+        strip_top = 0
+        if scroll is not None:
+            rows = row_signature(gray)
+            strip_top = scroll.plan(rows, img.height)
+        timings = {}
+        start = time.perf_counter()
+        bands = self.locate_cards(gray)
+        cards = [band for band in bands if band[3] > strip_top]
+        timings["locate"] = time.perf_counter() - start
+
+        result = RecognitionResult("")
+        if not bands and self.fallback_full and strip_top < img.height:
+            # 画面变了但认不出卡片版面：对变化的部分完整识别一遍，由解析器判断是否有收款
+            start = time.perf_counter()
+            ocr_rows_counter.inc(img.height - strip_top, label_value="fallback")
+            strip = img.crop((0, strip_top, img.width, img.height)) if strip_top else img
+            result = RecognitionResult(engine.image_to_string(preprocess_for_ocr(strip)))
+            timings["fallback"] = time.perf_counter() - start
+        elif cards:
+            texts = []
+            timings["card"] = 0.0
+            for left, top, right, bottom in cards:
+                start = time.perf_counter()
+                box = (max(0, left - self.margin), max(0, top - self.margin),
+                       min(img.width, right + self.margin), min(img.height, bottom + self.margin))
+                ocr_rows_counter.inc(box[3] - box[1], label_value="card")
+                card_img = preprocess_for_ocr(img.crop(box))
+                lines = group_lines(engine.image_to_words(card_img))
+                texts.append("\n".join(line.text for line in lines))
+                timings["card"] += time.perf_counter() - start
+                if self.amount_digits:
+                    start = time.perf_counter()
+                    result.amount_hints.extend(self._recognise_amount(engine, card_img, card_lines)
+                                               for card_lines in self._split_card_lines(lines))
+                    timings["digits"] = timings.get("digits", 0.0) + time.perf_counter() - start
+            result.text = "\n".join(texts)
+        result.timings = timings
+        if scroll is not None:
+            scroll.commit(rows) # 识别成功后才更新，出错时下一帧仍从上次的状态对齐
+        return result
+
+    def locate_cards(self, gray):
+        """
+        返回灰度图 (H x W 的 uint8 数组) 中所有卡片色带的矩形 [(left, top, right, bottom), ...]，从上到下排列。
+        背景色取左右两侧边缘像素中最多的灰度值。
+        """
+        height, width = gray.shape
+        if not height or not width:
+            return []
+        edges = np.concatenate((gray[:, 0], gray[:, -1]))
+        background = int(np.bincount(edges, minlength=256).argmax())
+        card = np.abs(gray.astype(np.int16) - background) > self.tolerance
+        band_rows = card.mean(axis=1) >= self.min_fill
+        # 填平色带中间不超过 max_gap 行的空隙 (卡片内的分隔线)
+        padded = np.concatenate(([False], band_rows, [False]))
+        changes = np.flatnonzero(padded[1:] != padded[:-1])
+        runs = [[int(a), int(b)] for a, b in zip(changes[::2], changes[1::2])]
+        merged = []
+        for run in runs:
+            if merged and run[0] - merged[-1][1] <= self.max_gap:
+                merged[-1][1] = run[1]
+            else:
+                merged.append(run)
+        cards = []
+        for top, bottom in merged:
+            if bottom - top < self.min_height:
+                continue
+            columns = np.flatnonzero(card[top:bottom].mean(axis=0) >= 0.5)
+            left, right = (int(columns[0]), int(columns[-1]) + 1) if len(columns) else (0, width)
+            cards.append((left, top, right, bottom))
+        return cards
+
+    def _split_card_lines(self, lines):
+        """把完整识别的文本行分成每张收款卡片的行 (按 ReceiptParser.parse_all 的切分，剔除的卡片不在其中)"""
+        starts, position = [], 0
+        for line in lines:
+            starts.append(position)
+            position += len(line.text) + 1
+        return [[line for line, line_start in zip(lines, starts) if line_start < end and line_start + len(line.text) > start]
+                for start, end in receipt_parser.payment_spans("\n".join(line.text for line in lines))]
+
+    @staticmethod
+    def _amount_anchor(text):
+        """文本中第一个金额字段关键词 (来自识别规则的 anchors.amount)，没有时返回 None"""
+        return next((hit for hit in receipt_parser.rules.scan(text) if hit.kind == "amount"), None)
+
+    def _recognise_amount(self, engine, card_img, lines):
+        """对金额关键词 (如 "收款金额") 右侧的数字部分做数字专用识别"""
+        for line in lines:
+            if self._amount_anchor(line.text) is None:
+                continue
+            # 逐词拼接找到关键词结束的位置，从其后第一个数字开始裁剪 (跳过 "¥" 等货币符号)
+            joined = ""
+            anchor_seen = False
+            for word in line.words:
+                search_from = 0
+                if not anchor_seen:
+                    joined += word.text
+                    anchor = self._amount_anchor(joined)
+                    if anchor is None:
+                        continue
+                    anchor_seen = True
+                    # 关键词和金额可能被识别成同一个词
+                    search_from = max(0, len(word.text) - (len(joined) - anchor.end))
+                digit = self.DIGIT_PATTERN.search(word.text, search_from)
+                if digit:
+                    # 按字符比例估算第一个数字的横坐标
+                    x = word.left + (word.right - word.left) * digit.start() // max(1, len(word.text))
+                    box = (max(0, x - 2), max(0, line.top - 2), min(card_img.width, line.right + self.margin),
+                           min(card_img.height, line.bottom + 2))
+                    digits = engine.image_to_digits(card_img.crop(box))
+                    if self.AMOUNT_VALUE_PATTERN.match(digits):
+                        return digits
+                    logger.debug("金额数字识别结果无效: %r", digits)
+                    return None
+        return None
+
+receipt_recognizer = ReceiptRegionRecognizer()
+
+def recognise_frame(engine, img, scroll=None):
+    """按配置识别一帧：启用 ROI 时只识别收款卡片 (传入 scroll 时增量识别)，否则整图识别"""
+    if ROI_ENABLED:
+        return receipt_recognizer.recognise(engine, img, scroll if SCROLL_OCR_ENABLED else None)
+    return RecognitionResult(engine.image_to_string(preprocess_for_ocr(img)))
+
+def parse_recognition(recognition):
+    """把一帧的识别结果拆成每张收款卡片分别解析，返回 [(卡片文本, ReceiptFields), ...]"""
+    cards = receipt_parser.parse_all(recognition.text)
+    if not recognition.amount_hints:
+        return cards
+    if len(recognition.amount_hints) != len(cards):
+        # 按文本和按行切出的卡片数不一致 (例如某张卡片的标题没有识别出来)，无法确定金额属于哪张卡片
+        logger.warning(f"数字识别得到 {len(recognition.amount_hints)} 个金额，但解析出 {len(cards)} 张卡片，不使用数字识别的金额")
+        return cards
+    for (_, fields), hint in zip(cards, recognition.amount_hints):
+        if hint:
+            fields.amount = hint # 数字专用识别的金额更可靠
+    return cards
+
+# --- 收款去重 ---
+class DedupIndex:
+    """
+    有界、按时间过期的去重索引 (线程安全)。
+    键按插入顺序保存在 OrderedDict 中 (超过条数上限时淘汰最旧的键)；
+    每个键可以有自己的保留时间，过期时间另外放在小根堆中，按过期顺序清理。
+    """
+    def __init__(self, ttl=DEDUP_TTL, max_entries=DEDUP_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # key -> 过期时间
+        self._expiry = [] # [(过期时间, 序号, key), ...] 小根堆，键被淘汰或重新加入后留下的旧项在弹出时跳过
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def add_if_absent(self, key, ttl=None):
+        """键不存在 (或已过期) 时记录下来并返回 True；重复时返回 False。ttl 为该键的保留时间，默认 self.ttl"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if key in self._entries:
+                return False
+            expires_at = now + (self.ttl if ttl is None else ttl)
+            self._entries[key] = expires_at
+            self._sequence += 1
+            heapq.heappush(self._expiry, (expires_at, self._sequence, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if len(self._expiry) > 2 * self.max_entries:
+                # 淘汰的键留下的旧项太多时重建堆
+                self._expiry = [(expires_at, index, key) for index, (key, expires_at) in enumerate(self._entries.items())]
+                heapq.heapify(self._expiry)
+                self._sequence = len(self._expiry)
+            return True
+
+    def discard(self, key):
+        """撤销一个键 (例如后续处理失败，需要允许重新上报)"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            self._expire(time.monotonic())
+            return len(self._entries)
+
+    def _expire(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, _, key = heapq.heappop(self._expiry)
+            if self._entries.get(key) == expires_at:
+                del self._entries[key]
+
+# 监控线程与 receive_payment 共用；键分别以 "detected" / "ingested" 区分
+payment_dedup = DedupIndex()
+
+DATETIME_PARTS_PATTERN = re.compile(r"(\d{4})[-/](\d{1,2})[-/](\d{1,2})\s*(\d{1,2}):(\d{2})(?::(\d{2}))?")
+CLOCK_PARTS_PATTERN = re.compile(r"(\d{1,2}):(\d{2})(?::(\d{2}))?")
+
+def normalize_payment_time(payment_time, today=None):
+    """把OCR时间规范为 'YYYY-MM-DD HH:MM:SS'；只有时分秒时补上当天日期，无法识别时返回空字符串"""
+    if not payment_time:
+        return ""
+    match = DATETIME_PARTS_PATTERN.search(payment_time)
+    if match:
+        year, month, day, hour, minute, second = match.groups()
+        return f"{year}-{int(month):02d}-{int(day):02d} {int(hour):02d}:{minute}:{second or '00'}"
+    match = CLOCK_PARTS_PATTERN.search(payment_time)
+    if match:
+        hour, minute, second = match.groups()
+        today = today or datetime.now().strftime("%Y-%m-%d")
+        return f"{today} {int(hour):02d}:{minute}:{second or '00'}"
+    return ""
+
+def amount_to_cents(amount):
+    """把金额 (字符串或数字) 精确转换为整数分，四舍五入到分，无法识别时返回 None"""
+    try:
+        return int(Decimal(str(amount).strip()).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP) * 100)
+    except (InvalidOperation, ValueError):
+        return None
+
+def format_cents(cents):
+    """整数分 -> 两位小数字符串"""
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
+def normalize_amount(amount):
+    """把金额规范为两位小数字符串，无法识别时返回空字符串"""
+    cents = amount_to_cents(amount)
+    return format_cents(cents) if cents is not None else ""
+
+def is_full_timestamp(payment_time):
+    """时间是否包含日期和秒：只有这样的时间才足以区分金额、备注都相同的两笔收款"""
+    match = DATETIME_PARTS_PATTERN.search(payment_time or "")
+    return bool(match and match.group(6))
+
+def _dedup_time(payment_time):
+    """去重键中的时间：有日期时为完整时间；只有时分秒时不补日期，跨过午夜重新识别同一张卡片仍得到同一个键"""
+    if payment_time and not DATETIME_PARTS_PATTERN.search(payment_time):
+        match = CLOCK_PARTS_PATTERN.search(payment_time)
+        if match:
+            hour, minute, second = match.groups()
+            return f"{int(hour):02d}:{minute}:{second or '00'}"
+    return normalize_payment_time(payment_time)
+
+def payment_dedup_key(amount, payment_time, user_memo, account="", daily_index=None, today=None):
+    """
+    由规范化后的金额 + 时间 + 备注 (+ 账户) 组成的去重键，不受OCR空格等噪声影响。
+    有 "今日第N笔" 时再加上识别当天的日期和 N，金额、备注都相同的两笔收款也能区分。
+    """
+    memo = re.sub(r"\s+", "", user_memo or "")
+    key = "|".join((account or "", normalize_amount(amount), _dedup_time(payment_time), memo))
+    if daily_index is not None:
+        key += f"|{today or datetime.now().strftime('%Y-%m-%d')}#{daily_index}"
+    return key
+
+def fields_dedup_key(fields, account=""):
+    """识别结果 (ReceiptFields) 的去重键"""
+    return payment_dedup_key(fields.amount, fields.payment_time, fields.user_memo, account=account,
+                             daily_index=fields.daily_index)
+
+def is_distinct_payment(fields):
+    """去重键能否区分金额、备注都相同的两笔收款：时间带日期和秒，或者有 "今日第N笔" """
+    return is_full_timestamp(fields.payment_time) or fields.daily_index is not None
+
+def detected_dedup_ttl(fields):
+    """识别端去重键的保留时间：能区分不同收款时为 DEDUP_TTL，否则只挡住短时间内的重复识别 (DEDUP_WEAK_TTL)"""
+    return DEDUP_TTL if is_distinct_payment(fields) else DEDUP_WEAK_TTL
+
+def stable_order_id(dedup_key, prefix="ocr_detected_"):
+    """由去重键生成稳定的订单ID：同一笔收款每次识别都得到相同ID，不同收款不会冲突"""
+    return prefix + hashlib.sha1(dedup_key.encode("utf-8")).hexdigest()[:16]
+
+def detected_order_id(fields, dedup_key):
+    """
+    识别到的收款的订单ID。去重键能区分不同收款时 (is_distinct_payment) 由去重键生成稳定ID
+    (重复上报会被 receive_payment 识别为同一笔)；否则去重键可能对不同的收款相同 (例如没有时间和备注)，
+    每次识别生成新的ID，屏幕上同一张卡片的重复识别只由内存中的去重索引 (DEDUP_WEAK_TTL) 挡住。
+    """
+    if is_distinct_payment(fields):
+        return stable_order_id(dedup_key)
+    return new_detected_order_id()
+
+def new_detected_order_id():
+    """不与任何其他收款冲突的订单ID"""
+    return f"ocr_detected_{uuid.uuid4().hex[:16]}"
+
+def build_payment_data(fields, ocr_text, account="", region="", order_id=None):
+    """把解析结果组装成发送给回调URL的 payment_data"""
+    amount = fields.amount or UNKNOWN_AMOUNT
+    user_memo = fields.user_memo or NO_MEMO
+
+    # 将时间和其他信息组合成 payer_memo，真正的用户备注单独存放或合并
+    # 如果 OCR 时间提取失败，使用当前系统时间作为回退
+    if fields.payment_time is None:
+        current_time_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        ocr_info_memo = f"[系统时间] {current_time_str}"
+        logger.debug("[DEBUG] OCR时间提取失败，使用系统时间: %s", current_time_str)
+    else:
+        ocr_info_memo = f"[OCR时间] {fields.payment_time}"
+
+    if fields.user_memo:
+        final_payer_memo = f"{ocr_info_memo} | 用户备注: {user_memo}"
+    else:
+        final_payer_memo = ocr_info_memo
+
+    return {
+        "order_id": order_id or new_detected_order_id(),
+        "amount": amount,
+        "payer_memo": final_payer_memo, # 使用组合后的备注
+        "timestamp": int(time.time()),
+        "ocr_raw_text": ocr_text,
+        "user_memo": user_memo, # 可选：单独存一份用户备注
+        "account": account, # 收款账户 (监控区域名称)
+        "region": region
+    }
+
+def benchmark_parser(texts, repeat=1):
+    """
+    解析器基准测试。
+    :param texts: OCR文本列表
+    :param repeat: 重复次数
+    :return: {"texts", "seconds", "texts_per_second", "payments"}
+    """
+    parser = ReceiptParser(receipt_parser.rules)
+    payments = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            if parser.parse(text).is_payment:
+                payments += 1
+    elapsed = time.perf_counter() - start
+    total = len(texts) * repeat
+    return {"texts": total, "seconds": elapsed, "texts_per_second": total / elapsed if elapsed else 0.0, "payments": payments}
+
+# --- 录制与回放 ---
+class FrameRecorder:
+    """
+    录制模式：保存每个执行了 OCR 的区域帧 (xxx.png)、OCR 文本 (xxx.txt) 和解析结果 (xxx.json)。
+    xxx.json 人工核对修改后即是 --replay 的标注，xxx.txt 改成正确文本后可用于 --bench-preprocess。
+    """
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def record(self, account, img, ocr_text, cards):
+        """cards 为本帧解析出的 ReceiptFields 列表 (没有收款时为空)"""
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+        safe_account = re.sub(r'[^\w-]', '_', account or "region")
+        base = os.path.join(self.directory, f"{datetime.now():%Y%m%d-%H%M%S}_{seq:06d}_{safe_account}")
+        img.save(base + ".png")
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            f.write(ocr_text)
+        with open(base + ".json", "w", encoding="utf-8") as f:
+            json.dump({"account": account, "cards": [asdict(fields) for fields in cards]}, f, ensure_ascii=False, indent=2)
+
+REPLAY_FIELDS = ("is_payment", "amount", "payment_time", "user_memo")
+
+def _label_cards(label):
+    """标注中的收款卡片列表 (兼容只有单张卡片字段的旧格式)"""
+    if "cards" in label:
+        return label["cards"]
+    return [label] if label.get("is_payment") else []
+
+def _percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return 0.0
+    return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * fraction))]
+
+def _start_replay_stub_server():
+    """在 127.0.0.1 的随机端口启动回调桩服务，返回 (server, 回调URL, 收到的通知列表)"""
+    from werkzeug.serving import make_server # Flask 自带的依赖
+    stub = Flask("replay_stub")
+    received = []
+
+    @stub.route('/receive_payment', methods=['POST'])
+    def stub_receive_payment():
+        received.append(request.get_json(force=True, silent=True))
+        return jsonify({"status": "success"}), 200
+
+    server = make_server("127.0.0.1", 0, stub, threaded=True)
+    threading.Thread(target=server.serve_forever, name="replay-stub", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/receive_payment", received
+
+def replay_frames(directory, engine, callback_url=None):
+    """
+    把录制的帧依次送过 帧变化检测 → OCR → 解析 → 去重 → 投递，统计吞吐、各阶段耗时和字段准确率。
+    :param directory: 包含 *.png 的目录，同名 .json 为标注 (可选，格式同 FrameRecorder)
+    :param engine: 已预热的 OCR 引擎
+    :param callback_url: 回调地址，为 None 时发往本地桩服务
+    :return: {"frames", "seconds", "frames_per_second", "stages": {阶段: {"p50_ms", "p99_ms"}},
+              "payments", "duplicates", "delivered", "labelled", "labelled_cards",
+              "card_count_accuracy", "accuracy": {字段: 按卡片计的准确率}}
+    """
+    server = None
+    if callback_url is None:
+        server, callback_url, _ = _start_replay_stub_server()
+    stages = {name: [] for name in ("capture", "ocr", "parse", "dedup", "delivery")}
+    detectors = {}
+    scrolls = {}
+    dedup = DedupIndex() # 独立的索引，不影响正在运行的监控
+    correct = {name: 0 for name in REPLAY_FIELDS}
+    labelled = labelled_cards = correct_card_counts = payments = duplicates = delivered = 0
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith(".png"))
+
+    def timed(stage, start):
+        now = time.perf_counter()
+        stages[stage].append((now - start) * 1000)
+        return now
+
+    started = time.perf_counter()
+    try:
+        for name in names:
+            base = os.path.join(directory, os.path.splitext(name)[0])
+            label = None
+            if os.path.exists(base + ".json"):
+                with open(base + ".json", encoding="utf-8") as f:
+                    label = json.load(f)
+            account = (label or {}).get("account") or ""
+
+            # 1. "采集": 读取 PNG 并做帧变化检测 (与监控循环一样按账户分别检测)
+            start = time.perf_counter()
+            img = Image.open(base + ".png").convert("RGB")
+            detector = detectors.setdefault(account, FrameChangeDetector())
+            changed = detector.has_changed(img.convert("RGBA").tobytes(), img.width, img.height)
+            start = timed("capture", start)
+            if not changed:
+                continue
+
+            # 2. OCR
+            recognition = recognise_frame(engine, img, scrolls.setdefault(account, ScrollState()))
+            start = timed("ocr", start)
+            for name, seconds in recognition.timings.items():
+                stages.setdefault(f"ocr_{name}", []).append(seconds * 1000)
+
+            # 3. 解析 (一帧可能有多张卡片)
+            cards = parse_recognition(recognition)
+            start = timed("parse", start)
+
+            if label is not None:
+                labelled += 1
+                expected_cards = _label_cards(label)
+                if len(expected_cards) == len(cards):
+                    correct_card_counts += 1
+                for index, expected in enumerate(expected_cards):
+                    labelled_cards += 1
+                    actual = cards[index][1] if index < len(cards) else ReceiptFields()
+                    for field_name in REPLAY_FIELDS:
+                        expected_value, actual_value = expected.get(field_name), getattr(actual, field_name)
+                        if field_name == "amount" and expected_value is not None and actual_value is not None:
+                            expected_value, actual_value = normalize_amount(expected_value), normalize_amount(actual_value)
+                        if expected_value == actual_value:
+                            correct[field_name] += 1
+
+            for card_text, fields in cards:
+                payments += 1
+
+                # 4. 去重
+                start = time.perf_counter()
+                dedup_key = fields_dedup_key(fields, account=account)
+                is_new = dedup.add_if_absent(dedup_key, ttl=detected_dedup_ttl(fields))
+                start = timed("dedup", start)
+                if not is_new:
+                    duplicates += 1
+                    continue
+
+                # 5. 投递
+                payment_data = build_payment_data(fields, card_text, account=account, region="replay",
+                                                  order_id=detected_order_id(fields, dedup_key))
+                try:
+                    response = get_http_session().post(callback_url, data=json.dumps(payment_data), timeout=DELIVERY_TIMEOUT)
+                    if response.status_code == 200:
+                        delivered += 1
+                except requests.exceptions.RequestException as e:
+                    logger.warning(f"回放投递失败: {e}")
+                timed("delivery", start)
+    finally:
+        elapsed = time.perf_counter() - started
+        if server is not None:
+            server.shutdown()
+
+    report_stages = {}
+    for stage, samples in stages.items():
+        samples.sort()
+        report_stages[stage] = {"count": len(samples), "p50_ms": _percentile(samples, 0.5), "p99_ms": _percentile(samples, 0.99)}
+    return {
+        "frames": len(names),
+        "seconds": elapsed,
+        "frames_per_second": len(names) / elapsed if elapsed else 0.0,
+        "stages": report_stages,
+        "payments": payments,
+        "duplicates": duplicates,
+        "delivered": delivered,
+        "labelled": labelled,
+        "labelled_cards": labelled_cards,
+        "card_count_accuracy": correct_card_counts / labelled if labelled else 0.0,
+        "accuracy": {name: correct[name] / labelled_cards if labelled_cards else 0.0 for name in REPLAY_FIELDS},
+    }
+
+# --- 监控引擎 (与界面无关，GUI 和无界面模式共用) ---
+class MonitorEngine:
+    """
+    监控引擎：采集调度、OCR 线程池、解析去重和回调投递都在这里，不依赖 tkinter。
+    界面通过 add_listener 注册的 listener(event, data) 观察引擎，事件包括:
+      "log"      data 为日志消息 (已写入 logger)
+      "payment"  data 为投递成功的 payment_data
+      "status"   data 为 status() 返回的统计字典
+      "stopped"  data 为 None，监控线程已退出
+    listener 在引擎的工作线程中被调用，GUI 需要自行切回主线程。
+    """
+    def __init__(self, regions=None, outbox_path=OUTBOX_DB_PATH, batch_mode=DELIVERY_BATCH_MODE, record_dir=None):
+        # 监控区域列表 (每个区域有独立的帧变化检测状态)
+        self.regions = list(regions or [])
+        self._listeners = []
+
+        # 录制模式：保存识别过的帧，供 --replay 离线回放
+        self.recorder = FrameRecorder(record_dir) if record_dir else None
+
+        # OCR 引擎池 (在开始监控时创建并预热，之后复用)，工作线程从池中借用引擎
+        self.ocr_engines = []
+        self._engine_pool = queue.Queue()
+
+        # 回调发件箱与投递线程：引擎创建即开始投递上次未送达的通知
+        self.outbox = PaymentOutbox(outbox_path)
+        self.delivery_worker = DeliveryWorker(self.outbox, on_delivered=self._on_payment_delivered, batch_mode=batch_mode)
+        self.delivery_worker.start()
+        delivery_backlog_gauge.set_function(self.outbox.pending_count)
+
+        # 自适应轮询 (开始监控时按最短/最长间隔重新创建)
+        self.poll_scheduler = AdaptivePollScheduler()
+
+        # 帧计数 (跳过的帧 / 实际执行OCR的帧)
+        self.frames_skipped = 0
+        self.frames_ocr = 0
+
+        self.running = False
+        self._thread = None
+
+    # --- 观察者 ---
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _emit(self, event, data=None):
+        for listener in list(self._listeners):
+            try:
+                listener(event, data)
+            except Exception as e:
+                logger.error(f"监控事件 {event} 的处理函数出错: {e}", exc_info=True)
+
+    def log(self, message):
+        """记录日志并通知界面"""
+        logger.info(message)
+        self._emit("log", message)
+
+    def status(self):
+        return {
+            "running": self.running,
+            "interval": self.poll_scheduler.interval,
+            "frames_ocr": self.frames_ocr,
+            "frames_skipped": self.frames_skipped,
+            "pending_deliveries": self.outbox.pending_count(),
+        }
+
+    # --- 区域管理 (仅在未运行时修改) ---
+    def add_region(self, region):
+        if self.running:
+            raise RuntimeError("监控正在进行中，请先停止监控再修改区域。")
+        if any(r.name == region.name for r in self.regions):
+            raise ValueError(f"账户名称 '{region.name}' 已存在。")
+        self.regions.append(region)
+        self.log(f"已添加监控区域 {region}")
+
+    def remove_region(self, index):
+        if self.running:
+            raise RuntimeError("监控正在进行中，请先停止监控再修改区域。")
+        region = self.regions.pop(index)
+        self.log(f"已删除监控区域 {region}")
+        return region
+
+    @property
+    def batch_mode(self):
+        return self.delivery_worker.batch_mode
+
+    @batch_mode.setter
+    def batch_mode(self, enabled):
+        """切换批量投递模式，下一轮投递生效"""
+        self.delivery_worker.batch_mode = bool(enabled)
+        self.log(f"批量投递已{'开启' if self.delivery_worker.batch_mode else '关闭'}")
+
+    # --- 启动 / 停止 ---
+    def _ensure_ocr_engines(self, count):
+        """确保引擎池中至少有 count 个已预热的 OCR 引擎"""
+        while len(self.ocr_engines) < count:
+            engine = create_ocr_engine()
+            engine.warm_up()
+            self.ocr_engines.append(engine)
+            self._engine_pool.put(engine)
+
+    def start(self, callback_url, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL):
+        """
+        预热 OCR 引擎并启动监控线程。
+        参数无效时抛出 ValueError，OCR 引擎初始化失败时原样抛出异常，此时引擎保持停止状态。
+        """
+        if self.running:
+            raise RuntimeError("监控已在运行。")
+        if not self.regions:
+            raise ValueError("没有可监控的区域。")
+        if not callback_url:
+            raise ValueError("请输入有效的回调URL。")
+        self.poll_scheduler = AdaptivePollScheduler(min_interval, max_interval)
+
+        # 创建并预热OCR引擎，避免第一笔收款时才加载语言数据
+        needed_engines = min(OCR_WORKERS, len(self.regions))
+        if len(self.ocr_engines) < needed_engines:
+            self._ensure_ocr_engines(needed_engines)
+            self.log(f"OCR 引擎已就绪: {self.ocr_engines[0].name} x {len(self.ocr_engines)}")
+
+        # 重置帧变化检测，保证每个区域的第一帧一定会执行OCR
+        for region in self.regions:
+            self.log(f"已选择监控区域 {region}")
+            region.reset()
+            region.future = None
+        self.frames_skipped = 0
+        self.frames_ocr = 0
+
+        self.running = True
+        self._thread = threading.Thread(target=self._run_loop, args=(callback_url,), name="monitor", daemon=True)
+        self._thread.start()
+
+    def request_stop(self):
+        """通知监控线程在本轮结束后退出 (不等待，可在信号处理函数中调用)"""
+        self.running = False
+
+    def stop(self, timeout=5):
+        """停止监控并等待监控线程结束"""
+        self.running = False
+        if self._thread and self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout=timeout)
+
+    def close(self, timeout=2):
+        """停止监控并释放 OCR 引擎、投递线程和发件箱"""
+        self.stop(timeout=timeout)
+        for engine in self.ocr_engines:
+            engine.close()
+        self.delivery_worker.stop(timeout=timeout)
+        self.outbox.close()
+
+    def wait(self, poll=0.5):
+        """阻塞直到监控线程结束 (短间隔轮询，Ctrl+C 可以打断)"""
+        while self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout=poll)
+
+    # --- 监控循环 ---
+    def _run_loop(self, callback_url):
+        """
+        核心监控循环 (采集调度器)，在独立线程中运行。
+        依次截取每个监控区域，画面有变化时把图像提交给 OCR 线程池识别。
+        每个区域同一时刻最多只有一帧在识别，因此排队任务数不会超过区域数。
+        """
+        self.log(f"监控线程循环开始。区域数: {len(self.regions)}，OCR 线程数: {len(self.ocr_engines)}")
+        sct = None
+        executor = ThreadPoolExecutor(max_workers=len(self.ocr_engines), thread_name_prefix="ocr")
+        try:
+            # mss 实例在整个监控线程中复用，不再每帧重新创建
+            sct = mss.mss()
+            while self.running:
+                any_changed = False
+                for region in self.regions:
+                    if region.future is not None and not region.future.done():
+                        any_changed = True # 变化的帧还在识别中，不能因为本轮没有采集就放慢轮询
+                        continue # 该区域上一帧还在识别中，本轮不再采集
+                    try:
+                        # 1. 截图指定区域 (使用 mss)
+                        start = time.perf_counter()
+                        screenshot = sct.grab(region.monitor)
+
+                        # 画面没有变化时直接跳过OCR
+                        if not region.detector.has_changed(screenshot.raw, screenshot.width, screenshot.height):
+                            capture_latency.observe(time.perf_counter() - start)
+                            frames_counter.inc(label_value="skipped")
+                            self.frames_skipped += 1
+                            continue
+                        self.frames_ocr += 1
+                        any_changed = True
+
+                        # 将 mss 截图直接转换为 PIL Image (无 PNG 编解码)，交给线程池识别
+                        img = screenshot_to_image(screenshot)
+                        capture_latency.observe(time.perf_counter() - start)
+                        frames_counter.inc(label_value="ocr")
+                        region.future = executor.submit(self._process_region_frame, region, img, callback_url)
+
+                    except Exception as e:
+                         logger.error(f"采集区域 [{region.name}] 时发生错误: {e}", exc_info=True)
+                         region.reset()
+
+                # 有变化 (或变化的帧仍在识别) 时快速轮询，静止时逐步放慢
+                if any_changed:
+                    self.poll_scheduler.on_activity()
+                else:
+                    self.poll_scheduler.on_idle()
+                self._emit("status", self.status())
+                time.sleep(self.poll_scheduler.interval)
+
+        except Exception as e:
+             logger.critical(f"监控线程发生未处理的异常: {e}", exc_info=True)
+        finally:
+            executor.shutdown(wait=True)
+            if sct is not None:
+                sct.close()
+            self.running = False # 确保标志位被清除
+            self.log(f"监控线程循环结束。共执行OCR {self.frames_ocr} 帧，跳过未变化帧 {self.frames_skipped} 帧。")
+            self._emit("stopped")
+
+    def _process_region_frame(self, region, img, callback_url):
+        """在 OCR 线程池中运行：识别一帧、提取收款信息并发送回调"""
+        engine = self._engine_pool.get() # 每个工作线程独占一个引擎
+        try:
+            # 2. 执行OCR识别 (使用开始监控时预热好的引擎，启用 ROI 时只识别收款卡片)
+            start = time.perf_counter()
+            recognition = recognise_frame(engine, img, region.scroll)
+            ocr_latency.observe(time.perf_counter() - start)
+            for name, seconds in recognition.timings.items():
+                ocr_pass_latency.observe(seconds, label_value=name)
+            ocr_text = recognition.text
+        except Exception as e:
+            logger.error(f"区域 [{region.name}] OCR 识别失败: {e}", exc_info=True)
+            region.reset() # 出错的帧下次重新识别
+            return
+        finally:
+            self._engine_pool.put(engine)
+
+        try:
+            logger.debug("[%s] OCR识别结果:\n%s", region.name, ocr_text)
+
+            # 3. 处理OCR结果：一帧中可能有多张收款卡片 (两次轮询之间连续到账)，逐张提取
+            start = time.perf_counter()
+            cards = parse_recognition(recognition)
+            parse_latency.observe(time.perf_counter() - start)
+
+            if self.recorder is not None:
+                try:
+                    self.recorder.record(region.name, img, ocr_text, [fields for _, fields in cards])
+                except OSError as e:
+                    logger.warning(f"录制帧失败: {e}")
+
+            new_payments = 0
+            for card_text, fields in cards:
+                # 去重：按规范化后的金额 + 时间 + 备注判断是否已经上报过
+                logger.debug("[DEBUG] 提取结果: %s", fields)
+                dedup_key = fields_dedup_key(fields, account=region.name)
+                if not payment_dedup.add_if_absent(("detected", dedup_key), ttl=detected_dedup_ttl(fields)):
+                    duplicates_counter.inc(label_value="detected")
+                    logger.debug("检测到已上报过的收款 (%s)，跳过。", dedup_key)
+                    continue # 跳过重复的卡片
+
+                payment_data = build_payment_data(fields, card_text, account=region.name, region=region.coords_str(),
+                                                  order_id=detected_order_id(fields, dedup_key))
+                logger.debug("[DEBUG] 最终构造的 payment_data: %s", payment_data)
+
+                # 4. 写入发件箱，由投递线程负责发送和重试 (回调变慢或宕机都不会阻塞采集)
+                try:
+                    self.outbox.enqueue(callback_url, payment_data)
+                except Exception:
+                    payment_dedup.discard(("detected", dedup_key)) # 未能持久化，允许下次重新识别
+                    raise
+                new_payments += 1
+                logger.info(f"区域 [{region.name}] 识别到收款 {payment_data['amount']}，已写入发件箱。")
+
+            if new_payments:
+                self.delivery_worker.wake()
+                # 收款后通常会有连续的通知，回到快速轮询
+                self.poll_scheduler.on_activity()
+        except Exception as e:
+            logger.error(f"处理区域 [{region.name}] 的识别结果时发生错误: {e}", exc_info=True)
+            region.reset() # 出错的帧下次重新识别
+
+    def _on_payment_delivered(self, payment_data):
+        """投递线程成功发送通知后通知观察者"""
+        self._emit("payment", payment_data)
+
+# --- GUI 类定义 ---
+# tkinter 只在打开界面时导入 (见 _import_tkinter)，无界面模式和 API 进程在没有 tkinter 的环境中也能运行
+tk = messagebox = scrolledtext = None
+
+def _import_tkinter():
+    """导入 tkinter 并设置模块级的 tk / messagebox / scrolledtext，缺少 tkinter 时抛出 ImportError"""
+    global tk, messagebox, scrolledtext
+    import tkinter
+    from tkinter import messagebox as tk_messagebox, scrolledtext as tk_scrolledtext
+    tk, messagebox, scrolledtext = tkinter, tk_messagebox, tk_scrolledtext
+
+class NotificationWindow:
+    def __init__(self, record_dir=None):
+        _import_tkinter()
+        self.root = tk.Tk()
+        self.root.title("Dty 微信收款OCR监听器")
+        self.root.geometry("550x800") # 增加高度以容纳调试功能区域
 
         # --- GUI元素 ---
         # 状态标签
-        self.status_label = tk.Label(self, text="状态: 未运行", fg="red")
+        self.status_label = tk.Label(self.root, text="状态: 未运行", fg="red")
         self.status_label.pack(pady=10)
 
         # 区域坐标输入框
-        coord_frame = tk.Frame(self)
+        coord_frame = tk.Frame(self.root)
         coord_frame.pack(pady=5)
         tk.Label(coord_frame, text="监控区域 (左,顶,宽,高):").pack(side=tk.LEFT)
         self.coord_entry = tk.Entry(coord_frame, width=30)
@@ -71,16 +2208,46 @@ class NotificationWindow(tk.Tk):
         self.select_button = tk.Button(coord_frame, text="选择区域", command=self.select_region)
         self.select_button.pack(side=tk.LEFT, padx=5)
 
+        # 多区域列表 (每个区域对应一个收款账户)
+        region_list_frame = tk.Frame(self.root)
+        region_list_frame.pack(pady=5)
+        tk.Label(region_list_frame, text="账户名称:").pack(side=tk.LEFT)
+        self.region_name_entry = tk.Entry(region_list_frame, width=12)
+        self.region_name_entry.insert(0, "默认")
+        self.region_name_entry.pack(side=tk.LEFT, padx=5)
+        self.add_region_button = tk.Button(region_list_frame, text="添加区域", command=self.add_region)
+        self.add_region_button.pack(side=tk.LEFT, padx=5)
+        self.remove_region_button = tk.Button(region_list_frame, text="删除选中", command=self.remove_region)
+        self.remove_region_button.pack(side=tk.LEFT, padx=5)
+        self.region_listbox = tk.Listbox(self.root, height=4, width=60)
+        self.region_listbox.pack(pady=2)
+        tk.Label(self.root, text="(区域列表为空时监控上方输入框中的单个区域)", fg="gray").pack()
+
         # 回调URL输入框
-        url_frame = tk.Frame(self)
+        url_frame = tk.Frame(self.root)
         url_frame.pack(pady=5)
         tk.Label(url_frame, text="回调URL:").pack(side=tk.LEFT)
         self.url_entry = tk.Entry(url_frame, width=40)
         self.url_entry.insert(0, DEFAULT_CALLBACK_URL)
         self.url_entry.pack(side=tk.LEFT, padx=5)
 
+        # 轮询间隔输入框
+        interval_frame = tk.Frame(self.root)
+        interval_frame.pack(pady=5)
+        tk.Label(interval_frame, text="轮询间隔(秒) 最短:").pack(side=tk.LEFT)
+        self.min_interval_entry = tk.Entry(interval_frame, width=6)
+        self.min_interval_entry.insert(0, str(POLL_MIN_INTERVAL))
+        self.min_interval_entry.pack(side=tk.LEFT, padx=5)
+        tk.Label(interval_frame, text="最长:").pack(side=tk.LEFT)
+        self.max_interval_entry = tk.Entry(interval_frame, width=6)
+        self.max_interval_entry.insert(0, str(POLL_MAX_INTERVAL))
+        self.max_interval_entry.pack(side=tk.LEFT, padx=5)
+        self.batch_mode_var = tk.BooleanVar(value=DELIVERY_BATCH_MODE)
+        tk.Checkbutton(interval_frame, text="批量投递", variable=self.batch_mode_var,
+                       command=self._on_batch_mode_changed).pack(side=tk.LEFT, padx=5)
+
         # 控制按钮
-        button_frame = tk.Frame(self)
+        button_frame = tk.Frame(self.root)
         button_frame.pack(pady=10)
         self.start_button = tk.Button(button_frame, text="开始监控", command=self.start_monitoring)
         self.start_button.pack(side=tk.LEFT, padx=10)
@@ -88,14 +2255,14 @@ class NotificationWindow(tk.Tk):
         self.stop_button.pack(side=tk.LEFT, padx=10)
 
         # --- 日志显示区域 ---
-        log_frame = tk.Frame(self)
+        log_frame = tk.Frame(self.root)
         log_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
         tk.Label(log_frame, text="日志:").pack(anchor=tk.W)
         self.log_text = scrolledtext.ScrolledText(log_frame, height=10, state=tk.DISABLED)
         self.log_text.pack(fill=tk.BOTH, expand=True)
 
         # --- 新增：收款记录显示区域 ---
-        payments_frame = tk.LabelFrame(self, text="收款记录", padx=5, pady=5)
+        payments_frame = tk.LabelFrame(self.root, text="收款记录", padx=5, pady=5)
         payments_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
 
         self.payments_text = scrolledtext.ScrolledText(payments_frame, height=8, state=tk.DISABLED)
@@ -103,7 +2270,7 @@ class NotificationWindow(tk.Tk):
         # --- 新增代码结束 ---
 
         # --- 新增：调试功能区域 ---
-        debug_frame = tk.LabelFrame(self, text="调试功能 - 手动发送测试数据", padx=5, pady=5)
+        debug_frame = tk.LabelFrame(self.root, text="调试功能 - 手动发送测试数据", padx=5, pady=5)
         debug_frame.pack(fill=tk.X, padx=10, pady=5)
 
         # 金额输入
@@ -150,35 +2317,103 @@ class NotificationWindow(tk.Tk):
         # --- 调试功能区域结束 ---
 
         # --- 状态变量 ---
-        self.monitoring_thread = None
-        self.is_monitoring = False
         self.region_selected = False
         self.selected_region = None
 
-        # 用于简单去重的变量
-        self.last_processed_hash = None
+        # 界面事件队列: 任意线程都可以放入，主线程定时批量取出
+        self._ui_events = queue.SimpleQueue()
+        self._ui_refresh_job = self.root.after(UI_REFRESH_MS, self._drain_ui_events)
+
+        # 监控引擎负责采集、识别和投递，窗口只是它的观察者
+        self.engine = MonitorEngine(regions=[MonitorRegion.from_config(cfg) for cfg in MONITOR_REGIONS], record_dir=record_dir)
+        self.engine.add_listener(self._on_engine_event)
+        for region in self.engine.regions:
+            self.region_listbox.insert(tk.END, str(region))
+
+    @property
+    def is_monitoring(self):
+        return self.engine.running
+
+    def _on_engine_event(self, event, data):
+        """引擎事件在工作线程中触发，放入界面事件队列，由主线程批量处理"""
+        if event == "log":
+            self._ui_events.put(("log", self._format_log_line(data))) # 引擎已写入 logger
+        elif event == "payment":
+            self._on_payment_delivered(data)
+        elif event == "status":
+            self._ui_events.put(("status", data))
+        elif event == "stopped":
+            self._ui_events.put(("call", (self._on_monitoring_stopped_in_main_thread, ())))
+
+    # --- 界面事件队列 ---
+    def call_in_ui(self, func, *args):
+        """在主线程中执行 func(*args)，可从任意线程调用"""
+        self._ui_events.put(("call", (func, args)))
+
+    def _drain_ui_events(self):
+        """定时在主线程中取出所有待处理的界面事件，合并后一次性更新控件"""
+        log_lines, payment_lines, calls = [], [], []
+        status = None
+        try:
+            while True:
+                kind, payload = self._ui_events.get_nowait()
+                if kind == "log":
+                    log_lines.append(payload)
+                elif kind == "payment":
+                    payment_lines.append(payload)
+                elif kind == "status":
+                    status = payload # 只需要最新的状态
+                else:
+                    calls.append(payload)
+        except queue.Empty:
+            pass
 
-    def log_message(self, message):
-        """在GUI日志区域和Python日志系统中同时记录消息"""
+        try:
+            if log_lines:
+                self._append_lines(self.log_text, log_lines, UI_LOG_MAX_LINES)
+            if payment_lines:
+                self._append_lines(self.payments_text, payment_lines, UI_PAYMENT_MAX_LINES)
+            if status is not None:
+                self._update_monitor_status(status)
+            for func, args in calls:
+                func(*args)
+        except Exception as e:
+            logger.error(f"更新界面时发生错误: {e}", exc_info=True)
+        finally:
+            self._ui_refresh_job = self.root.after(UI_REFRESH_MS, self._drain_ui_events)
+
+    @staticmethod
+    def _append_lines(widget, lines, max_lines):
+        """把多行文本一次性追加到 ScrolledText，只保留最后 max_lines 行"""
+        lines = lines[-max_lines:]
+        widget.config(state=tk.NORMAL)
+        widget.insert(tk.END, "\n".join(lines) + "\n")
+        line_count = int(widget.index("end-1c").split(".")[0]) - 1 # 末尾换行后有一个空行
+        if line_count > max_lines:
+            widget.delete("1.0", f"{line_count - max_lines + 1}.0")
+        widget.see(tk.END) # 自动滚动到底部
+        widget.config(state=tk.DISABLED)
+
+    @staticmethod
+    def _format_log_line(message):
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        formatted_message = f"[{timestamp}] {message}"
+        return f"[{timestamp}] {message}"
 
-        # 更新GUI日志
-        self.log_text.config(state=tk.NORMAL)
-        self.log_text.insert(tk.END, formatted_message + "\n")
-        self.log_text.see(tk.END) # 自动滚动到底部
-        self.log_text.config(state=tk.DISABLED)
+    def log_message(self, message):
+        """在GUI日志区域和Python日志系统中同时记录消息 (可从任意线程调用)"""
+        self._ui_events.put(("log", self._format_log_line(message)))
 
         # 记录到Python日志
         logger.info(message)
 
     # --- 更新代码：增强收款记录显示，明确区分备注 ---
-    def add_payment_record(self, amount, payer_memo, timestamp):
+    def add_payment_record(self, amount, payer_memo, timestamp, account=None):
         """
-        在GUI的收款记录区域添加一条新记录。
+        在GUI的收款记录区域添加一条新记录 (可从任意线程调用)。
         :param amount: 金额 (字符串)
         :param payer_memo: 付款方备注/时间等信息 (字符串)
         :param timestamp: Unix时间戳 (整数)
+        :param account: 收款账户 (监控区域名称，可选)
         """
         try:
             # 将时间戳转换为可读格式
@@ -191,18 +2426,21 @@ class NotificationWindow(tk.Tk):
         # 清晰地标记出金额、时间和备注
         # 示例: [2023-10-27 10:30:00] 收到 ¥10.00 | 备注: 测试付款
         record = f"[{readable_time}] 收到 ¥{amount} | 备注: {payer_memo}"
+        if account:
+            record = f"[{account}] {record}"
 
-        # 安全地更新GUI (在主线程中)
-        def update_gui():
-            self.payments_text.config(state=tk.NORMAL)
-            self.payments_text.insert(tk.END, record + "\n")
-            self.payments_text.see(tk.END) # 自动滚动到底部
-            self.payments_text.config(state=tk.DISABLED)
-
-        # 使用 after 确保线程安全
-        self.after(0, update_gui)
+        # 由主线程在下一次刷新时批量写入
+        self._ui_events.put(("payment", record))
     # --- 更新代码结束 ---
 
+    def set_selected_region(self, region):
+        """鼠标选择区域完成后 (在主线程中) 更新坐标输入框"""
+        self.selected_region = region
+        self.coord_entry.delete(0, tk.END)
+        self.coord_entry.insert(0, f"{region['left']},{region['top']},{region['width']},{region['height']}")
+        self.log_message(f"已选择监控区域: {region}")
+        self.region_selected = True
+
     def select_region(self):
         """启动鼠标监听以选择监控区域"""
         if self.is_monitoring:
@@ -217,36 +2455,83 @@ class NotificationWindow(tk.Tk):
         self.mouse_listener = MouseRegionSelector(self)
         self.mouse_listener.start_listening() # 启动监听
 
+    def add_region(self):
+        """把坐标输入框中的区域加入监控区域列表"""
+        if self.is_monitoring:
+            messagebox.showwarning("警告", "监控正在进行中，请先停止监控再修改区域。")
+            return
+        try:
+            left, top, width, height = map(int, self.coord_entry.get().split(','))
+        except ValueError:
+            messagebox.showerror("错误", "区域坐标格式无效，请输入 '左,顶,宽,高' 的整数形式。")
+            return
+        name = self.region_name_entry.get().strip() or f"区域{len(self.engine.regions) + 1}"
+        region = MonitorRegion(name, left, top, width, height)
+        try:
+            self.engine.add_region(region)
+        except ValueError as e:
+            messagebox.showerror("错误", str(e))
+            return
+        self.region_listbox.insert(tk.END, str(region))
+
+    def remove_region(self):
+        """从监控区域列表中删除选中的区域"""
+        if self.is_monitoring:
+            messagebox.showwarning("警告", "监控正在进行中，请先停止监控再修改区域。")
+            return
+        for index in reversed(self.region_listbox.curselection()):
+            self.engine.remove_region(index)
+            self.region_listbox.delete(index)
+
     def start_monitoring(self):
-        """启动监控线程"""
+        """启动监控引擎"""
         if self.is_monitoring:
              messagebox.showinfo("信息", "监控已在运行。")
              return
 
         coords_str = self.coord_entry.get()
         try:
-            left, top, width, height = map(int, coords_str.split(','))
-            self.selected_region = {"left": left, "top": top, "width": width, "height": height}
-            self.log_message(f"已选择监控区域: {self.selected_region}")
-
-            # 获取回调URL
-            callback_url = self.url_entry.get().strip()
-            if not callback_url:
-                 messagebox.showerror("错误", "请输入有效的回调URL。")
-                 return
-
-            # 更新UI状态
-            self.start_button.config(state=tk.DISABLED)
-            self.stop_button.config(state=tk.NORMAL)
-            self.status_label.config(text="状态: 监控中...", fg="green")
-
-            # 启动监控线程
-            self.is_monitoring = True
-            self.monitoring_thread = threading.Thread(target=self.run_monitoring_loop, args=(callback_url,), daemon=True)
-            self.monitoring_thread.start()
-
+            # 区域列表为空时，兼容原来的单区域用法
+            if not self.engine.regions:
+                left, top, width, height = map(int, coords_str.split(','))
+                self.selected_region = {"left": left, "top": top, "width": width, "height": height}
+                region = MonitorRegion(self.region_name_entry.get().strip() or "默认", left, top, width, height)
+                self.engine.add_region(region)
+                self.region_listbox.insert(tk.END, str(region))
         except ValueError:
             messagebox.showerror("错误", "区域坐标格式无效，请输入 '左,顶,宽,高' 的整数形式。")
+            return
+
+        # 获取回调URL
+        callback_url = self.url_entry.get().strip()
+        if not callback_url:
+             messagebox.showerror("错误", "请输入有效的回调URL。")
+             return
+
+        # 轮询间隔
+        try:
+            min_interval = float(self.min_interval_entry.get())
+            max_interval = float(self.max_interval_entry.get())
+            AdaptivePollScheduler(min_interval, max_interval)
+        except ValueError:
+            messagebox.showerror("错误", "轮询间隔无效，请输入满足 0 < 最短 <= 最长 的数字。")
+            return
+
+        # 启动时会同步预热OCR引擎，避免第一笔收款时才加载语言数据
+        self.status_label.config(text="状态: 正在初始化OCR引擎...", fg="orange")
+        self.root.update_idletasks()
+        try:
+            self.engine.start(callback_url, min_interval, max_interval)
+        except Exception as e:
+            logger.error(f"启动监控失败: {e}", exc_info=True)
+            self.status_label.config(text="状态: 未运行", fg="red")
+            messagebox.showerror("错误", f"启动监控失败:\n{e}")
+            return
+
+        # 更新UI状态
+        self.start_button.config(state=tk.DISABLED)
+        self.stop_button.config(state=tk.NORMAL)
+        self.status_label.config(text="状态: 监控中...", fg="green")
 
     def stop_monitoring(self):
         """停止监控"""
@@ -255,11 +2540,7 @@ class NotificationWindow(tk.Tk):
              return
 
         self.log_message("正在停止监控...")
-        self.is_monitoring = False
-
-        # 等待监控线程结束
-        if self.monitoring_thread and self.monitoring_thread.is_alive():
-            self.monitoring_thread.join(timeout=5) # 等待最多5秒
+        self.engine.stop(timeout=5) # 等待最多5秒
 
         # 更新UI状态
         self.start_button.config(state=tk.NORMAL)
@@ -267,275 +2548,30 @@ class NotificationWindow(tk.Tk):
         self.status_label.config(text="状态: 已停止", fg="red")
         self.log_message("监控已停止。")
 
-    def run_monitoring_loop(self, callback_url):
-        """核心监控循环，在独立线程中运行"""
-        self.log_message("监控线程循环开始。")
-        try:
-            while self.is_monitoring:
-                if self.selected_region:
-                    try:
-                        # 1. 截图指定区域 (使用 mss)
-                        with mss.mss() as sct:
-                            # mss 需要 monitor 参数，我们构建一个
-                            monitor = {
-                                "left": self.selected_region["left"],
-                                "top": self.selected_region["top"],
-                                "width": self.selected_region["width"],
-                                "height": self.selected_region["height"]
-                            }
-
-                            # 截图
-                            screenshot = sct.grab(monitor)
-
-                            # 将 mss 截图转换为 PIL Image
-                            img_buffer = io.BytesIO(mss.tools.to_png(screenshot.rgb, screenshot.size))
-                            img = Image.open(img_buffer)
-
-                        # 2. 执行OCR识别
-                        # 使用 BytesIO 将图像传递给 tesseract，避免临时文件
-                        custom_config = f'--oem 3 --psm 6 -l {OCR_LANG}'
-
-                        # pytesseract.image_to_string 可以直接接受 PIL Image
-                        ocr_text = pytesseract.image_to_string(img, config=custom_config)
-
-                        logger.debug(f"OCR识别结果:\n{ocr_text}")
-
-                        # 3. 处理OCR结果
-                        # 移除OCR文本中的所有空格和换行符，以便更鲁棒地匹配关键词
-                        ocr_text_no_spaces = ocr_text.replace(' ', '').replace('\n', '').replace('\r', '')
-                        logger.debug(f"处理后的OCR文本 (无空格/换行): {ocr_text_no_spaces}")
-
-                        # 假设微信通知包含 "收款成功" (即使OCR加了空格，移除后也能匹配)
-                        if "收款成功" in ocr_text_no_spaces:
-
-                            # 简单去重机制：计算当前OCR文本的哈希值
-                            current_text_hash = hashlib.md5(ocr_text.strip().encode('utf-8')).hexdigest()
-                            if current_text_hash == self.last_processed_hash:
-                                logger.debug("检测到相同内容，可能是重复通知，跳过。")
-                                time.sleep(2) # 即使跳过也短暂等待
-                                continue # 跳过重复内容
-
-                            # --- 强制调试版金额和时间提取 ---
-                            logger.debug(f"[DEBUG] 开始提取金额和时间...")
-                            logger.debug(f"[DEBUG] 原始OCR文本: '{repr(ocr_text)}'") # repr 显示 \n 等
-                            ocr_text_normalized_for_debug = ocr_text.replace('\n', ' ').replace('\r', ' ')
-                            logger.debug(f"[DEBUG] 标准化后文本 (用于提取): '{ocr_text_normalized_for_debug}'")
-
-                            # --- 提取金额 (基于关键词定位法, 适配OCR空格) ---
-                            amount = "未知"
-                            try:
-                                # 1. 定义两种可能的关键词形式：紧密型 和 OCR空格型
-                                keywords_to_try = ["收款金额", "收 款 金 额"] # 添加带空格的版本
-
-                                keyword_found_index = -1
-                                found_keyword = ""
-                                for keyword in keywords_to_try:
-                                    keyword_index = ocr_text_normalized_for_debug.find(keyword)
-                                    if keyword_index != -1:
-                                        keyword_found_index = keyword_index
-                                        found_keyword = keyword
-                                        break # 找到一个就停止
-
-                                if keyword_found_index != -1:
-                                    logger.debug(f"[DEBUG] 找到关键词: '{found_keyword}'")
-                                    # 2. 找到关键词后，从此位置之后截取一段文本用于搜索数字
-                                    #    例如，截取关键词后 20 个字符
-                                    start_search_index = keyword_found_index + len(found_keyword)
-                                    text_after_keyword = ocr_text_normalized_for_debug[start_search_index : start_search_index + 20]
-                                    logger.debug(f"[DEBUG] 关键词'{found_keyword}'之后的文本片段: '{text_after_keyword}'")
-
-                                    # 3. 在截取的片段中寻找最常见的金额格式 (例如 0.01, 100.00)
-                                    #    这个正则比较宽松，只找数字和小数点
-                                    amount_in_fragment_match = re.search(r'(\d+(?:\.\d{2})?)', text_after_keyword)
-                                    if amount_in_fragment_match:
-                                        amount = amount_in_fragment_match.group(1)
-                                        logger.debug(f"[DEBUG] 通过关键词定位法提取到金额: {amount}")
-                                    else:
-                                        logger.debug(f"[DEBUG] 在关键词后的片段中未找到标准金额格式。")
-                                else:
-                                    logger.debug(f"[DEBUG] 未在标准化文本中找到任何关键词 {keywords_to_try}。")
-                            except Exception as e:
-                                logger.error(f"[ERROR] 在基于关键词提取金额时发生异常: {e}")
-
-
-                            # 如果关键词法失败，可以考虑回退到旧的符号匹配法（可选）
-                            # if amount == "未知":
-                            #     # ... (这里粘贴之前的符号匹配代码逻辑) ...
-
-                            # --- 提取时间 (修复变量未定义问题) ---
-                            timestamp_str = "未知时间" # <--- 关键：提前定义并初始化默认值
-                            try:
-                                # 定义可能的时间关键词
-                                time_keywords_to_try = ["收款时间", "收 款 时 间", "到账时间", "到 账 时 间"]
-                                
-                                time_found = False
-                                for keyword in time_keywords_to_try:
-                                    keyword_index = ocr_text_normalized_for_debug.find(keyword)
-                                    if keyword_index != -1:
-                                        # 找到关键词，从此处往后截取一段文本
-                                        start_index = keyword_index + len(keyword)
-                                        # 截取接下来的 25 个字符用于时间匹配
-                                        text_after_keyword = ocr_text_normalized_for_debug[start_index : start_index + 25]
-                                        logger.debug(f"[DEBUG] 时间关键词'{keyword}'之后的文本片段: '{text_after_keyword}'")
-                                        
-                                        # 尝试匹配常见的时间格式
-                                        # 格式1: 2025-12-30 18:47:40 或 2025/12/30 18:47:40
-                                        time_match = re.search(r'(\d{4}[-/]\d{1,2}[-/]\d{1,2}\s*\d{1,2}:\d{2}(?::\d{2})?)', text_after_keyword)
-                                        if time_match:
-                                            timestamp_str = time_match.group(1).strip()
-                                            time_found = True
-                                            logger.debug(f"[DEBUG] 通过关键词定位法提取到时间: {timestamp_str}")
-                                            break
-                                        
-                                        # 格式2: 18:47:40 或 18:47 (仅时间)
-                                        time_match = re.search(r'(\d{1,2}:\d{2}(?::\d{2})?)', text_after_keyword)
-                                        if time_match:
-                                            timestamp_str = time_match.group(1).strip()
-                                            time_found = True
-                                            logger.debug(f"[DEBUG] 通过关键词定位法提取到时间(仅时分秒): {timestamp_str}")
-                                            break
-                                
-                                # 如果关键词法失败，尝试在整个文本中搜索时间格式
-                                if not time_found:
-                                    logger.debug("[DEBUG] 未通过关键词找到时间，尝试全文搜索时间格式...")
-                                    # 尝试匹配完整日期时间格式
-                                    time_match = re.search(r'(\d{4}[-/]\d{1,2}[-/]\d{1,2}\s*\d{1,2}:\d{2}(?::\d{2})?)', ocr_text_normalized_for_debug)
-                                    if time_match:
-                                        timestamp_str = time_match.group(1).strip()
-                                        logger.debug(f"[DEBUG] 全文搜索提取到时间: {timestamp_str}")
-                                    else:
-                                        # 尝试匹配仅时间格式
-                                        time_match = re.search(r'(\d{1,2}:\d{2}:\d{2})', ocr_text_normalized_for_debug)
-                                        if time_match:
-                                            timestamp_str = time_match.group(1).strip()
-                                            logger.debug(f"[DEBUG] 全文搜索提取到时间(仅时分秒): {timestamp_str}")
-                                        else:
-                                            logger.debug("[DEBUG] 未能从OCR文本中提取到时间信息。")
-                            except Exception as e:
-                                logger.error(f"[ERROR] 在提取时间时发生异常: {e}")
-
-                            # --- 新增：提取用户备注 ---
-                            user_memo = "无备注"
-                            try:
-                                # 定义可能的备注关键词 (根据微信实际显示调整)
-                                memo_keywords_to_try = ["付款方备注", "转账备注", "付 款 方 备 注"]
-
-                                # 在标准化后的文本中查找
-                                normalized_ocr_for_memo = ocr_text_normalized_for_debug # 使用前面定义的变量
-
-                                memo_found = False
-                                for keyword in memo_keywords_to_try:
-                                    keyword_index = normalized_ocr_for_memo.find(keyword)
-                                    if keyword_index != -1:
-                                        # 找到关键词，从此处往后截取一段文本
-                                        start_index = keyword_index + len(keyword)
-                                        # 假设备注不会太长，比如截取接下来的 30 个字符
-                                        potential_memo = normalized_ocr_for_memo[start_index : start_index + 30].strip()
-
-                                        # --- 改进：更精细地清理和截断备注 ---
-                                        # 1. 去掉开头可能的冒号和空格
-                                        potential_memo = potential_memo.lstrip(':').lstrip()
-
-                                        # 2. 如果有换行，则只取第一行
-                                        potential_memo = potential_memo.split('\n')[0]
-
-                                        # 3. 【关键改进】寻找常见的终止符并截断
-                                        # 定义应在备注后停止的关键词（通常是下一个信息块的开始）
-                                        truncation_indicators = ["汇", "总", "备", "注"] # "汇总", "备注" 的首字
-
-                                        # 遍历这些指示符，找到最早出现的位置
-                                        earliest_trunc_pos = len(potential_memo) # 默认不截断
-                                        for indicator in truncation_indicators:
-                                            pos = potential_memo.find(indicator)
-                                            if pos != -1 and pos < earliest_trunc_pos:
-                                                earliest_trunc_pos = pos
-
-                                        # 执行截断
-                                        final_user_memo = potential_memo[:earliest_trunc_pos].strip()
-
-                                        # 4. 确保最终结果不为空
-                                        if final_user_memo:
-                                            user_memo = final_user_memo
-                                            memo_found = True
-                                            logger.debug(f"[DEBUG] 找到用户备注关键词 '{keyword}', 提取并截断后备注: '{user_memo}'")
-                                            break # 找到一个就停止
-                                        # --- 改进结束 ---
-
-                                if not memo_found:
-                                    logger.debug("[DEBUG] 未在OCR文本中找到用户备注关键词。")
-
-                            except Exception as e:
-                                logger.error(f"[ERROR] 在提取用户备注时发生异常: {e}")
-
-                            # --- 构造数据 ---
-                            # 将时间和其他信息组合成 payer_memo，真正的用户备注单独存放或合并
-                            # 如果 OCR 时间提取失败，使用当前系统时间作为回退
-                            if timestamp_str == "未知时间":
-                                current_time_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                ocr_info_memo = f"[系统时间] {current_time_str}"
-                                logger.debug(f"[DEBUG] OCR时间提取失败，使用系统时间: {current_time_str}")
-                            else:
-                                ocr_info_memo = f"[OCR时间] {timestamp_str}"
-                            
-                            if user_memo != "无备注":
-                                # 可以选择只显示用户备注，或者两者都显示
-                                # 方式一：只显示用户备注
-                                # final_payer_memo = user_memo
-                                # 方式二：合并显示 (推荐)
-                                final_payer_memo = f"{ocr_info_memo} | 用户备注: {user_memo}"
-                            else:
-                                final_payer_memo = ocr_info_memo
-
-                            payment_data = {
-                                "order_id": f"ocr_detected_{int(time.time())}",
-                                "amount": amount,
-                                "payer_memo": final_payer_memo, # 使用组合后的备注
-                                "timestamp": int(time.time()),
-                                "ocr_raw_text": ocr_text,
-                                "user_memo": user_memo # 可选：单独存一份用户备注
-                            }
-                            logger.debug(f"[DEBUG] 最终构造的 payment_data: {payment_data}")
-                            # --- 强制调试版结束 ---
-
-
-                            # 4. 发送通知到回调URL
-                            try:
-                                headers = {'Content-Type': 'application/json'}
-                                response = requests.post(callback_url, data=json.dumps(payment_data), headers=headers, timeout=10)
-                                if response.status_code == 200:
-                                    logger.info(f"成功发送通知到 {callback_url}。响应: {response.status_code}")
-                                    # 更新去重哈希
-                                    self.last_processed_hash = current_text_hash
-
-                                    # --- 新增代码开始：成功发送后更新GUI收款记录 ---
-                                    # 确保 payment_data 中包含所需字段
-                                    if 'amount' in payment_data and 'payer_memo' in payment_data and 'timestamp' in payment_data:
-                                        self.add_payment_record(
-                                            payment_data['amount'],
-                                            payment_data['payer_memo'],
-                                            payment_data['timestamp']
-                                        )
-                                    else:
-                                        logger.warning("payment_data 缺少必要字段，无法添加到GUI收款记录。")
-                                    # --- 新增代码结束 ---
-
-                                else:
-                                    logger.error(f"发送通知失败。状态码: {response.status_code}, 响应: {response.text}")
-                            except requests.exceptions.RequestException as e:
-                                logger.error(f"发送请求时发生网络错误: {e}")
-
-                    except Exception as e:
-                         logger.error(f"监控循环中发生错误: {e}", exc_info=True) # exc_info=True 打印堆栈跟踪
-
-                time.sleep(2) # 每2秒检查一次
+    def _on_batch_mode_changed(self):
+        """切换批量投递模式，下一轮投递生效"""
+        self.engine.batch_mode = self.batch_mode_var.get()
+
+    def _on_payment_delivered(self, payment_data):
+        """投递线程成功发送通知后，更新GUI收款记录"""
+        # 确保 payment_data 中包含所需字段
+        if 'amount' in payment_data and 'payer_memo' in payment_data and 'timestamp' in payment_data:
+            self.add_payment_record(
+                payment_data['amount'],
+                payment_data['payer_memo'],
+                payment_data['timestamp'],
+                account=payment_data.get('account')
+            )
+        else:
+            logger.warning("payment_data 缺少必要字段，无法添加到GUI收款记录。")
 
-        except Exception as e:
-             logger.critical(f"监控线程发生未处理的异常: {e}", exc_info=True)
-        finally:
-            self.is_monitoring = False # 确保标志位被清除
-            logger.info("监控线程循环结束。")
-            # 通知主线程更新GUI (通过事件队列安全地调用)
-            self.after(0, self._on_monitoring_stopped_in_main_thread)
+    def _update_monitor_status(self, status):
+        """在状态标签中显示当前轮询间隔、OCR帧数与跳过帧数 (在主线程中调用)"""
+        if self.is_monitoring:
+            self.status_label.config(
+                text=(f"状态: 监控中... 间隔 {status['interval']:.2f}s "
+                      f"(OCR: {status['frames_ocr']} 帧 / 跳过: {status['frames_skipped']} 帧)"),
+                fg="green")
 
     def _on_monitoring_stopped_in_main_thread(self):
          """在主线程中安全地更新GUI状态"""
@@ -572,7 +2608,7 @@ class NotificationWindow(tk.Tk):
         
         # 自动生成订单ID（如果未提供）
         if not order_id:
-            order_id = f"debug_test_{int(time.time())}"
+            order_id = f"debug_test_{int(time.time())}_{uuid.uuid4().hex[:6]}"
         
         # 构建付款方备注
         current_time_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -605,30 +2641,29 @@ class NotificationWindow(tk.Tk):
         # 在后台线程中发送请求，避免阻塞GUI
         def send_request():
             try:
-                headers = {'Content-Type': 'application/json'}
-                response = requests.post(callback_url, data=json.dumps(payment_data), headers=headers, timeout=10)
+                response = get_http_session().post(callback_url, data=json.dumps(payment_data), timeout=DELIVERY_TIMEOUT)
                 
                 if response.status_code == 200:
-                    self.after(0, lambda: self.log_message(f"[调试] 测试数据发送成功! 响应: {response.status_code}"))
+                    self.log_message(f"[调试] 测试数据发送成功! 响应: {response.status_code}")
                     # 更新GUI收款记录
-                    self.after(0, lambda: self.add_payment_record(
+                    self.add_payment_record(
                         payment_data['amount'],
                         payment_data['payer_memo'],
                         payment_data['timestamp']
-                    ))
-                    self.after(0, lambda: messagebox.showinfo("成功", f"测试数据发送成功!\n\n订单ID: {order_id}\n金额: ¥{amount}\n备注: {user_memo}"))
+                    )
+                    self.call_in_ui(messagebox.showinfo, "成功", f"测试数据发送成功!\n\n订单ID: {order_id}\n金额: ¥{amount}\n备注: {user_memo}")
                 else:
-                    self.after(0, lambda: self.log_message(f"[调试] 发送失败! 状态码: {response.status_code}, 响应: {response.text}"))
-                    self.after(0, lambda: messagebox.showerror("失败", f"发送失败!\n状态码: {response.status_code}\n响应: {response.text}"))
+                    self.log_message(f"[调试] 发送失败! 状态码: {response.status_code}, 响应: {response.text}")
+                    self.call_in_ui(messagebox.showerror, "失败", f"发送失败!\n状态码: {response.status_code}\n响应: {response.text}")
             except requests.exceptions.ConnectionError:
-                self.after(0, lambda: self.log_message(f"[调试] 连接失败! 请确保API服务器正在运行"))
-                self.after(0, lambda: messagebox.showerror("连接失败", f"无法连接到 {callback_url}\n请确保API服务器正在运行"))
+                self.log_message("[调试] 连接失败! 请确保API服务器正在运行")
+                self.call_in_ui(messagebox.showerror, "连接失败", f"无法连接到 {callback_url}\n请确保API服务器正在运行")
             except requests.exceptions.Timeout:
-                self.after(0, lambda: self.log_message(f"[调试] 请求超时!"))
-                self.after(0, lambda: messagebox.showerror("超时", "请求超时，请检查网络连接"))
+                self.log_message("[调试] 请求超时!")
+                self.call_in_ui(messagebox.showerror, "超时", "请求超时，请检查网络连接")
             except Exception as e:
-                self.after(0, lambda: self.log_message(f"[调试] 发送时发生错误: {e}"))
-                self.after(0, lambda: messagebox.showerror("错误", f"发送时发生错误:\n{e}"))
+                self.log_message(f"[调试] 发送时发生错误: {e}")
+                self.call_in_ui(messagebox.showerror, "错误", f"发送时发生错误:\n{e}")
         
         # 启动后台线程发送请求
         threading.Thread(target=send_request, daemon=True).start()
@@ -651,15 +2686,12 @@ class NotificationWindow(tk.Tk):
     def on_closing(self):
         """处理窗口关闭事件"""
         if self.is_monitoring:
-            if messagebox.askokcancel("退出", "监控正在进行中，确定要退出吗？"):
-                self.is_monitoring = False
-                if self.monitoring_thread and self.monitoring_thread.is_alive():
-                    self.monitoring_thread.join(timeout=2)
-                self.destroy()
-            else:
+            if not messagebox.askokcancel("退出", "监控正在进行中，确定要退出吗？"):
                 return # 取消关闭
-        else:
-           self.destroy()
+        self.engine.remove_listener(self._on_engine_event) # 窗口销毁后不再接收事件
+        self.root.after_cancel(self._ui_refresh_job)
+        self.engine.close(timeout=2)
+        self.root.destroy()
 
 # --- 鼠标区域选择辅助类 ---
 class MouseRegionSelector:
@@ -670,6 +2702,7 @@ class MouseRegionSelector:
 
     def on_click(self, x, y, button, pressed):
         """处理鼠标点击事件"""
+        from pynput import mouse # 需要图形界面，仅在选择区域时导入
         if button == mouse.Button.left:
             if pressed:
                 if self.first_click_pos is None:
@@ -691,11 +2724,8 @@ class MouseRegionSelector:
 
                     if width > 0 and height > 0:
                         region = {"left": left, "top": top, "width": width, "height": height}
-                        self.gui_window.selected_region = region
-                        self.gui_window.coord_entry.delete(0, tk.END)
-                        self.gui_window.coord_entry.insert(0, f"{left},{top},{width},{height}")
-                        self.gui_window.log_message(f"已选择监控区域: {region}")
-                        self.gui_window.region_selected = True
+                        # 在监听线程中触发，交给主线程更新输入框
+                        self.gui_window.call_in_ui(self.gui_window.set_selected_region, region)
                     else:
                         self.gui_window.log_message("选择的区域无效 (宽度或高度为0)，请重新选择。")
 
@@ -706,6 +2736,7 @@ class MouseRegionSelector:
 
     def start_listening(self):
         """启动鼠标监听"""
+        from pynput import mouse # 需要图形界面，仅在选择区域时导入
         self.first_click_pos = None # 重置
         self.listener = mouse.Listener(on_click=self.on_click)
         self.listener.start()
@@ -719,19 +2750,500 @@ class MouseRegionSelector:
 
 
 # --- Flask API 服务器 ---
-from flask import Flask, request, jsonify
 from flask_cors import CORS
-import threading
-# 导入处理时间戳所需的库
-import time
-from datetime import datetime
 
 app = Flask(__name__)
 CORS(app)  # 允许所有跨域请求
 
-# --- 新增：用于存储支付记录的全局列表 ---
-payment_records = []
-# ----------------------------------------
+# --- 收款记录存储 ---
+class PaymentStore:
+    """
+    持久化的收款记录 (SQLite + WAL)，对 order_id、payment_time、actual_amount、user_memo 建索引。
+    金额另存整数分 amount_cents；payment_totals 表保存按 全部/天/小时/备注 累计的笔数和金额，
+    与记录在同一个事务里更新，/payment_summary 只读取汇总桶，不扫描记录。
+    每个线程使用自己的连接，Flask 的多个工作线程可以并发读取。
+    """
+    COLUMNS = ("order_id", "actual_amount", "payment_time", "payer_memo", "user_memo", "account", "amount_cents")
+    TOTALS_UPSERT = ("INSERT INTO payment_totals (kind, bucket, count, cents) VALUES (?, ?, 1, ?) "
+                     "ON CONFLICT(kind, bucket) DO UPDATE SET count = count + 1, cents = cents + excluded.cents")
+
+    def __init__(self, path=PAYMENTS_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS payments (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    order_id TEXT NOT NULL,
+                    actual_amount TEXT NOT NULL,
+                    payment_time TEXT NOT NULL,
+                    payer_memo TEXT,
+                    user_memo TEXT,
+                    account TEXT,
+                    created_at REAL NOT NULL
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_order_id ON payments(order_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_payment_time ON payments(payment_time)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_amount ON payments(actual_amount)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_user_memo ON payments(user_memo)")
+            # 订单服务最常用的查询：按备注 + 金额匹配
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_memo_amount ON payments(user_memo, actual_amount)")
+        self._migrate()
+
+    def _migrate(self):
+        """旧数据库补上 amount_cents 列和 payment_totals 汇总表 (由已有记录一次性重建)"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE") # 与共用同一数据库的其他进程互斥
+        try:
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(payments)")}
+            if "amount_cents" not in columns:
+                conn.execute("ALTER TABLE payments ADD COLUMN amount_cents INTEGER")
+            rows = conn.execute("SELECT id, actual_amount FROM payments WHERE amount_cents IS NULL").fetchall()
+            conn.executemany("UPDATE payments SET amount_cents = ? WHERE id = ?",
+                             [(amount_to_cents(amount) or 0, row_id) for row_id, amount in rows])
+            exists = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'payment_totals'").fetchone()
+            if not exists:
+                conn.execute("""
+                    CREATE TABLE payment_totals (
+                        kind TEXT NOT NULL,
+                        bucket TEXT NOT NULL,
+                        count INTEGER NOT NULL,
+                        cents INTEGER NOT NULL,
+                        PRIMARY KEY (kind, bucket)
+                    )""")
+                for kind, bucket in self._bucket_expressions():
+                    conn.execute(f"INSERT INTO payment_totals (kind, bucket, count, cents) "
+                                 f"SELECT '{kind}', {bucket}, COUNT(*), SUM(amount_cents) FROM payments GROUP BY 2")
+                logger.info("已由现有收款记录建立汇总表 payment_totals")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _bucket_expressions():
+        """汇总维度及其桶的 SQL 表达式 (payment_time 为 'YYYY-MM-DD HH:MM:SS')"""
+        return (("all", "''"), ("day", "substr(payment_time, 1, 10)"),
+                ("hour", "substr(payment_time, 1, 13)"), ("memo", "COALESCE(user_memo, '')"))
+
+    @staticmethod
+    def _buckets(record):
+        """与 _bucket_expressions 对应的 Python 版本，写入记录时增量更新"""
+        payment_time = record.get("payment_time") or ""
+        return (("all", ""), ("day", payment_time[:10]), ("hour", payment_time[:13]), ("memo", record.get("user_memo") or ""))
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = open_sqlite(self.path)
+            self._local.conn = conn
+        return conn
+
+    def _row_to_record(self, row):
+        return dict(zip(self.COLUMNS, row))
+
+    def insert(self, record):
+        """写入一条处理后的收款记录并累加汇总桶，返回自增ID"""
+        cents = record.get("amount_cents")
+        if cents is None:
+            cents = amount_to_cents(record.get("actual_amount")) or 0
+        values = tuple(record.get(column, "") for column in self.COLUMNS[:-1]) + (cents, time.time())
+        with self._conn() as conn:
+            cursor = conn.execute(
+                f"INSERT INTO payments ({', '.join(self.COLUMNS)}, created_at) VALUES ({', '.join('?' * len(values))})",
+                values)
+            conn.executemany(self.TOTALS_UPSERT, [(kind, bucket, cents) for kind, bucket in self._buckets(record)])
+            return cursor.lastrowid
+
+    def summary(self, since=None, until=None, memo_limit=50):
+        """
+        从汇总桶读取收款统计，耗时只与桶的数量有关。
+        :param since: 起始日期 'YYYY-MM-DD' (含)，影响合计、按天和按小时的结果
+        :param until: 截止日期 'YYYY-MM-DD' (含)
+        :param memo_limit: 按备注统计时返回金额最大的前几个备注 (按备注统计不受日期过滤影响)
+        :return: {"count", "cents", "days": [(天, 笔数, 分)], "hours": [...], "memos": [...]}
+        """
+        conn = self._conn()
+        conditions, params = [], []
+        if since is not None:
+            conditions.append("substr(bucket, 1, 10) >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("substr(bucket, 1, 10) <= ?")
+            params.append(until)
+        where = "".join(f" AND {condition}" for condition in conditions)
+        buckets = {}
+        for kind in ("day", "hour"):
+            buckets[kind] = conn.execute(
+                f"SELECT bucket, count, cents FROM payment_totals WHERE kind = ?{where} ORDER BY bucket",
+                [kind] + params).fetchall()
+        if conditions:
+            count, cents = sum(row[1] for row in buckets["day"]), sum(row[2] for row in buckets["day"])
+        else:
+            count, cents = conn.execute(
+                "SELECT COALESCE(SUM(count), 0), COALESCE(SUM(cents), 0) FROM payment_totals WHERE kind = 'all'").fetchone()
+        memos = conn.execute(
+            "SELECT bucket, count, cents FROM payment_totals WHERE kind = 'memo' ORDER BY cents DESC, bucket LIMIT ?",
+            (memo_limit,)).fetchall()
+        return {"count": count, "cents": cents, "days": buckets["day"], "hours": buckets["hour"], "memos": memos}
+
+    def query(self, since=None, cursor=None, limit=None, user_memo=None, amount=None, order_id=None, with_total=False):
+        """
+        按条件查询记录 (全部走索引)，按写入顺序返回。
+        :param since: 只返回 payment_time >= since 的记录 ('YYYY-MM-DD HH:MM:SS'，可只写日期)
+        :param cursor: 只返回ID大于 cursor 的记录 (上一页返回的 next_cursor)
+        :param limit: 最多返回条数 (None 表示不限)
+        :param with_total: 是否统计匹配总数 (需要扫描全部匹配记录，分页时默认不统计)
+        :return: (记录列表, 匹配总数 (不统计时为 None), 最后一条的ID)
+        """
+        conditions, params = [], []
+        for column, value in (("user_memo", user_memo), ("actual_amount", amount), ("order_id", order_id)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            conditions.append("payment_time >= ?")
+            params.append(since)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        conn = self._conn()
+        total = conn.execute(f"SELECT COUNT(*) FROM payments {where}", params).fetchone()[0] if with_total else None
+
+        if cursor is not None:
+            conditions.append("id > ?")
+            params.append(cursor)
+            where = f"WHERE {' AND '.join(conditions)}"
+        sql = f"SELECT id, {', '.join(self.COLUMNS)} FROM payments {where} ORDER BY id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        rows = conn.execute(sql, params).fetchall()
+        last_id = rows[-1][0] if rows else None
+        return [self._row_to_record(row[1:]) for row in rows], total, last_id
+
+    def after(self, cursor, limit=100, user_memo=None):
+        """返回ID大于 cursor 的记录 [(id, 记录), ...]，供推送接口按事件ID续传"""
+        sql = f"SELECT id, {', '.join(self.COLUMNS)} FROM payments WHERE id > ?"
+        params = [cursor]
+        if user_memo is not None:
+            sql += " AND user_memo = ?"
+            params.append(user_memo)
+        rows = self._conn().execute(sql + " ORDER BY id LIMIT ?", params + [limit]).fetchall()
+        return [(row[0], self._row_to_record(row[1:])) for row in rows]
+
+    def last_id(self):
+        """当前最大的记录ID，没有记录时为 0"""
+        return self._conn().execute("SELECT COALESCE(MAX(id), 0) FROM payments").fetchone()[0]
+
+    def find_by_order_id(self, order_id):
+        """按订单ID查找最早的一条记录，不存在时返回 None"""
+        row = self._conn().execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM payments WHERE order_id = ? ORDER BY id LIMIT 1", (order_id,)).fetchone()
+        return self._row_to_record(row) if row else None
+
+payment_store = PaymentStore()
+payment_records_gauge.set_function(payment_store.last_id) # 主键索引上的 MAX(id)，不扫描记录
+
+# --- 新收款通知 ---
+class PaymentBroadcaster:
+    """
+    新收款到达时唤醒所有等待中的订阅者。
+    订阅者之间共享同一个条件变量，只保存各自的游标 (最后看到的记录ID)，
+    记录本身从 payment_store 读取，不为每个订阅者维护队列或后台线程。
+    API 端口上每个挂起的订阅者仍占用一个服务线程，所以同时挂起的订阅数限制在 max_subscribers 以内；
+    推送服务 (PushServer) 通过 add_listener 收到通知，它的连接不计入这里的名额。
+    """
+    def __init__(self, latest_id=0, max_subscribers=API_PUSH_MAX_SUBSCRIBERS):
+        self._cond = threading.Condition()
+        self.latest_id = latest_id
+        self.max_subscribers = max_subscribers
+        self.subscribers = 0
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """每次 publish 后调用 callback(record_id) (在发布者的线程中调用，必须立即返回)"""
+        self._listeners.append(callback)
+
+    def subscribe(self):
+        """占用一个订阅名额，已满时返回 False (调用方返回 503)"""
+        with self._cond:
+            if self.subscribers >= self.max_subscribers:
+                return False
+            self.subscribers += 1
+            return True
+
+    def unsubscribe(self):
+        with self._cond:
+            self.subscribers -= 1
+
+    def publish(self, record_id):
+        """receive_payment 写入记录后调用"""
+        with self._cond:
+            if record_id > self.latest_id:
+                self.latest_id = record_id
+            self._cond.notify_all()
+        for callback in self._listeners:
+            callback(record_id)
+
+    def wait_for_new(self, after_id, timeout):
+        """等待出现ID大于 after_id 的记录，超时返回 False"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.latest_id > after_id, timeout)
+
+payment_broadcaster = PaymentBroadcaster(payment_store.last_id())
+push_subscribers_gauge.set_function(
+    lambda: payment_broadcaster.subscribers + (_push_server.subscribers if _push_server is not None else 0))
+
+# --- 待支付订单 ---
+class OrderRegistry:
+    """
+    待支付订单登记表。订单持久化在 payments.db 的 orders 表中，
+    待支付的订单同时放在以 (备注, 金额) 为键的内存哈希索引里，收款入库时 O(1) 匹配，
+    同一个键下有多个订单时先登记的先匹配。过期订单在每次登记/匹配/查询时按过期时间的小根堆顺带清理。
+    """
+    COLUMNS = ("order_no", "user_memo", "amount", "notify_url", "status", "created_at", "expires_at", "paid_at", "payment_order_id")
+
+    def __init__(self, path=PAYMENTS_DB_PATH):
+        self._lock = threading.Lock()
+        self._conn = open_sqlite(path)
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS orders (
+                    order_no TEXT PRIMARY KEY,
+                    user_memo TEXT NOT NULL,
+                    amount TEXT NOT NULL,
+                    notify_url TEXT,
+                    status TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    paid_at REAL,
+                    payment_order_id TEXT
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status)")
+        self._index = {} # (备注, 金额) -> deque([order_no, ...])
+        self._expiry = [] # [(expires_at, order_no), ...] 小根堆
+        rows = self._conn.execute(
+            "SELECT order_no, user_memo, amount, expires_at FROM orders WHERE status = 'pending' ORDER BY created_at").fetchall()
+        for order_no, user_memo, amount, expires_at in rows:
+            self._index.setdefault(self.match_key(user_memo, amount), deque()).append(order_no)
+            heapq.heappush(self._expiry, (expires_at, order_no))
+
+    @staticmethod
+    def match_key(user_memo, amount):
+        """匹配键: 去掉空白的备注 + 两位小数的金额 (与识别端去重键的规范化一致)"""
+        return (re.sub(r"\s+", "", user_memo or ""), normalize_amount(amount))
+
+    def _row_to_order(self, row):
+        return dict(zip(self.COLUMNS, row))
+
+    def _get_locked(self, order_no):
+        row = self._conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM orders WHERE order_no = ?", (order_no,)).fetchone()
+        return self._row_to_order(row) if row else None
+
+    def _expire_locked(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            _, order_no = heapq.heappop(self._expiry)
+            with self._conn:
+                cursor = self._conn.execute(
+                    "UPDATE orders SET status = 'expired' WHERE order_no = ? AND status = 'pending'", (order_no,))
+            if not cursor.rowcount:
+                continue # 已经支付
+            order = self._get_locked(order_no)
+            pending = self._index.get(self.match_key(order["user_memo"], order["amount"]))
+            if pending and order_no in pending:
+                pending.remove(order_no)
+            orders_counter.inc(label_value="expired")
+            logger.info(f"待支付订单已过期: {order_no}")
+
+    def register(self, user_memo, amount, notify_url=None, ttl=ORDER_TTL, order_no=None):
+        """
+        登记一个待支付订单，返回 (订单, 是否新登记)。order_no 已存在时直接返回已有订单 (幂等)。
+        参数无效时抛出 ValueError。
+        """
+        key = self.match_key(user_memo, amount)
+        if not key[0]:
+            raise ValueError("user_memo 不能为空")
+        if not key[1] or Decimal(key[1]) <= 0:
+            raise ValueError("amount 必须是大于0的金额")
+        if not 0 < ttl <= ORDER_MAX_TTL:
+            raise ValueError(f"ttl 必须在 1 ~ {ORDER_MAX_TTL} 秒之间")
+        order_no = order_no or f"order_{uuid.uuid4().hex}"
+        now = time.time()
+        with self._lock:
+            self._expire_locked(now)
+            existing = self._get_locked(order_no)
+            if existing is not None:
+                return existing, False
+            with self._conn:
+                self._conn.execute(
+                    "INSERT INTO orders (order_no, user_memo, amount, notify_url, status, created_at, expires_at) "
+                    "VALUES (?, ?, ?, ?, 'pending', ?, ?)",
+                    (order_no, user_memo, key[1], notify_url, now, now + ttl))
+            self._index.setdefault(key, deque()).append(order_no)
+            heapq.heappush(self._expiry, (now + ttl, order_no))
+            order = self._get_locked(order_no)
+        orders_counter.inc(label_value="registered")
+        return order, True
+
+    def get(self, order_no):
+        with self._lock:
+            self._expire_locked(time.time())
+            return self._get_locked(order_no)
+
+    def match(self, payment):
+        """收款入库后调用：按 (备注, 金额) 找到最早登记的待支付订单并标记为已支付，返回该订单或 None"""
+        key = self.match_key(payment.get("user_memo"), payment.get("actual_amount"))
+        now = time.time()
+        with self._lock:
+            self._expire_locked(now)
+            pending = self._index.get(key)
+            while pending:
+                order_no = pending.popleft()
+                with self._conn:
+                    cursor = self._conn.execute(
+                        "UPDATE orders SET status = 'paid', paid_at = ?, payment_order_id = ? "
+                        "WHERE order_no = ? AND status = 'pending'", (now, payment.get("order_id"), order_no))
+                if cursor.rowcount:
+                    if not pending:
+                        del self._index[key]
+                    orders_counter.inc(label_value="paid")
+                    return self._get_locked(order_no)
+            self._index.pop(key, None)
+        return None
+
+    def pending_count(self):
+        with self._lock:
+            self._expire_locked(time.time())
+            return sum(len(pending) for pending in self._index.values())
+
+order_registry = OrderRegistry()
+
+_webhook_worker = None
+_webhook_worker_lock = threading.Lock()
+
+def get_webhook_worker():
+    """返回 webhook 投递线程 (首次调用时创建并启动，会先投递上次未送达的 webhook)"""
+    global _webhook_worker
+    with _webhook_worker_lock:
+        if _webhook_worker is None:
+            _webhook_worker = DeliveryWorker(PaymentOutbox(WEBHOOK_OUTBOX_DB_PATH), batch_mode=False, name="webhook",
+                                             latency=webhook_latency, counter=webhook_deliveries_counter)
+            _webhook_worker.start()
+        return _webhook_worker
+
+def notify_order_paid(order, payment):
+    """订单匹配到收款后，把 webhook 写入发件箱，由投递线程发送和重试"""
+    if not order.get("notify_url"):
+        return
+    worker = get_webhook_worker()
+    worker.outbox.enqueue(order["notify_url"], {"event": "order.paid", "order": order, "payment": payment})
+    worker.wake()
+
+
+def process_payment(data):
+    """
+    处理一条支付通知并保存，返回 (处理后的记录, 是否为新记录)。
+    同一订单ID重复提交时不会再次入库，直接返回已有记录 (幂等)。
+    单条接口 /receive_payment 与批量接口 /receive_payments 共用此逻辑。
+    """
+    # --- 数据提取与基础处理 ---
+    raw_order_id = data.get("order_id", "N/A")
+    raw_amount_str = data.get("amount", "0.00")
+    payer_memo = data.get("payer_memo", "")
+    user_memo = data.get("user_memo", "")
+    account = data.get("account", "") # 收款账户 (多区域监控时区分来源)
+    timestamp_int = data.get("timestamp")
+
+    # --- 核心业务逻辑处理 ---
+
+    # 1. 处理金额 (字符串 -> 整数分，不经过浮点数)
+    amount_cents = amount_to_cents(raw_amount_str)
+    if amount_cents is None:
+        logger.warning(f"无效的金额格式: {raw_amount_str}")
+        amount_cents = 0 # 或者返回错误？
+    formatted_amount = format_cents(amount_cents) # 格式化为保留两位小数的字符串
+
+    # 2. 处理时间戳 (整数秒 -> 人类可读格式)
+    logger.debug("[DEBUG] 收到的 timestamp_int: %s, 类型: %s", timestamp_int, type(timestamp_int))
+    readable_time = None
+    
+    # 尝试多种方式解析时间戳
+    if timestamp_int is not None:
+        try:
+            # 尝试转换为整数（处理字符串或浮点数的情况）
+            ts_value = int(timestamp_int) if not isinstance(timestamp_int, int) else timestamp_int
+            # 转换为本地时间
+            readable_time = datetime.fromtimestamp(ts_value).strftime('%Y-%m-%d %H:%M:%S')
+            logger.debug("[DEBUG] 成功转换时间戳: %s -> %s", ts_value, readable_time)
+        except (ValueError, OSError, TypeError) as e:
+            logger.warning(f"时间戳转换失败: {timestamp_int}, 错误: {e}")
+    
+    timestamp_valid = readable_time is not None
+
+    # 如果时间戳解析失败，使用当前系统时间作为回退
+    if readable_time is None:
+        readable_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        logger.debug("[DEBUG] 使用当前系统时间作为回退: %s", readable_time)
+
+    # 3. 订单ID处理：未提供时由金额 + 时间戳 + 备注生成稳定的ID，保证重复提交可以识别；
+    #    没有有效的时间戳时无法区分金额、备注相同的两笔收款，只能生成新的ID
+    if raw_order_id in (None, "", "N/A"):
+        if timestamp_valid:
+            raw_order_id = stable_order_id(
+                payment_dedup_key(raw_amount_str, str(timestamp_int), f"{user_memo}|{payer_memo}", account=account),
+                prefix="payment_")
+        else:
+            raw_order_id = f"payment_{uuid.uuid4().hex[:16]}"
+    processed_order_id = raw_order_id # 这里可以添加逻辑
+
+    # 4. (可选) 备注处理，比如清理、截断等
+    # 你之前写的清理和截断逻辑可以放在这里应用到 payer_memo 或 user_memo 上
+
+    processed_payment_info = { # 使用更描述性的键名
+        "order_id": processed_order_id,
+        "actual_amount": formatted_amount, # 返回格式化后的金额
+        "payment_time": readable_time,     # 返回格式化后的时间
+        "payer_memo": payer_memo,
+        "user_memo": user_memo,            # 返回处理后的用户备注
+        "account": account,                # 收款账户
+        "amount_cents": amount_cents,      # 金额 (整数分)
+        # 可以添加更多处理后的信息
+        # "net_amount": net_amount, # 例如，扣除手续费后的净额
+        # "currency": "CNY"         # 货币单位
+    }
+
+    # 幂等：内存索引挡住并发的重复提交，数据库按 order_id 索引挡住重启前/其他进程写入的记录
+    ingest_key = ("ingested", processed_order_id)
+    if not payment_dedup.add_if_absent(ingest_key):
+        duplicates_counter.inc(label_value="ingested")
+        logger.info(f"重复的支付通知，订单ID: {processed_order_id}")
+        return payment_store.find_by_order_id(processed_order_id) or processed_payment_info, False
+    existing = payment_store.find_by_order_id(processed_order_id)
+    if existing is not None:
+        duplicates_counter.inc(label_value="ingested")
+        logger.info(f"订单已存在，不重复入库，订单ID: {processed_order_id}")
+        return existing, False
+
+    # ***** 在这里添加保存记录的代码 *****
+    try:
+        record_id = payment_store.insert(processed_payment_info) # 持久化
+    except Exception:
+        payment_dedup.discard(ingest_key)
+        raise
+    payment_broadcaster.publish(record_id) # 唤醒 /stream_payments 和 /wait_payment 的订阅者
+
+    # 匹配待支付订单 (哈希索引，不扫描历史记录)，匹配成功后通知订单的 notify_url
+    try:
+        order = order_registry.match(processed_payment_info)
+        if order is not None:
+            logger.info(f"收款 {processed_order_id} 匹配到订单 {order['order_no']}")
+            notify_order_paid(order, processed_payment_info)
+    except Exception as e:
+        logger.error(f"匹配待支付订单时发生错误: {e}", exc_info=True)
+    # ************************************
+
+    logger.info(f"处理完成，返回信息: {processed_payment_info}")
+    return processed_payment_info, True
 
 
 @app.route('/receive_payment', methods=['POST'])
@@ -745,112 +3257,760 @@ def receive_payment():
 
         logger.info(f"收到支付通知: {data}")
 
-        # --- 数据提取与基础处理 ---
-        raw_order_id = data.get("order_id", "N/A")
-        raw_amount_str = data.get("amount", "0.00")
-        payer_memo = data.get("payer_memo", "")
-        user_memo = data.get("user_memo", "")
-        timestamp_int = data.get("timestamp")
-
-        # --- 核心业务逻辑处理 ---
-
-        # 1. 处理金额 (字符串 -> 浮点数)
-        try:
-            amount_float = float(raw_amount_str)
-            formatted_amount = f"{amount_float:.2f}" # 格式化为保留两位小数的字符串
-        except ValueError:
-            logger.warning(f"无效的金额格式: {raw_amount_str}")
-            formatted_amount = "0.00" # 或者返回错误？
-
-        # 2. 处理时间戳 (整数秒 -> 人类可读格式)
-        logger.debug(f"[DEBUG] 收到的 timestamp_int: {timestamp_int}, 类型: {type(timestamp_int)}")
-        readable_time = None
-        
-        # 尝试多种方式解析时间戳
-        if timestamp_int is not None:
-            try:
-                # 尝试转换为整数（处理字符串或浮点数的情况）
-                ts_value = int(timestamp_int) if not isinstance(timestamp_int, int) else timestamp_int
-                # 转换为本地时间
-                readable_time = datetime.fromtimestamp(ts_value).strftime('%Y-%m-%d %H:%M:%S')
-                logger.debug(f"[DEBUG] 成功转换时间戳: {ts_value} -> {readable_time}")
-            except (ValueError, OSError, TypeError) as e:
-                logger.warning(f"时间戳转换失败: {timestamp_int}, 错误: {e}")
-        
-        # 如果时间戳解析失败，使用当前系统时间作为回退
-        if readable_time is None:
-            readable_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            logger.debug(f"[DEBUG] 使用当前系统时间作为回退: {readable_time}")
-
-        # 3. (可选) 订单ID处理，比如去除前缀等
-        processed_order_id = raw_order_id # 这里可以添加逻辑
-
-        # 4. (可选) 备注处理，比如清理、截断等
-        # 你之前写的清理和截断逻辑可以放在这里应用到 payer_memo 或 user_memo 上
+        processed_payment_info, is_new = process_payment(data)
 
         # --- 构造返回给客户端的响应数据 ---
         response_data = {
             "status": "success",
-            "processed_payment_info": { # 使用更描述性的键名
-                "order_id": processed_order_id,
-                "actual_amount": formatted_amount, # 返回格式化后的金额
-                "payment_time": readable_time,     # 返回格式化后的时间
-                "payer_memo": payer_memo,
-                "user_memo": user_memo,            # 返回处理后的用户备注
-                # 可以添加更多处理后的信息
-                # "net_amount": net_amount, # 例如，扣除手续费后的净额
-                # "currency": "CNY"         # 货币单位
-            },
+            "processed_payment_info": processed_payment_info,
+            "duplicate": not is_new, # 重复提交的通知不会再次入库
             # (可选) 也可以返回原始收到的数据
             # "original_data_received": data
         }
-
-        # ***** 在这里添加保存记录的代码 *****
-        payment_records.append(response_data["processed_payment_info"]) # 将处理后的信息添加到全局列表
-        # ************************************
-
-        logger.info(f"处理完成，返回信息: {response_data['processed_payment_info']}")
         return jsonify(response_data), 200
 
     except Exception as e:
         logger.error(f"处理支付通知时发生未预期错误: {e}", exc_info=True)
         return jsonify({"status": "error", "message": "Internal server error during processing"}), 500
 
+@app.route('/receive_payments', methods=['POST'])
+def receive_payments():
+    """
+    批量接收支付通知。请求体为 {"payments": [通知, ...]} 或直接为通知列表。
+    每条通知单独处理，results 与请求中的顺序一一对应。
+    """
+    data = request.get_json(silent=True)
+    payments = data.get("payments") if isinstance(data, dict) else data
+    if not isinstance(payments, list) or not payments:
+        logger.warning("批量接口收到无效数据")
+        return jsonify({"status": "error", "message": "Expected a non-empty list of payments"}), 400
+
+    logger.info(f"收到批量支付通知: {len(payments)} 条")
+    results = []
+    for item in payments:
+        if not isinstance(item, dict) or not item:
+            results.append({"status": "error", "message": "No valid JSON data received"})
+            continue
+        try:
+            processed_payment_info, is_new = process_payment(item)
+            results.append({"status": "success", "processed_payment_info": processed_payment_info, "duplicate": not is_new})
+        except Exception as e:
+            logger.error(f"批量处理支付通知时发生未预期错误: {e}", exc_info=True)
+            results.append({"status": "error", "message": "Internal server error during processing"})
+    return jsonify({"status": "success", "results": results}), 200
+
+@app.route('/orders', methods=['POST'])
+def create_order():
+    """
+    登记待支付订单。请求体: {"user_memo", "amount", "notify_url" (可选), "ttl" (秒，可选), "order_no" (可选)}
+    收到备注和金额都匹配的收款时订单变为 paid，并向 notify_url POST {"event": "order.paid", "order", "payment"}。
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"status": "error", "message": "No valid JSON data received"}), 400
+    try:
+        ttl = float(data.get("ttl", ORDER_TTL))
+        order, created = order_registry.register(str(data.get("user_memo") or ""), data.get("amount"),
+                                                 notify_url=data.get("notify_url") or None, ttl=ttl,
+                                                 order_no=data.get("order_no") or None)
+    except (ValueError, TypeError) as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    if order.get("notify_url"):
+        get_webhook_worker() # 第一次登记带回调的订单时启动投递线程，顺带重试上次未送达的 webhook
+    return jsonify({"status": "success", "order": order, "duplicate": not created}), 200
+
+@app.route('/orders/<order_no>', methods=['GET'])
+def get_order(order_no):
+    """查询订单状态 (pending / paid / expired)"""
+    order = order_registry.get(order_no)
+    if order is None:
+        return jsonify({"status": "error", "message": "Order not found"}), 404
+    return jsonify({"status": "success", "order": order}), 200
+
 # ***** 添加查询所有记录的端点 *****
+def _normalize_amount(value):
+    """把查询参数中的金额规范为与存储一致的两位小数字符串"""
+    amount = normalize_amount(value)
+    if not amount:
+        raise ValueError(f"无效的金额: {value}")
+    return amount
+
+def _int_arg(args, name, default=None):
+    """读取整数查询参数：未提供时返回 default，格式无效 (包括空值) 时抛出 ValueError"""
+    value = args.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} 必须是整数: {value!r}") from None
+
+def _query_payments_response(user_memo=None):
+    """
+    解析查询参数并返回分页结果。
+    支持 since、limit、cursor、user_memo、amount、order_id，均为可选；
+    不带 limit 时返回全部匹配记录 (与旧版本行为一致)，带 limit 时用返回的 next_cursor 翻页，
+    limit 超过 QUERY_MAX_LIMIT 时按 QUERY_MAX_LIMIT 返回。
+    分页时统计匹配总数需要扫描全部匹配记录，只有带 count=1 时才返回 total_count。
+    """
+    args = request.args
+    try:
+        limit = _int_arg(args, "limit")
+        if limit is not None:
+            if limit <= 0:
+                raise ValueError("limit 必须大于 0")
+            limit = min(limit, QUERY_MAX_LIMIT)
+        cursor = _int_arg(args, "cursor")
+        amount = args.get("amount")
+        amount = _normalize_amount(amount) if amount else None
+        with_count = args.get("count", "0") not in ("0", "false", "")
+    except ValueError as e:
+        return jsonify({"status": "error", "message": f"Invalid query parameter: {e}"}), 400
+
+    full_result = limit is None and cursor is None # 返回全部匹配记录时总数就是记录条数，不必另外统计
+    records, total, last_id = payment_store.query(
+        since=args.get("since") or None,
+        cursor=cursor,
+        limit=limit,
+        user_memo=user_memo if user_memo is not None else args.get("user_memo"),
+        amount=amount,
+        order_id=args.get("order_id"),
+        with_total=with_count and not full_result,
+    )
+    response = {"status": "success", "records": records}
+    if full_result:
+        response["total_count"] = len(records) # 匹配条件的总记录数
+    elif with_count:
+        response["total_count"] = total
+    if limit is not None:
+        # 本页已满时给出下一页游标，否则为 None 表示没有更多数据
+        response["next_cursor"] = last_id if len(records) == limit else None
+    return jsonify(response), 200
+
 @app.route('/query_payment', methods=['GET'])
 def query_payment():
-    """提供一个查询接口，返回所有已存储的支付记录"""
-    global payment_records # 声明使用全局变量
-
-    # 返回所有记录
-    # 注意：对于大量数据，可能需要考虑分页
+    """查询已存储的支付记录，可按 since/limit/cursor/user_memo/amount/order_id 过滤和分页"""
+    return _query_payments_response()
+
+@app.route('/query_payment/<user_memo>', methods=['GET'])
+def query_payment_by_memo(user_memo):
+    """按用户备注 (订单号) 查询，订单服务匹配收款时使用，可附加 amount 等参数"""
+    return _query_payments_response(user_memo=user_memo)
+
+def _summary_rows(rows, key):
+    return [{key: bucket, "count": count, "amount": format_cents(cents), "amount_cents": cents}
+            for bucket, count, cents in rows]
+
+@app.route('/payment_summary', methods=['GET'])
+def payment_summary():
+    """
+    收款汇总：合计、按天、按小时、按备注的笔数和金额 (由入库时累加的汇总桶得出，金额按分精确计算)。
+    参数: since / until (可选，'YYYY-MM-DD'，含当天)、memo_limit (可选，默认50)
+    """
+    args = request.args
+    try:
+        since, until = args.get("since") or None, args.get("until") or None
+        for value in (since, until):
+            if value is not None:
+                datetime.strptime(value, "%Y-%m-%d")
+        memo_limit = _int_arg(args, "memo_limit", 50)
+        if not 0 < memo_limit <= QUERY_MAX_LIMIT:
+            raise ValueError(f"memo_limit 必须在 1 到 {QUERY_MAX_LIMIT} 之间")
+    except ValueError as e:
+        return jsonify({"status": "error", "message": f"Invalid query parameter: {e}"}), 400
+
+    summary = payment_store.summary(since=since, until=until, memo_limit=memo_limit)
     return jsonify({
         "status": "success",
-        "total_count": len(payment_records), # 可选：返回总记录数
-        "records": payment_records           # 返回存储的所有记录
+        "total_count": summary["count"],
+        "total_amount": format_cents(summary["cents"]),
+        "total_amount_cents": summary["cents"],
+        "days": _summary_rows(summary["days"], "day"),
+        "hours": _summary_rows(summary["hours"], "hour"),
+        "memos": _summary_rows(summary["memos"], "user_memo"),
     }), 200
 # *********************************
 
+# ***** 推送接口：长轮询与 Server-Sent Events *****
+def _push_unavailable():
+    """推送订阅已满：让客户端稍后重试，不占用服务线程"""
+    response = jsonify({"status": "error", "message": "Too many push subscribers, retry later"})
+    response.headers["Retry-After"] = "5"
+    return response, 503
+
+@app.route('/wait_payment', methods=['GET'])
+def wait_payment():
+    """
+    长轮询：等待新的收款记录后立即返回，超时返回空列表。
+    参数: user_memo (可选，只等待该备注的记录)、timeout (秒，默认30)、
+          cursor (可选，从该记录ID之后开始；不传则只等待调用之后到达的记录)
+    """
+    try:
+        timeout = min(float(request.args.get("timeout", 30)), WAIT_MAX_TIMEOUT)
+        cursor = _int_arg(request.args, "cursor")
+    except ValueError as e:
+        return jsonify({"status": "error", "message": f"Invalid query parameter: {e}"}), 400
+    user_memo = request.args.get("user_memo")
+    if cursor is None:
+        cursor = payment_broadcaster.latest_id
+    if not payment_broadcaster.subscribe():
+        return _push_unavailable()
+
+    try:
+        deadline = time.monotonic() + max(0.0, timeout)
+        while True:
+            checked_up_to = payment_broadcaster.latest_id # 先读取，保证下面的查询覆盖到这个ID
+            matches = payment_store.after(cursor, user_memo=user_memo)
+            if matches:
+                return jsonify({
+                    "status": "success",
+                    "records": [record for _, record in matches],
+                    "next_cursor": matches[-1][0],
+                }), 200
+            # 没有匹配的记录时，把游标推进到已检查过的位置，避免重复扫描
+            cursor = max(cursor, checked_up_to)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not payment_broadcaster.wait_for_new(cursor, remaining):
+                return jsonify({"status": "timeout", "records": [], "next_cursor": cursor}), 200
+    finally:
+        payment_broadcaster.unsubscribe()
+
+@app.route('/stream_payments', methods=['GET'])
+def stream_payments():
+    """
+    Server-Sent Events 推送新收款，事件ID为记录ID。
+    断线重连时浏览器会带上 Last-Event-ID 头，从该ID之后续传；也可用 last_event_id 参数指定。
+    参数: user_memo (可选，只推送该备注的记录)
+    """
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    try:
+        cursor = int(last_event_id) if last_event_id else payment_broadcaster.latest_id
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid Last-Event-ID"}), 400
+    user_memo = request.args.get("user_memo")
+
+    def generate():
+        nonlocal cursor
+        yield "retry: 3000\n\n"
+        while True:
+            checked_up_to = payment_broadcaster.latest_id
+            matches = payment_store.after(cursor, user_memo=user_memo)
+            for record_id, record in matches:
+                cursor = record_id
+                yield f"id: {record_id}\nevent: payment\ndata: {json.dumps(record, ensure_ascii=False)}\n\n"
+            if matches:
+                continue
+            cursor = max(cursor, checked_up_to)
+            if not payment_broadcaster.wait_for_new(cursor, SSE_KEEPALIVE_INTERVAL):
+                yield ": keep-alive\n\n"
+
+    if not payment_broadcaster.subscribe():
+        return _push_unavailable()
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream", headers=headers)
+    response.call_on_close(payment_broadcaster.unsubscribe) # 客户端断开或服务器关闭连接时释放名额
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 文本格式的运行指标 (各阶段耗时直方图、帧/去重/投递计数、投递积压)"""
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+# *********************************
+
+# --- 推送服务 (事件驱动) ---
+class PushServer:
+    """
+    在独立端口上提供与 API 相同的 /wait_payment 和 /stream_payments，由一个 asyncio 事件循环线程服务所有订阅者，
+    每个连接只是一个协程，挂起的连接数不受工作线程数限制 (上限为 max_subscribers)。
+    payment_broadcaster 发布新收款时唤醒事件循环，新记录只从 payment_store 读取一次放入最近记录缓存，
+    各订阅者按自己的游标和备注从缓存中取；游标早于缓存范围 (断线很久后续传) 时才直接查询数据库。
+    """
+    HEADER_TIMEOUT = 10 # 读取请求头的超时 (秒)
+
+    def __init__(self, host=API_HOST, port=PUSH_PORT, max_subscribers=PUSH_MAX_SUBSCRIBERS,
+                 store=None, broadcaster=None, recent_records=PUSH_RECENT_RECORDS):
+        self.host = host
+        self.port = port
+        self.max_subscribers = max_subscribers
+        self.store = store or payment_store
+        self.broadcaster = broadcaster or payment_broadcaster
+        self.recent_records = recent_records
+        self.subscribers = 0
+        self._loop = None
+        self._server = None
+        self._changed = None # asyncio.Event，每次有新记录时置位并换成新的
+        self._ready = threading.Event()
+        self._error = None
+        self._ids = [] # 最近记录的ID (递增)
+        self._records = [] # 与 _ids 一一对应的记录
+        self._floor = 0 # ID 大于该值的记录都在缓存中
+        self._latest_id = 0
+
+    # --- 生命周期 ---
+    def start(self):
+        """在后台线程中启动事件循环，端口监听成功后返回 (port=0 时 self.port 为实际端口)"""
+        self._floor = self._latest_id = self.store.last_id()
+        threading.Thread(target=self._run, name="push", daemon=True).start()
+        self._ready.wait()
+        if self._server is None:
+            raise OSError(f"推送服务无法监听 {self.host}:{self.port}: {self._error}")
+        self.broadcaster.add_listener(lambda record_id: self._loop.call_soon_threadsafe(self._refresh))
+        logger.info(f"推送服务 (asyncio, 最多 {self.max_subscribers} 个连接) 监听 http://{self.host}:{self.port}")
+        return self
+
+    def stop(self, timeout=5):
+        """关闭监听端口和所有连接，停止事件循环"""
+        if self._loop is not None and self._server is not None:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result(timeout)
+
+    async def _shutdown(self):
+        self._server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._loop.call_soon(self._loop.stop)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._changed = asyncio.Event()
+        try:
+            self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+            self.port = self._server.sockets[0].getsockname()[1]
+        except OSError as e:
+            self._error = e
+            return
+        finally:
+            self._ready.set()
+        self._loop.run_forever()
+        self._loop.close()
+
+    # --- 最近记录缓存 ---
+    def _refresh(self):
+        """(事件循环线程) 把新记录读入缓存并唤醒所有等待中的订阅者；连续多次通知时后面的查询为空"""
+        while True:
+            rows = self.store.after(self._latest_id, limit=self.recent_records)
+            for record_id, record in rows:
+                self._ids.append(record_id)
+                self._records.append(record)
+            if rows:
+                self._latest_id = rows[-1][0]
+            if len(rows) < self.recent_records:
+                break
+        excess = len(self._ids) - self.recent_records
+        if excess > self.recent_records: # 攒够一批再裁剪，均摊 O(1)
+            self._floor = self._ids[excess - 1]
+            del self._ids[:excess], self._records[:excess]
+        if rows:
+            changed, self._changed = self._changed, asyncio.Event()
+            changed.set()
+
+    def _records_after(self, cursor, user_memo):
+        """ID 大于 cursor 的记录 [(id, 记录), ...]，最多 100 条 (与 payment_store.after 一致)"""
+        if cursor < self._floor:
+            return self.store.after(cursor, user_memo=user_memo)
+        start = bisect.bisect_right(self._ids, cursor)
+        matches = []
+        for index in range(start, len(self._ids)):
+            record = self._records[index]
+            if user_memo is None or record.get("user_memo") == user_memo:
+                matches.append((self._ids[index], record))
+                if len(matches) >= 100:
+                    break
+        return matches
+
+    # --- HTTP ---
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), self.HEADER_TIMEOUT)
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.HEADER_TIMEOUT)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            url = urllib.parse.urlsplit(target)
+            args = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+            if method != "GET":
+                await self._respond(writer, "405 Method Not Allowed", {"status": "error", "message": "Method not allowed"})
+            elif url.path not in ("/wait_payment", "/stream_payments"):
+                await self._respond(writer, "404 Not Found", {"status": "error", "message": "Not found"})
+            elif self.subscribers >= self.max_subscribers:
+                await self._respond(writer, "503 Service Unavailable",
+                                    {"status": "error", "message": "Too many push subscribers, retry later"},
+                                    extra_headers="Retry-After: 5\r\n")
+            else:
+                self.subscribers += 1
+                try:
+                    if url.path == "/wait_payment":
+                        await self._wait_payment(reader, writer, args)
+                    else:
+                        await self._stream_payments(reader, writer, args, headers)
+                finally:
+                    self.subscribers -= 1
+        except (ValueError, asyncio.TimeoutError, ConnectionError):
+            pass # 请求格式错误或客户端已断开
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, body, extra_headers=""):
+        payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        writer.write((f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                      f"Access-Control-Allow-Origin: *\r\n{extra_headers}Connection: close\r\n\r\n").encode("latin-1") + payload)
+        await writer.drain()
+
+    async def _wait_changed(self, closed, timeout):
+        """等待新记录或客户端断开，返回 'changed' / 'closed' / 'timeout'"""
+        changed = asyncio.ensure_future(self._changed.wait())
+        done, _ = await asyncio.wait({changed, closed}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if not changed.done():
+            changed.cancel()
+        if closed in done:
+            return "closed"
+        return "changed" if changed in done else "timeout"
+
+    async def _wait_payment(self, reader, writer, args):
+        """与 API 的 /wait_payment 相同的参数和返回值"""
+        try:
+            timeout = min(float(args.get("timeout", 30)), WAIT_MAX_TIMEOUT)
+            cursor = _int_arg(args, "cursor", self._latest_id)
+        except ValueError as e:
+            await self._respond(writer, "400 Bad Request", {"status": "error", "message": f"Invalid query parameter: {e}"})
+            return
+        user_memo = args.get("user_memo")
+        deadline = self._loop.time() + max(0.0, timeout)
+        closed = asyncio.ensure_future(reader.read(1)) # 客户端断开时完成
+        try:
+            while True:
+                matches = self._records_after(cursor, user_memo)
+                if matches:
+                    await self._respond(writer, "200 OK", {
+                        "status": "success",
+                        "records": [record for _, record in matches],
+                        "next_cursor": matches[-1][0],
+                    })
+                    return
+                cursor = max(cursor, self._latest_id)
+                remaining = deadline - self._loop.time()
+                state = await self._wait_changed(closed, remaining) if remaining > 0 else "timeout"
+                if state == "closed":
+                    return
+                if state == "timeout":
+                    await self._respond(writer, "200 OK", {"status": "timeout", "records": [], "next_cursor": cursor})
+                    return
+        finally:
+            closed.cancel()
+
+    async def _stream_payments(self, reader, writer, args, headers):
+        """与 API 的 /stream_payments 相同的参数和事件格式"""
+        last_event_id = headers.get("last-event-id") or args.get("last_event_id")
+        try:
+            cursor = int(last_event_id) if last_event_id else self._latest_id
+        except ValueError:
+            await self._respond(writer, "400 Bad Request", {"status": "error", "message": "Invalid Last-Event-ID"})
+            return
+        user_memo = args.get("user_memo")
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream; charset=utf-8\r\nCache-Control: no-cache\r\n"
+                     b"X-Accel-Buffering: no\r\nAccess-Control-Allow-Origin: *\r\nConnection: close\r\n\r\nretry: 3000\n\n")
+        await writer.drain()
+        closed = asyncio.ensure_future(reader.read(1))
+        try:
+            while True:
+                matches = self._records_after(cursor, user_memo)
+                for record_id, record in matches:
+                    cursor = record_id
+                    writer.write(f"id: {record_id}\nevent: payment\ndata: {json.dumps(record, ensure_ascii=False)}\n\n".encode("utf-8"))
+                if matches:
+                    await writer.drain()
+                    continue
+                cursor = max(cursor, self._latest_id)
+                state = await self._wait_changed(closed, SSE_KEEPALIVE_INTERVAL)
+                if state == "closed":
+                    return
+                if state == "timeout":
+                    writer.write(b": keep-alive\n\n")
+                    await writer.drain()
+        finally:
+            closed.cancel()
+
+_push_server = None
+
+def start_push_server(host=API_HOST, port=PUSH_PORT):
+    """启动推送服务 (进程内只启动一次)，返回 PushServer"""
+    global _push_server
+    if _push_server is None:
+        _push_server = PushServer(host, port).start()
+    return _push_server
+
+def create_app():
+    """
+    WSGI 入口 (gunicorn 'Dty:create_app()')。不经过 run_flask_app 时在这里启动 webhook 投递线程，
+    上次未送达的 webhook 不必等到下一个订单登记或支付才重试。
+    """
+    get_webhook_worker()
+    return app
+
 # --- run_flask_app 函数 ---
-def run_flask_app():
-    """运行Flask应用"""
-    # 注意：host='0.0.0.0' 使其对外网可见，生产环境需谨慎
+def run_flask_app(host=API_HOST, port=API_PORT, threads=API_THREADS, server=API_SERVER, push_port=PUSH_PORT):
+    """
+    运行Flask应用 (阻塞)。
+    :param server: 'waitress' / 'werkzeug' (Flask 开发服务器) / 'auto' (有 waitress 时用 waitress)
+    :param push_port: 推送服务端口，0 表示不启动
+    """
+    if server == 'waitress' and waitress is None:
+        raise RuntimeError("未安装 waitress，请先 pip install waitress")
+    get_webhook_worker() # 继续投递上次未送达的订单 webhook
+    if push_port:
+        try:
+            start_push_server(host, push_port)
+        except OSError as e:
+            logger.warning(f"{e}，只在 API 端口提供推送接口")
+    if server in ('auto', 'waitress') and waitress is not None:
+        if payment_broadcaster.max_subscribers >= threads:
+            logger.warning(f"API_PUSH_MAX_SUBSCRIBERS ({payment_broadcaster.max_subscribers}) 不小于 API 线程数 ({threads})，"
+                           f"API 端口上的推送连接可能占满线程导致收款回调超时")
+        logger.info(f"API 服务器 (waitress, {threads} 线程) 监听 http://{host}:{port}")
+        waitress.serve(app, host=host, port=port, threads=threads)
+        return
+    if server == 'auto':
+        logger.warning("未安装 waitress，使用 Flask 开发服务器运行 API (pip install waitress 可获得更稳定的延迟)")
+    else:
+        logger.info(f"API 服务器 (Flask 开发服务器) 监听 http://{host}:{port}")
     # debug=False 避免与主GUI线程冲突，并防止代码重载带来的问题
-    app.run(host='0.0.0.0', port=5001, debug=False)
+    app.run(host=host, port=port, debug=False, threaded=True)
+
+def start_api_thread(args):
+    """在后台线程中启动 API 服务器 (与监控同一进程)"""
+    threading.Thread(target=run_flask_app, name="api", daemon=True,
+                     args=(args.api_host, args.api_port, args.api_threads, args.api_server, args.push_port)).start()
+    logger.info(f"Flask API服务器线程已在 http://{args.api_host}:{args.api_port} 启动")
+
+def start_metrics_server(host=API_HOST, port=API_PORT + 1):
+    """
+    在后台线程中单独提供 /metrics。API 放在 --api-only 进程时，截图/OCR/投递指标只存在于监控进程中，
+    监控进程 (--no-api) 用它暴露自己的指标。返回 server，可调用 server.shutdown() 停止。
+    """
+    from werkzeug.serving import make_server # Flask 自带的依赖
+    metrics_app = Flask("metrics")
+    metrics_app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
+    server = make_server(host, port, metrics_app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"监控进程的运行指标已在 http://{host}:{port}/metrics 提供")
+    return server
+
+def benchmark_api(url, concurrency=16, total=2000):
+    """
+    用 concurrency 个线程并发请求 url (通常是 /query_payment)，测量吞吐与延迟。
+    :return: {"requests", "errors", "seconds", "requests_per_second", "p50_ms", "p95_ms", "p99_ms"}
+    """
+    local = threading.local()
+
+    def one_request(_):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session() # 每个线程一个 keep-alive 连接
+        start = time.perf_counter()
+        try:
+            ok = session.get(url, timeout=DELIVERY_TIMEOUT).status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        return (time.perf_counter() - start) * 1000, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bench-api") as executor:
+        results = list(executor.map(one_request, range(total)))
+    elapsed = time.perf_counter() - started
+    latencies = sorted(ms for ms, _ in results)
+    return {
+        "requests": total,
+        "errors": sum(1 for _, ok in results if not ok),
+        "seconds": elapsed,
+        "requests_per_second": total / elapsed if elapsed else 0.0,
+        "p50_ms": _percentile(latencies, 0.5),
+        "p95_ms": _percentile(latencies, 0.95),
+        "p99_ms": _percentile(latencies, 0.99),
+    }
+
+def parse_region(region_str):
+    """把 '左,顶,宽,高' 字符串解析为 mss 区域字典"""
+    left, top, width, height = map(int, region_str.split(','))
+    return {"left": left, "top": top, "width": width, "height": height}
+
+def parse_monitor_region(region_str, index=1):
+    """把 '[名称=]左,顶,宽,高' 字符串解析为 MonitorRegion，未写名称时按序号命名"""
+    name, sep, coords = region_str.rpartition('=')
+    m = parse_region(coords)
+    return MonitorRegion(name.strip() if sep and name.strip() else f"区域{index}",
+                         m["left"], m["top"], m["width"], m["height"])
+
+def run_gui(args):
+    """创建并运行GUI主窗口 (阻塞到窗口关闭)"""
+    global notification_window_instance
+    try:
+        window = NotificationWindow(record_dir=args.record)
+    except ImportError:
+        raise SystemExit("界面需要 tkinter，没有图形环境时请使用 --headless 运行")
+    # 将GUI实例赋给全局变量，供Flask API访问 (虽然目前未使用)
+    notification_window_instance = window
+    window.root.protocol("WM_DELETE_WINDOW", window.on_closing) # 绑定关闭事件
+    logger.info("GUI应用程序已启动。")
+    window.root.mainloop()
+
+def run_headless(args):
+    """无界面模式：直接运行监控引擎，Ctrl+C 或 SIGTERM 停止"""
+    if args.region:
+        regions = [parse_monitor_region(r, i) for i, r in enumerate(args.region, 1)]
+    else:
+        regions = [MonitorRegion.from_config(cfg) for cfg in MONITOR_REGIONS]
+    if not regions:
+        raise SystemExit("无界面模式需要至少一个 --region 或在 MONITOR_REGIONS 中配置监控区域")
+
+    engine = MonitorEngine(regions=regions, batch_mode=args.batch, record_dir=args.record)
+
+    def on_event(event, data):
+        # 日志已经由引擎写入 logger，这里只补充投递结果
+        if event == "payment":
+            logger.info(f"收款通知已送达: {data.get('account')} ¥{data.get('amount')} ({data.get('order_id')})")
+    engine.add_listener(on_event)
+
+    if not args.no_api:
+        start_api_thread(args)
+    elif args.metrics_port:
+        start_metrics_server(args.api_host, args.metrics_port)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: engine.request_stop())
+    try:
+        engine.start(args.callback, args.min_interval, args.max_interval)
+        engine.wait()
+    except KeyboardInterrupt:
+        logger.info("收到中断信号，正在停止监控...")
+    finally:
+        engine.close(timeout=5)
+    logger.info("无界面模式已退出。")
+
+def build_arg_parser():
+    """命令行参数"""
+    parser = argparse.ArgumentParser(description="Dty 微信收款OCR监听器")
+    parser.add_argument("--bench-capture", action="store_true", help="运行截图转换路径的基准测试后退出")
+    parser.add_argument("--log-level", default=LOG_LEVEL if LOG_LEVEL.strip().upper() in LOG_LEVELS else "INFO",
+                        type=str.upper, choices=LOG_LEVELS, help="日志级别 (默认 INFO)")
+    parser.add_argument("--headless", action="store_true", help="不启动图形界面，直接运行监控引擎")
+    parser.add_argument("--region", action="append", metavar="[名称=]左,顶,宽,高",
+                        help="监控区域，可重复指定多个 (基准测试只使用第一个，默认 0,0,400,300)")
+    parser.add_argument("--callback", default=DEFAULT_CALLBACK_URL, help="无界面模式的回调URL")
+    parser.add_argument("--min-interval", type=float, default=POLL_MIN_INTERVAL, help="无界面模式的最短轮询间隔(秒)")
+    parser.add_argument("--max-interval", type=float, default=POLL_MAX_INTERVAL, help="无界面模式的最长轮询间隔(秒)")
+    parser.add_argument("--batch", action="store_true", default=DELIVERY_BATCH_MODE, help="无界面模式使用批量投递")
+    parser.add_argument("--no-api", action="store_true", help="不在本进程启动内置 Flask API 服务器 (API 由 --api-only 进程提供时使用)")
+    parser.add_argument("--api-only", action="store_true", help="只运行 API 服务器 (独立进程，不监控屏幕)")
+    parser.add_argument("--api-server", default=API_SERVER, choices=["auto", "waitress", "werkzeug"], help="API 使用的服务器")
+    parser.add_argument("--api-host", default=API_HOST, help="API 监听地址")
+    parser.add_argument("--api-port", type=int, default=API_PORT, help="API 监听端口")
+    parser.add_argument("--api-threads", type=int, default=API_THREADS, help="waitress 工作线程数")
+    parser.add_argument("--push-port", type=int, default=PUSH_PORT, help="推送服务 (asyncio) 端口，0 表示不启动")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                        help="与 --no-api 一起使用: 在该端口单独提供本进程的 /metrics (截图/OCR/投递指标)")
+    parser.add_argument("--bench-api", metavar="URL", nargs="?", const=f"http://127.0.0.1:{API_PORT}/query_payment?limit=100",
+                        help="并发请求 API 测量吞吐和延迟后退出 (默认 /query_payment?limit=100)")
+    parser.add_argument("--concurrency", type=int, default=16, help="API 基准测试的并发数")
+    parser.add_argument("--requests", type=int, default=2000, help="API 基准测试的请求总数")
+    parser.add_argument("--rules", metavar="FILE", help=f"识别规则文件 (JSON，默认 {RULES_FILE}，不存在时使用内置规则)")
+    parser.add_argument("--record", metavar="DIR", help="录制模式: 把识别过的帧、OCR文本和解析结果保存到目录")
+    parser.add_argument("--replay", metavar="DIR", help="回放录制的帧目录，输出吞吐、各阶段耗时和字段准确率后退出")
+    parser.add_argument("--replay-callback", metavar="URL", help="回放时的回调地址 (默认发往本地桩服务)")
+    parser.add_argument("--frames", type=int, default=50, help="基准测试每种路径测量的帧数")
+    parser.add_argument("--bench-parse", metavar="DIR", help="对目录中保存的OCR文本 (*.txt) 运行解析器基准测试后退出")
+    parser.add_argument("--repeat", type=int, default=100, help="解析器基准测试的重复次数")
+    parser.add_argument("--bench-preprocess", metavar="DIR",
+                        help="用目录中的截图 (*.png) 与对应的期望文本 (同名 .txt) 比较各预处理配置的准确率和耗时后退出")
+    return parser
 
 # --- 主程序入口 ---
 if __name__ == "__main__":
-    # 启动Flask API服务器线程
-    flask_thread = threading.Thread(target=run_flask_app, daemon=True)
-    flask_thread.start()
-    logger.info("Flask API服务器线程已在 http://0.0.0.0:5001 启动")
-
-    # 创建并运行GUI主窗口
-    root = NotificationWindow()
-    # 将GUI实例赋给全局变量，供Flask API访问 (虽然目前未使用)
-    notification_window_instance = root
-    root.protocol("WM_DELETE_WINDOW", root.on_closing) # 绑定关闭事件
-    logger.info("GUI应用程序已启动。")
-    root.mainloop()
+    args = build_arg_parser().parse_args()
+    configure_logging(args.log_level)
 
+    if args.rules:
+        if not os.path.exists(args.rules):
+            sys.exit(f"规则文件不存在: {args.rules}")
+        try:
+            receipt_parser.rules = load_receipt_rules(args.rules)
+        except (OSError, ValueError) as e:
+            sys.exit(f"加载识别规则失败: {e}")
+
+    if args.bench_capture:
+        region_str = args.region[0].rpartition('=')[2] if args.region else "0,0,400,300"
+        results = benchmark_capture(parse_region(region_str), frames=args.frames)
+        for name, stats in results.items():
+            print(f"{name:>14}: 平均 {stats['mean_ms']:.2f} ms | p50 {stats['p50_ms']:.2f} ms | p95 {stats['p95_ms']:.2f} ms")
+        sys.exit(0)
+
+    if args.bench_preprocess:
+        samples = []
+        for name in sorted(os.listdir(args.bench_preprocess)):
+            base, ext = os.path.splitext(name)
+            truth_path = os.path.join(args.bench_preprocess, base + ".txt")
+            if ext.lower() == ".png" and os.path.exists(truth_path):
+                with open(truth_path, encoding="utf-8") as f:
+                    samples.append((Image.open(os.path.join(args.bench_preprocess, name)).convert("RGB"), f.read()))
+        print(f"共 {len(samples)} 张样本")
+        engine = create_ocr_engine()
+        engine.warm_up()
+        for name, stats in benchmark_preprocessing(samples, engine).items():
+            print(f"{name:<16} 准确率 {stats['accuracy'] * 100:6.2f}% | 预处理 {stats['preprocess_ms']:7.2f} ms | OCR {stats['ocr_ms']:8.2f} ms")
+        engine.close()
+        sys.exit(0)
+
+    if args.replay:
+        engine = create_ocr_engine()
+        engine.warm_up()
+        report = replay_frames(args.replay, engine, callback_url=args.replay_callback)
+        engine.close()
+        print(f"回放 {report['frames']} 帧耗时 {report['seconds']:.2f} s，{report['frames_per_second']:.2f} 帧/秒")
+        for stage, stats in report["stages"].items():
+            print(f"{stage:>10}: {stats['count']:5d} 次 | p50 {stats['p50_ms']:8.2f} ms | p99 {stats['p99_ms']:8.2f} ms")
+        print(f"识别到收款 {report['payments']} 笔，去重 {report['duplicates']} 笔，投递成功 {report['delivered']} 笔")
+        if report["labelled"]:
+            accuracy = " | ".join(f"{name} {value * 100:.1f}%" for name, value in report["accuracy"].items())
+            print(f"{report['labelled']} 帧有标注，卡片数正确 {report['card_count_accuracy'] * 100:.1f}%")
+            print(f"字段准确率 ({report['labelled_cards']} 张卡片): {accuracy}")
+        sys.exit(0)
+
+    if args.bench_parse:
+        texts = []
+        for name in sorted(os.listdir(args.bench_parse)):
+            if name.endswith(".txt"):
+                with open(os.path.join(args.bench_parse, name), encoding="utf-8") as f:
+                    texts.append(f.read())
+        result = benchmark_parser(texts, repeat=args.repeat)
+        print(f"解析 {result['texts']} 段文本耗时 {result['seconds']:.3f} s，"
+              f"{result['texts_per_second']:.0f} 段/秒，其中收款通知 {result['payments']} 段")
+        sys.exit(0)
+
+    if args.bench_api:
+        result = benchmark_api(args.bench_api, concurrency=args.concurrency, total=args.requests)
+        print(f"{result['requests']} 个请求 ({args.concurrency} 并发) 耗时 {result['seconds']:.2f} s，"
+              f"{result['requests_per_second']:.0f} 请求/秒，失败 {result['errors']} 个")
+        print(f"延迟 p50 {result['p50_ms']:.2f} ms | p95 {result['p95_ms']:.2f} ms | p99 {result['p99_ms']:.2f} ms")
+        sys.exit(0)
+
+    if args.api_only:
+        # 独立的 API 进程：与监控进程共享 payments.db (WAL 模式支持多进程读写)，不受 OCR 占用 GIL 的影响
+        run_flask_app(args.api_host, args.api_port, args.api_threads, args.api_server, args.push_port)
+        sys.exit(0)
+
+    if args.headless:
+        run_headless(args)
+        sys.exit(0)
+
+    # 启动Flask API服务器线程 (API 在独立进程中运行时用 --no-api 跳过)
+    if not args.no_api:
+        start_api_thread(args)
+    elif args.metrics_port:
+        start_metrics_server(args.api_host, args.metrics_port)
+
+    run_gui(args)
     logger.info("应用程序关闭完成。")
@@ -0,0 +1,16 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def dty(tmp_path_factory):
+    """导入 Dty。导入时会在当前目录创建 payments.db、app.log 等文件，所以先切换到临时目录"""
+    os.chdir(tmp_path_factory.mktemp("dty"))
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    return importlib.import_module("Dty")
@@ -0,0 +1,55 @@
+def _card(amount, memo, index=1, total=None):
+    """微信 "收款到账通知" 卡片的实际版面: 标题在第一行，"收款成功" 在末尾的备注中"""
+    return (f"收款到账通知\n收款金额 ¥{amount}\n付款方备注 {memo}\n"
+            f"汇总 今日第{index}笔收款，共计¥{total or amount}\n备注 收款成功，已存入零钱")
+
+
+def _parse(dty, text):
+    return [(f.amount, f.user_memo, f.daily_index) for _, f in dty.receipt_parser.parse_all(text)]
+
+
+def test_single_card(dty):
+    assert _parse(dty, _card("12.00", "A001")) == [("12.00", "A001", 1)]
+
+
+def test_two_cards_keep_their_own_fields(dty):
+    text = _card("12.00", "A001") + "\n10:31\n" + _card("3.50", "B002", index=2, total="15.50")
+    assert _parse(dty, text) == [("12.00", "A001", 1), ("3.50", "B002", 2)]
+
+
+def test_truncated_card_above_first_title_is_ignored(dty):
+    text = "汇总 今日第1笔收款，共计¥12.00\n备注 收款成功，已存入零钱\n" + _card("3.50", "B002", index=2)
+    assert _parse(dty, text) == [("3.50", "B002", 2)]
+
+
+def test_card_without_recognised_title(dty):
+    text = _card("12.00", "A001").replace("收款到账通知", "收款到帐涌知") # 标题识别错误时整段文本作为一张卡片
+    assert _parse(dty, text) == [("12.00", "A001", 1)]
+
+
+def test_excluded_card_is_dropped(dty):
+    text = _card("12.00", "A001") + "\n自动续费\n扣费金额 ¥30.00\n" + _card("3.50", "B002", index=2)
+    assert _parse(dty, text) == [("12.00", "A001", 1), ("3.50", "B002", 2)]
+    assert not dty.receipt_parser.parse("自动续费\n扣费金额 ¥30.00\n扣费成功").is_payment
+
+
+def test_exclude_keyword_inside_field_value(dty):
+    (card, fields), = dty.receipt_parser.parse_all(_card("10.00", "退款单1"))
+    assert fields.is_payment and fields.user_memo == "退款单1"
+
+
+def test_amount_hints_only_applied_when_card_counts_match(dty):
+    text = _card("10.00", "a") + "\n" + _card("3.50", "b", index=2)
+    cards = dty.parse_recognition(dty.RecognitionResult(text, ["11.00", None]))
+    assert [f.amount for _, f in cards] == ["11.00", "3.50"]
+    cards = dty.parse_recognition(dty.RecognitionResult(text, ["11.00"]))
+    assert [f.amount for _, f in cards] == ["10.00", "3.50"]
+
+
+def test_card_lines_follow_parser_split(dty):
+    text = "汇总 旧卡片\n" + _card("10.00", "a") + "\n自动续费\n扣费金额 ¥30.00\n" + _card("3.50", "b", index=2)
+    lines = [dty.OCRLine(line, 0, 0, 0, 0, []) for line in text.split("\n")]
+    groups = dty.ReceiptRegionRecognizer()._split_card_lines(lines)
+    assert [[line.text for line in group][:2] for group in groups] == [
+        ["收款到账通知", "收款金额 ¥10.00"], ["收款到账通知", "收款金额 ¥3.50"]]
+    assert all(not line.text.startswith("扣费") for group in groups for line in group)
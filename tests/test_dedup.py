@@ -0,0 +1,61 @@
+import time
+
+
+def test_dedup_index_expires_per_key(dty):
+    index = dty.DedupIndex(ttl=60)
+    assert index.add_if_absent("long")
+    assert index.add_if_absent("short", ttl=0.05)
+    assert not index.add_if_absent("short")
+    time.sleep(0.1)
+    assert index.add_if_absent("short") # 短保留时间的键过期，长保留时间的键仍在
+    assert not index.add_if_absent("long")
+    index.discard("long")
+    assert index.add_if_absent("long")
+
+
+def test_dedup_index_evicts_oldest(dty):
+    index = dty.DedupIndex(ttl=60, max_entries=2)
+    for key in ("a", "b", "c"):
+        index.add_if_absent(key)
+    assert len(index) == 2
+    assert index.add_if_absent("a") and not index.add_if_absent("c")
+
+
+def test_dedup_key_ignores_ocr_noise(dty):
+    key = dty.payment_dedup_key("10", "2026-10-18 9:00:00", "a b", account="A")
+    assert key == dty.payment_dedup_key("10.00", "2026/10/18 09:00:00", "ab", account="A")
+    # 只有时分秒时不补日期，跨过午夜重新识别同一张卡片得到同一个键
+    assert dty.payment_dedup_key("10", "23:59:58", "m") == "|10.00|23:59:58|m"
+
+
+def test_daily_index_distinguishes_equal_payments(dty):
+    first = dty.payment_dedup_key("10", None, None, daily_index=3, today="2026-10-18")
+    assert first == "|10.00|||2026-10-18#3"
+    assert first != dty.payment_dedup_key("10", None, None, daily_index=4, today="2026-10-18")
+    assert first != dty.payment_dedup_key("10", None, None, daily_index=3, today="2026-10-19")
+
+
+def test_weak_keys_use_short_ttl_and_fresh_order_ids(dty):
+    counted = dty.ReceiptFields(True, "10.00", None, None, daily_index=2)
+    full = dty.ReceiptFields(True, "10.00", "2026-10-18 09:00:01", None)
+    for fields in (counted, full):
+        key = dty.fields_dedup_key(fields)
+        assert dty.detected_dedup_ttl(fields) == dty.DEDUP_TTL
+        assert dty.detected_order_id(fields, key) == dty.detected_order_id(fields, key)
+    for payment_time in (None, "09:00:01", "2026-10-18 09:00"):
+        weak = dty.ReceiptFields(True, "10.00", payment_time, None)
+        key = dty.fields_dedup_key(weak)
+        assert dty.detected_dedup_ttl(weak) == dty.DEDUP_WEAK_TTL
+        assert dty.detected_order_id(weak, key) != dty.detected_order_id(weak, key)
+
+
+def test_build_payment_data_never_reuses_order_id(dty):
+    fields = dty.ReceiptFields(True, "10.00", None, None)
+    ids = {dty.build_payment_data(fields, "")["order_id"] for _ in range(3)}
+    assert len(ids) == 3
+
+
+def test_parser_reads_daily_index(dty):
+    text = "收款到账通知\n收款金额 ¥12.00\n付款方备注 A001\n汇总 今日第 3 笔收款，共计¥36.00\n备注 收款成功，已存入零钱"
+    fields = dty.receipt_parser.parse(text)
+    assert (fields.amount, fields.user_memo, fields.daily_index) == ("12.00", "A001", 3)
@@ -0,0 +1,32 @@
+def _frame(width, height, value=0):
+    return bytearray([value]) * (width * height * 4)
+
+
+def test_first_frame_is_changed(dty):
+    detector = dty.FrameChangeDetector(tile_rows=2, tile_cols=2, row_step=1)
+    assert detector.has_changed(_frame(8, 8), 8, 8)
+    assert detector.changed_tiles == [0, 1, 2, 3]
+
+
+def test_identical_frame_is_skipped(dty):
+    detector = dty.FrameChangeDetector(tile_rows=2, tile_cols=2, row_step=1)
+    detector.has_changed(_frame(8, 8), 8, 8)
+    assert not detector.has_changed(_frame(8, 8), 8, 8)
+    assert detector.changed_tiles == []
+
+
+def test_changed_pixel_marks_its_tile(dty):
+    detector = dty.FrameChangeDetector(tile_rows=2, tile_cols=2, row_step=1)
+    detector.has_changed(_frame(8, 8), 8, 8)
+    raw = _frame(8, 8)
+    raw[(6 * 8 + 5) * 4] = 255 # 第6行第5列 -> 右下角的块
+    assert detector.has_changed(raw, 8, 8)
+    assert detector.changed_tiles == [3]
+
+
+def test_size_change_and_reset(dty):
+    detector = dty.FrameChangeDetector(tile_rows=2, tile_cols=2, row_step=1)
+    detector.has_changed(_frame(8, 8), 8, 8)
+    assert detector.has_changed(_frame(8, 4), 8, 4)
+    detector.reset()
+    assert detector.has_changed(_frame(8, 4), 8, 4)
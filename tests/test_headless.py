@@ -0,0 +1,13 @@
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+
+
+def test_import_without_tkinter(tmp_path):
+    """无界面模式和 API 进程不需要 tkinter：屏蔽 tkinter 后模块仍能导入"""
+    code = "import sys; sys.modules['tkinter'] = None; import Dty; assert Dty.tk is None"
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    result = subprocess.run([sys.executable, "-c", code], cwd=tmp_path, env=env, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,59 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from conftest import ROOT
+
+
+@pytest.fixture
+def registry(dty, tmp_path):
+    return dty.OrderRegistry(str(tmp_path / "payments.db"))
+
+
+def _payment(memo, amount, order_id="p1"):
+    return {"order_id": order_id, "user_memo": memo, "actual_amount": amount}
+
+
+def test_register_is_idempotent_and_validates(registry):
+    order, created = registry.register("memo", "12.5", order_no="o1")
+    assert created and order["status"] == "pending" and order["amount"] == "12.50"
+    again, created = registry.register("memo", "99", order_no="o1")
+    assert not created and again["amount"] == "12.50"
+    for memo, amount in [("", "1"), ("memo", "0"), ("memo", "abc")]:
+        with pytest.raises(ValueError):
+            registry.register(memo, amount)
+
+
+def test_match_pays_earliest_order_once(registry):
+    registry.register("memo", "5", order_no="first")
+    registry.register("memo", "5.00", order_no="second")
+    assert registry.match(_payment(" me mo ", "5.0"))["order_no"] == "first" # 备注去空白、金额规范化后匹配
+    paid = registry.match(_payment("memo", "5", order_id="p2"))
+    assert paid["order_no"] == "second" and paid["payment_order_id"] == "p2"
+    assert registry.match(_payment("memo", "5")) is None
+    assert registry.get("first")["status"] == "paid" and registry.pending_count() == 0
+
+
+def test_expired_order_is_not_matched(registry):
+    registry.register("memo", "1", ttl=0.05, order_no="late")
+    time.sleep(0.1)
+    assert registry.match(_payment("memo", "1")) is None
+    assert registry.get("late")["status"] == "expired"
+
+
+def test_pending_orders_survive_restart(dty, registry, tmp_path):
+    registry.register("memo", "2", order_no="kept")
+    reopened = dty.OrderRegistry(str(tmp_path / "payments.db"))
+    assert reopened.match(_payment("memo", "2"))["order_no"] == "kept"
+
+
+def test_import_does_not_start_webhook_worker(tmp_path):
+    """导入模块 (测试、压测工具、WSGI 加载) 不启动投递线程，也不创建 webhooks.db"""
+    code = ("import os, Dty; assert Dty._webhook_worker is None and not os.path.exists(Dty.WEBHOOK_OUTBOX_DB_PATH); "
+            "Dty.create_app(); assert Dty._webhook_worker is not None")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    result = subprocess.run([sys.executable, "-c", code], cwd=tmp_path, env=env, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,105 @@
+import sqlite3
+import threading
+
+import pytest
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+
+@pytest.fixture
+def callback_server():
+    """本地回调桩服务: responses[路径] 为 (状态码, 返回的 JSON)，received 记录收到的请求体"""
+    app = Flask("callback_stub")
+    responses, received = {}, []
+
+    @app.route("/<path:path>", methods=["POST"])
+    def handler(path):
+        received.append((path, request.get_json(force=True, silent=True)))
+        status, body = responses.get(path, (200, {"status": "success"}))
+        return jsonify(body), status
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}", responses, received
+    server.shutdown()
+
+
+@pytest.fixture
+def outbox(dty, tmp_path):
+    box = dty.PaymentOutbox(str(tmp_path / "outbox.db"))
+    yield box
+    box.close()
+
+
+def _attempts(outbox):
+    return outbox._conn.execute("SELECT attempts, dead_at IS NOT NULL FROM outbox ORDER BY id").fetchall()
+
+
+def test_delivered_row_is_removed(dty, outbox, callback_server):
+    base, _, received = callback_server
+    outbox.enqueue(base + "/receive_payment", {"order_id": "a"})
+    worker = dty.DeliveryWorker(outbox)
+    for item in outbox.due():
+        worker._deliver(*item)
+    assert received == [("receive_payment", {"order_id": "a"})]
+    assert outbox.pending_count() == 0
+
+
+def test_rejected_notification_is_dead_lettered(dty, outbox, callback_server):
+    base, responses, _ = callback_server
+    responses["receive_payment"] = (400, {"status": "error"})
+    outbox.enqueue(base + "/receive_payment", {"order_id": "bad"})
+    worker = dty.DeliveryWorker(outbox)
+    for item in outbox.due():
+        worker._deliver(*item)
+    assert outbox.due() == []
+    assert outbox.pending_count() == 0 and outbox.dead_count() == 1
+    assert outbox.seconds_until_next_due() is None
+
+
+def test_server_error_is_retried_until_max_attempts(dty, outbox, callback_server, monkeypatch):
+    base, responses, _ = callback_server
+    responses["receive_payment"] = (503, {"status": "error"})
+    monkeypatch.setattr(dty, "DELIVERY_MAX_ATTEMPTS", 2)
+    row_id = outbox.enqueue(base + "/receive_payment", {"order_id": "retry"})
+    worker = dty.DeliveryWorker(outbox)
+    worker._deliver(row_id, base + "/receive_payment", {"order_id": "retry"}, 0)
+    assert _attempts(outbox) == [(1, 0)]
+    assert outbox.seconds_until_next_due() > 0
+    worker._deliver(row_id, base + "/receive_payment", {"order_id": "retry"}, 1)
+    assert _attempts(outbox) == [(2, 1)]
+
+
+@pytest.mark.parametrize("body", [[], "ok", {"status": "success"}, {"results": ["success"]}])
+def test_malformed_batch_response_is_rescheduled(dty, outbox, callback_server, body):
+    base, responses, _ = callback_server
+    responses["receive_payments"] = (200, body)
+    for order_id in ("a", "b"):
+        outbox.enqueue(base + "/receive_payment", {"order_id": order_id})
+    worker = dty.DeliveryWorker(outbox, batch_mode=True)
+    worker._deliver_batches(outbox.due())
+    assert _attempts(outbox) == [(1, 0), (1, 0)]
+
+
+def test_batch_results_are_applied_per_item(dty, outbox, callback_server):
+    base, responses, received = callback_server
+    responses["receive_payments"] = (200, {"results": [{"status": "success"}, {"status": "error"}]})
+    for order_id in ("a", "b"):
+        outbox.enqueue(base + "/receive_payment", {"order_id": order_id})
+    worker = dty.DeliveryWorker(outbox, batch_mode=True)
+    worker._deliver_batches(outbox.due())
+    assert received == [("receive_payments", {"payments": [{"order_id": "a"}, {"order_id": "b"}]})]
+    assert _attempts(outbox) == [(1, 0)]
+
+
+def test_old_outbox_gets_dead_letter_column(dty, tmp_path):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT NOT NULL, payload TEXT NOT NULL, "
+                 "attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at REAL NOT NULL, created_at REAL NOT NULL, last_error TEXT)")
+    conn.execute("INSERT INTO outbox (url, payload, next_attempt_at, created_at) VALUES ('http://x', '{}', 0, 0)")
+    conn.commit()
+    conn.close()
+    box = dty.PaymentOutbox(path)
+    assert box.pending_count() == 1 and len(box.due()) == 1
+    box.close()
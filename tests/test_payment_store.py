@@ -0,0 +1,72 @@
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def store(dty, tmp_path):
+    return dty.PaymentStore(str(tmp_path / "payments.db"))
+
+
+def _record(order_id, amount="10.00", memo="m", payment_time="2026-10-18 09:00:00"):
+    return {"order_id": order_id, "actual_amount": amount, "payment_time": payment_time,
+            "payer_memo": "", "user_memo": memo, "account": "A"}
+
+
+def test_insert_and_lookup(store):
+    assert store.last_id() == 0
+    first = store.insert(_record("o1"))
+    second = store.insert(_record("o2", amount="3.50"))
+    assert second > first == 1 and store.last_id() == second
+    assert store.find_by_order_id("o2")["amount_cents"] == 350
+    assert store.find_by_order_id("missing") is None
+
+
+def test_process_payment_is_idempotent(dty):
+    order_id = f"test_{uuid.uuid4().hex}"
+    data = {"order_id": order_id, "amount": "12.5", "user_memo": "idem", "timestamp": 1760749200}
+    record, is_new = dty.process_payment(data)
+    assert is_new and record["actual_amount"] == "12.50"
+    again, is_new = dty.process_payment(dict(data))
+    assert not is_new and again["order_id"] == order_id
+    assert len(dty.payment_store.query(order_id=order_id)[0]) == 1
+
+
+def test_payment_without_order_id_gets_stable_id(dty):
+    data = {"amount": "1.00", "user_memo": f"memo_{uuid.uuid4().hex}", "timestamp": 1760749200}
+    record, is_new = dty.process_payment(dict(data))
+    again, is_new_again = dty.process_payment(dict(data))
+    assert is_new and not is_new_again
+    assert record["order_id"] == again["order_id"]
+
+
+def test_cursor_pagination(store):
+    for index in range(5):
+        store.insert(_record(f"p{index}", memo="page" if index % 2 == 0 else "other"))
+    records, total, cursor = store.query(user_memo="page", limit=2)
+    assert [r["order_id"] for r in records] == ["p0", "p2"] and total is None
+    records, total, cursor = store.query(user_memo="page", limit=2, cursor=cursor, with_total=True)
+    assert [r["order_id"] for r in records] == ["p4"] and total == 3
+    assert store.query(since="2026-10-19")[0] == []
+
+
+@pytest.mark.parametrize("query", ["limit=abc", "limit=", "limit=0", "limit=-1", "cursor=x", "cursor=", "limit=10&cursor=1.5"])
+def test_query_rejects_malformed_paging(dty, query):
+    response = dty.app.test_client().get(f"/query_payment?{query}")
+    assert response.status_code == 400
+
+
+def test_query_limit_is_clamped(dty, monkeypatch):
+    memo = f"clamp_{uuid.uuid4().hex}"
+    for index in range(3):
+        dty.payment_store.insert(_record(f"{memo}_{index}", memo=memo))
+    monkeypatch.setattr(dty, "QUERY_MAX_LIMIT", 2)
+    body = dty.app.test_client().get(f"/query_payment/{memo}?limit=1000").get_json()
+    assert len(body["records"]) == 2 and body["next_cursor"] is not None
+    assert "total_count" not in body
+
+
+def test_records_gauge_follows_store(dty):
+    record_id = dty.payment_store.insert(_record(f"gauge_{uuid.uuid4().hex}"))
+    body = dty.app.test_client().get("/metrics").get_data(as_text=True)
+    assert f"dty_payment_records {record_id}" in body.splitlines()
@@ -0,0 +1,80 @@
+import socket
+import threading
+import time
+
+import pytest
+import requests
+
+
+def _record(order_id, memo="m"):
+    return {"order_id": order_id, "actual_amount": "1.00", "payment_time": "2026-10-18 09:00:00",
+            "payer_memo": "", "user_memo": memo, "account": "A"}
+
+
+@pytest.fixture
+def push(dty, tmp_path):
+    """独立的存储、通知器和推送服务 (随机端口)"""
+    store = dty.PaymentStore(str(tmp_path / "payments.db"))
+    broadcaster = dty.PaymentBroadcaster(store.last_id())
+    server = dty.PushServer("127.0.0.1", 0, store=store, broadcaster=broadcaster, recent_records=2).start()
+
+    def pay(order_id, memo="m"):
+        broadcaster.publish(store.insert(_record(order_id, memo)))
+
+    yield server, store, pay
+    server.stop()
+
+
+def test_publish_calls_listeners(dty):
+    broadcaster = dty.PaymentBroadcaster()
+    seen = []
+    broadcaster.add_listener(seen.append)
+    broadcaster.publish(3)
+    assert seen == [3] and broadcaster.latest_id == 3
+    assert broadcaster.max_subscribers == dty.API_PUSH_MAX_SUBSCRIBERS
+
+
+def test_wait_payment_wakes_on_publish(push):
+    server, _, pay = push
+    threading.Timer(0.2, pay, args=("w1", "waiting")).start()
+    started = time.monotonic()
+    body = requests.get(f"http://127.0.0.1:{server.port}/wait_payment",
+                        params={"user_memo": "waiting", "timeout": 10}, timeout=15).json()
+    assert body["status"] == "success" and [r["order_id"] for r in body["records"]] == ["w1"]
+    assert time.monotonic() - started < 5
+    deadline = time.monotonic() + 2
+    while server.subscribers and time.monotonic() < deadline: # 名额在响应发出后释放
+        time.sleep(0.01)
+    assert server.subscribers == 0
+
+
+def test_wait_payment_timeout_and_bad_params(push):
+    server, _, _ = push
+    url = f"http://127.0.0.1:{server.port}/wait_payment"
+    assert requests.get(url, params={"timeout": 0.1}, timeout=5).json()["status"] == "timeout"
+    assert requests.get(url, params={"cursor": "x"}, timeout=5).status_code == 400
+
+
+def test_stream_resumes_from_store_after_cache_eviction(push):
+    server, _, pay = push
+    for index in range(5): # 缓存只保留最近 2 条 (加上裁剪前的余量)，从 0 续传需要查询数据库
+        pay(f"s{index}")
+    with socket.create_connection(("127.0.0.1", server.port), timeout=5) as sock:
+        sock.sendall(b"GET /stream_payments HTTP/1.1\r\nHost: x\r\nLast-Event-ID: 0\r\n\r\n")
+        data = b""
+        while data.count(b"event: payment") < 5:
+            chunk = sock.recv(65536)
+            assert chunk
+            data += chunk
+    assert data.startswith(b"HTTP/1.1 200 OK") and b"id: 5\n" in data
+
+
+def test_subscriber_limit(dty, tmp_path):
+    store = dty.PaymentStore(str(tmp_path / "payments.db"))
+    server = dty.PushServer("127.0.0.1", 0, max_subscribers=0, store=store,
+                            broadcaster=dty.PaymentBroadcaster()).start()
+    try:
+        response = requests.get(f"http://127.0.0.1:{server.port}/wait_payment", timeout=5)
+        assert response.status_code == 503 and response.headers["Retry-After"] == "5"
+    finally:
+        server.stop()
@@ -0,0 +1,53 @@
+import numpy as np
+from PIL import Image, ImageDraw
+
+
+def _pane(card_tops, height=600, width=300):
+    """浅色模式的聊天窗口: 灰色背景上的白色卡片 (带文字和分隔线)，卡片上方是时间戳"""
+    img = Image.new("RGB", (width, height), (237, 237, 237))
+    draw = ImageDraw.Draw(img)
+    for top in card_tops:
+        draw.text((width // 2 - 15, top - 20), "10:30", fill=(150, 150, 150))
+        draw.rectangle((20, top, width - 20, top + 150), fill=(255, 255, 255))
+        for row in range(4):
+            draw.rectangle((36, top + 16 + row * 28, 120 + (top + row * 37) % 150, top + 30 + row * 28), fill=(30, 30, 30))
+        draw.line((36, top + 125, width - 36, top + 125), fill=(237, 237, 237))
+    return img
+
+
+class _Engine:
+    """记录送入 OCR 的图像尺寸"""
+    def __init__(self):
+        self.calls = []
+
+    def image_to_words(self, img):
+        self.calls.append(("words", img.size))
+        return []
+
+    def image_to_string(self, img):
+        self.calls.append(("string", img.size))
+        return ""
+
+
+def test_locate_cards_finds_colour_bands(dty):
+    recognizer = dty.ReceiptRegionRecognizer()
+    cards = recognizer.locate_cards(np.asarray(_pane([40, 300]).convert("L")))
+    assert cards == [(20, 40, 281, 191), (20, 300, 281, 451)] # 分隔线不切断卡片，时间戳不算卡片
+
+
+def test_frame_without_bands_falls_back_to_one_ocr(dty):
+    engine = _Engine()
+    dty.ReceiptRegionRecognizer().recognise(engine, Image.new("RGB", (300, 600), (255, 255, 255)))
+    assert [kind for kind, _ in engine.calls] == ["string"]
+
+
+def test_scrolled_frame_only_recognises_new_cards(dty):
+    recognizer = dty.ReceiptRegionRecognizer(amount_digits=False)
+    scroll = dty.ScrollState()
+    engine = _Engine()
+    chat = _pane([40, 240, 440, 640], height=800)
+    recognizer.recognise(engine, chat.crop((0, 0, 300, 600)), scroll)
+    assert len(engine.calls) == 3
+    engine.calls.clear()
+    recognizer.recognise(engine, chat.crop((0, 200, 300, 800)), scroll) # 新卡片把内容上推 200 行
+    assert len(engine.calls) == 1
@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+from conftest import ROOT
+
+
+def test_overlapping_keywords_all_reported(dty):
+    rules = dty.ReceiptRules(["abcd"], ["bc"], {"amount": ["cd"]})
+    hits = sorted((hit.kind, hit.start, hit.end) for hit in rules.scan("xabcdx"))
+    assert hits == [("amount", 3, 5), ("exclude", 2, 4), ("include", 1, 5)]
+
+
+def test_shared_prefix_keywords(dty):
+    rules = dty.ReceiptRules(["收款成功"], anchors={"amount": ["收款金额"]})
+    assert [hit.kind for hit in rules.scan("收款金额 收款成功")] == ["amount", "include"]
+
+
+def test_whitespace_split_keyword(dty):
+    text = "聊天\n收 款\n成  功"
+    (hit,) = dty.ReceiptRules(["收款成功"]).scan(text)
+    assert text[hit.start:hit.end] == "收 款\n成  功"
+
+
+@pytest.mark.parametrize("include, exclude, anchors", [
+    ([], [], {}),
+    (["a"], ["a"], {}),
+    (["a"], [], {"unknown": ["b"]}),
+    ([" "], [], {}),
+])
+def test_invalid_rules(dty, include, exclude, anchors):
+    with pytest.raises(ValueError):
+        dty.ReceiptRules(include, exclude, anchors)
+
+
+def test_rules_file_matches_defaults(dty):
+    rules = dty.load_receipt_rules(os.path.join(ROOT, "rules.json"))
+    defaults = dty.load_receipt_rules(None)
+    assert sorted(rules.rules) == sorted(defaults.rules)
+
+
+def test_invalid_rules_file(dty, tmp_path):
+    path = tmp_path / "rules.json"
+    for content in ("{", "[]", '{"include": []}'):
+        path.write_text(content, encoding="utf-8")
+        with pytest.raises(ValueError):
+            dty.load_receipt_rules(str(path))
+
+
+def test_hits_are_counted(dty):
+    rules = dty.ReceiptRules(["收款成功"], ["自动续费"])
+    before = dty.rule_hits_counter.value("exclude:自动续费")
+    dty.ReceiptRules.count(rules.scan("自动续费 收款成功 自动续费"))
+    assert dty.rule_hits_counter.value("exclude:自动续费") == before + 2
@@ -0,0 +1,43 @@
+import numpy as np
+
+
+def _chat(height=400, width=120, seed=0):
+    """每隔几行一条随机 "文字" 的灰度画面"""
+    rng = np.random.default_rng(seed)
+    gray = np.full((height, width), 237, dtype=np.uint8)
+    for top in range(4, height - 6, 12):
+        gray[top:top + 6, 10:110] = rng.integers(0, 255, size=(6, 100), dtype=np.uint8)
+    return gray
+
+
+def test_unchanged_frame_has_no_scroll(dty):
+    rows = dty.row_signature(_chat())
+    assert dty.estimate_scroll(rows, rows) == 0
+
+
+def test_scroll_distance_is_found(dty):
+    content = _chat(height=460)
+    previous, current = content[:400], content[60:460]
+    assert dty.estimate_scroll(dty.row_signature(previous), dty.row_signature(current)) == 60
+
+
+def test_in_place_change_and_resize_are_not_scrolls(dty):
+    previous = dty.row_signature(_chat(seed=1))
+    assert dty.estimate_scroll(previous, dty.row_signature(_chat(seed=2))) is None
+    assert dty.estimate_scroll(previous, dty.row_signature(_chat(height=300, seed=1))) is None
+
+
+def test_scroll_beyond_max_fraction_is_rejected(dty):
+    content = _chat(height=800)
+    previous, current = dty.row_signature(content[:400]), dty.row_signature(content[350:750])
+    assert dty.estimate_scroll(previous, current, max_fraction=0.75) is None
+
+
+def test_scroll_state_plans_new_strip(dty):
+    content = _chat(height=460)
+    state = dty.ScrollState()
+    first = dty.row_signature(content[:400])
+    assert state.plan(first, 400) == 0 # 第一帧整帧识别
+    state.commit(first)
+    assert state.plan(dty.row_signature(content[60:460]), 400) == 400 - 60 - dty.SCROLL_STRIP_OVERLAP
+    assert state.plan(first, 400) == 400 # 内容没有移动
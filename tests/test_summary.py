@@ -0,0 +1,74 @@
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def store(dty, tmp_path):
+    return dty.PaymentStore(str(tmp_path / "payments.db"))
+
+
+def _record(order_id, amount, memo="m", payment_time="2026-10-18 09:00:00"):
+    return {"order_id": order_id, "actual_amount": amount, "payment_time": payment_time,
+            "payer_memo": "", "user_memo": memo, "account": "A"}
+
+
+def test_amount_cents(dty):
+    assert dty.amount_to_cents("12.345") == 1235
+    assert dty.amount_to_cents(" 0.1 ") == 10
+    assert dty.amount_to_cents("abc") is None
+    assert dty.amount_to_cents("NaN") is None
+    assert dty.format_cents(-5) == "-0.05"
+    assert dty.normalize_amount("1") == "1.00"
+    assert dty.normalize_amount("") == ""
+
+
+def test_totals_are_exact_cents(store):
+    for index in range(10):
+        store.insert(_record(f"c{index}", "0.10")) # 浮点相加会得到 0.9999999999999999
+    summary = store.summary()
+    assert summary["count"] == 10 and summary["cents"] == 100
+
+
+def test_summary_buckets_and_date_filter(store):
+    store.insert(_record("a", "1.00", memo="x", payment_time="2026-10-17 23:59:59"))
+    store.insert(_record("b", "2.50", memo="y", payment_time="2026-10-18 09:00:00"))
+    store.insert(_record("c", "3.00", memo="y", payment_time="2026-10-18 09:30:00"))
+    summary = store.summary()
+    assert (summary["count"], summary["cents"]) == (3, 650)
+    assert summary["days"] == [("2026-10-17", 1, 100), ("2026-10-18", 2, 550)]
+    assert summary["hours"] == [("2026-10-17 23", 1, 100), ("2026-10-18 09", 2, 550)]
+    assert summary["memos"] == [("y", 2, 550), ("x", 1, 100)]
+    since = store.summary(since="2026-10-18")
+    assert (since["count"], since["cents"]) == (2, 550) and len(since["memos"]) == 2 # 按备注统计不受日期过滤影响
+    assert store.summary(until="2026-10-17")["days"] == [("2026-10-17", 1, 100)]
+    assert store.summary(memo_limit=1)["memos"] == [("y", 2, 550)]
+
+
+def test_old_database_is_migrated(dty, tmp_path):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE payments (id INTEGER PRIMARY KEY AUTOINCREMENT, order_id TEXT NOT NULL, "
+                 "actual_amount TEXT NOT NULL, payment_time TEXT NOT NULL, payer_memo TEXT, user_memo TEXT, "
+                 "account TEXT, created_at REAL NOT NULL)")
+    conn.execute("INSERT INTO payments (order_id, actual_amount, payment_time, payer_memo, user_memo, account, created_at) "
+                 "VALUES ('old', '7.25', '2026-10-01 08:00:00', '', 'm', 'A', 0)")
+    conn.commit()
+    conn.close()
+    store = dty.PaymentStore(path)
+    assert store.find_by_order_id("old")["amount_cents"] == 725
+    store.insert(_record("new", "0.75"))
+    summary = store.summary()
+    assert (summary["count"], summary["cents"]) == (2, 800)
+
+
+def test_summary_endpoint(dty, store, monkeypatch):
+    monkeypatch.setattr(dty, "payment_store", store)
+    store.insert(_record("e1", "12.34", memo="endpoint"))
+    client = dty.app.test_client()
+    body = client.get("/payment_summary?since=2026-10-18&until=2026-10-18").get_json()
+    assert body["total_amount"] == "12.34" and body["total_amount_cents"] == 1234
+    assert body["days"] == [{"day": "2026-10-18", "count": 1, "amount": "12.34", "amount_cents": 1234}]
+    assert body["memos"][0]["user_memo"] == "endpoint"
+    for query in ("since=2026/10/18", "memo_limit=0", "memo_limit=x"):
+        assert client.get(f"/payment_summary?{query}").status_code == 400